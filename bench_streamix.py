@@ -0,0 +1,188 @@
+"""
+Benchmarks for the overhead of streamix itself, run offline against synthetic ffprobe output and the stub
+ffprobe/ffmpeg executables in bench_stubs.
+
+    # decision throughput through FileStreams and _get_file_state
+    python bench_streamix.py decisions --files 100000
+
+    # the same decisions for the whole corpus at once with the batch planner
+    python bench_streamix.py batch --files 500000
+
+    # end-to-end scan -> probe -> decide -> execute with stubs that take the given time per call
+    python bench_streamix.py pipeline --files 2000 --probe-latency 0.005 --ffmpeg-latency 0.02
+
+    # save a baseline, then fail (exit code 1) when a later run is more than 20% slower
+    python bench_streamix.py decisions --files 100000 --save baseline.json
+    python bench_streamix.py decisions --files 100000 --baseline baseline.json
+"""
+import argparse
+import collections
+import io
+import json
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+import streamix
+
+__author__ = 'cody'
+
+STUBS_DIR = pathlib.Path(__file__).resolve().parent / "bench_stubs"
+sys.path.insert(0, str(STUBS_DIR))
+
+import synthetic_probe  # noqa: E402
+
+
+def bench_decisions(files, max_audio=6, max_subs=6, chunk_size=10000, seed=0):
+    """Time building the processors (streams and state) and commands for a synthetic corpus"""
+    states = collections.Counter()
+    corpus = synthetic_probe.generate_corpus(files, seed=seed, max_audio=max_audio, max_subs=max_subs)
+    elapsed = 0.0
+    done = 0
+
+    while done < files:
+        # generate the corpus in chunks outside of the timing, so a million files never sit in memory at once
+        chunk = [next(corpus) for _ in range(min(chunk_size, files - done))]
+        paths = [pathlib.Path("/bench/{0}.mkv".format(done + i)) for i in range(len(chunk))]
+
+        start = time.perf_counter()
+        for path, info in zip(paths, chunk):
+            processor = streamix.FileProcessor(path, file_info=info)
+            if processor.needs_processing():
+                processor._get_command_args()
+            states[processor.state] += 1
+        elapsed += time.perf_counter() - start
+        done += len(chunk)
+
+    return {"benchmark": "decisions",
+            "files": files,
+            "seconds": elapsed,
+            "files_per_sec": files / elapsed,
+            "states": dict(states)}
+
+
+def bench_batch(files, max_audio=6, max_subs=6, seed=0):
+    """Time laying out a synthetic corpus in columns and classifying it with plan_batch"""
+    corpus = synthetic_probe.generate_corpus(files, seed=seed, max_audio=max_audio, max_subs=max_subs)
+
+    start = time.perf_counter()
+    columns = streamix.StreamColumns()
+    for i, info in enumerate(corpus):
+        columns.add(info, "{0}.mkv".format(i))
+    # generating the corpus is included here, the planning below is timed on its own
+    layout_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plans = streamix.plan_batch(columns, streamix.cfg.get("safe_codecs", []),
+                                streamix.cfg.get("audio_codec_priority", []), streamix.cfg.get("extensions"))
+    elapsed = time.perf_counter() - start
+
+    return {"benchmark": "batch",
+            "files": files,
+            "streams": len(columns.kinds),
+            "layout_secs": layout_secs,
+            "seconds": elapsed,
+            "files_per_sec": files / elapsed,
+            "states": dict(collections.Counter(state for state, _ in plans))}
+
+
+def bench_pipeline(files, probe_latency=0.0, ffmpeg_latency=0.0, probe_workers=4, remap_workers=4,
+                   convert_workers=2, files_per_dir=100, extras_per_file=2):
+    """Time a full run over a temporary library of empty files, using the stub ffprobe and ffmpeg"""
+    with tempfile.TemporaryDirectory(prefix="streamix-bench-") as library:
+        for i in range(files):
+            directory = os.path.join(library, "dir{0:05d}".format(i // files_per_dir))
+            os.makedirs(directory, exist_ok=True)
+            io.open(os.path.join(directory, "{0}.mkv".format(i)), "wb").close()
+            # files that never match the extensions and should cost next to nothing
+            for extra in range(extras_per_file):
+                io.open(os.path.join(directory, "{0}.{1}.srt".format(i, extra)), "wb").close()
+
+        os.environ["PATH"] = str(STUBS_DIR) + os.pathsep + os.environ.get("PATH", "")
+        os.environ["STREAMIX_STUB_PROBE_LATENCY"] = str(probe_latency)
+        os.environ["STREAMIX_STUB_FFMPEG_LATENCY"] = str(ffmpeg_latency)
+        streamix.cfg.update({"directories": [library],
+                             "probe_workers": probe_workers,
+                             "remap_workers": remap_workers,
+                             "convert_workers": convert_workers,
+                             "status_file": None,
+                             "dry-run": False})
+
+        start = time.perf_counter()
+        scanned = sum(1 for _ in streamix.collect_candidate_files())
+        scan_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        checked, scheduler = streamix.process_files(streamix.collect_candidate_files())
+        elapsed = time.perf_counter() - start
+
+    return {"benchmark": "pipeline",
+            "files": files,
+            "scanned": scanned,
+            "checked": checked,
+            "processed": scheduler.processed,
+            "failed": scheduler.failed,
+            "scan_secs": scan_secs,
+            "seconds": elapsed,
+            "files_per_sec": checked / elapsed}
+
+
+def check_regression(result, baseline_file, tolerance):
+    """Return False when the result is slower than the saved baseline by more than the tolerance"""
+    with io.open(baseline_file) as f:
+        baseline = json.load(f)
+
+    limit = baseline["files_per_sec"] * (1 - tolerance)
+    if result["files_per_sec"] < limit:
+        print("REGRESSION: {0:.0f} files/sec is below {1:.0f} ({2:.0%} under the baseline of {3:.0f})".format(
+            result["files_per_sec"], limit, tolerance, baseline["files_per_sec"]))
+        return False
+
+    print("OK: {0:.0f} files/sec (baseline {1:.0f})".format(result["files_per_sec"], baseline["files_per_sec"]))
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of streamix")
+    parser.add_argument("benchmark", choices=["decisions", "batch", "pipeline"])
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--max-audio", type=int, default=6, help="decisions/batch: max audio streams per file")
+    parser.add_argument("--max-subs", type=int, default=6, help="decisions/batch: max subtitle streams per file")
+    parser.add_argument("--probe-latency", type=float, default=0.0, help="pipeline: seconds per stub ffprobe call")
+    parser.add_argument("--ffmpeg-latency", type=float, default=0.0, help="pipeline: seconds per stub ffmpeg call")
+    parser.add_argument("--probe-workers", type=int, default=4)
+    parser.add_argument("--save", help="write the result as a baseline to this file")
+    parser.add_argument("--baseline", help="compare the result with a baseline saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    streamix.load_config()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if args.benchmark == "decisions":
+        result = bench_decisions(args.files, max_audio=args.max_audio, max_subs=args.max_subs)
+    elif args.benchmark == "batch":
+        result = bench_batch(args.files, max_audio=args.max_audio, max_subs=args.max_subs)
+    else:
+        result = bench_pipeline(args.files, probe_latency=args.probe_latency, ffmpeg_latency=args.ffmpeg_latency,
+                                probe_workers=args.probe_workers)
+
+    print(json.dumps(result, indent=2))
+
+    if args.save:
+        with io.open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline and not check_regression(result, args.baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
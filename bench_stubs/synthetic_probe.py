@@ -0,0 +1,65 @@
+"""Synthetic ffprobe output shared by the benchmarks and the stub ffprobe"""
+import random
+import zlib
+
+__author__ = 'cody'
+
+VIDEO_CODECS = ["h264", "hevc", "mpeg4"]
+AUDIO_CODECS = ["aac", "ac3", "eac3", "dts", "truehd", "flac", "pcm_dvd", "mp3", "opus"]
+SUB_CODECS = ["subrip", "ass", "hdmv_pgs_subtitle", "dvd_subtitle"]
+LANGUAGES = ["eng", "eng", "fre", "ger", "spa", "jpn", "ita", None]
+AUDIO_BITRATES = [128000, 192000, 320000, 448000, 640000, 768000, 1536000, None]
+
+
+def _stream(rng, index, codec_type, codec_name, language, bitrate, full):
+    stream = {"index": index, "codec_type": codec_type, "codec_name": codec_name}
+
+    if bitrate is not None:
+        stream["bit_rate"] = str(bitrate)
+
+    if language is not None:
+        stream["tags"] = {"language": language}
+
+    if full:
+        # the bulk of a real ffprobe document that streamix never reads
+        stream["codec_long_name"] = codec_name.upper()
+        stream["time_base"] = "1/1000"
+        stream["start_time"] = "0.000000"
+        stream["disposition"] = {k: 0 for k in ("default", "dub", "original", "comment", "lyrics", "karaoke",
+                                                 "forced", "hearing_impaired", "visual_impaired", "clean_effects")}
+        stream.setdefault("tags", {}).update({"BPS": str(bitrate or rng.randint(1, 10000000)),
+                                              "DURATION": "01:23:45.000000000",
+                                              "NUMBER_OF_FRAMES": str(rng.randint(1000, 1000000))})
+    return stream
+
+
+def generate_info(rng, max_audio=6, max_subs=6, languages=LANGUAGES, full=False):
+    """Build one ffprobe document with a video stream, 1 to max_audio audio streams and up to max_subs subtitles"""
+    streams = [_stream(rng, 0, "video", rng.choice(VIDEO_CODECS), rng.choice(languages), None, full)]
+
+    for _ in range(rng.randint(1, max_audio)):
+        streams.append(_stream(rng, len(streams), "audio", rng.choice(AUDIO_CODECS), rng.choice(languages),
+                               rng.choice(AUDIO_BITRATES), full))
+
+    for _ in range(rng.randint(0, max_subs)):
+        streams.append(_stream(rng, len(streams), "subtitle", rng.choice(SUB_CODECS), rng.choice(languages),
+                               None, full))
+
+    duration = rng.uniform(1200, 10800)
+    bit_rate = rng.randint(2000000, 40000000)
+    return {"streams": streams,
+            "format": {"duration": "{0:.6f}".format(duration),
+                       "bit_rate": str(bit_rate),
+                       "size": str(int(duration * bit_rate / 8))}}
+
+
+def generate_corpus(count, seed=0, **kwargs):
+    """Yield `count` ffprobe documents, the same ones for the same seed"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield generate_info(rng, **kwargs)
+
+
+def info_for_path(path, full=True):
+    """The ffprobe document for a file, always the same for the same path"""
+    return generate_info(random.Random(zlib.crc32(str(path).encode("utf-8"))), full=full)
@@ -0,0 +1,568 @@
+"""
+Reads the track list of Matroska and MP4 files straight from their headers, giving the same stream records as ffprobe
+for the fields streamix makes its decisions on (type, codec, language and bitrate).
+
+The file is mapped with mmap, so only the pages holding the headers are ever read. Anything the reader cannot match
+ffprobe on exactly makes read_file_info return None, and the caller falls back to ffprobe.
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+
+__author__ = 'cody'
+
+
+class Unsupported(Exception):
+    """The file uses something the header reader does not handle, ffprobe has to be used instead"""
+
+
+class Track(object):
+    """One track of the file, in the order (and so with the index) ffprobe lists it"""
+    __slots__ = ("index", "codec_type", "codec_name", "language", "bit_rate", "default", "forced")
+
+    def __init__(self, index, codec_type, codec_name, language=None, bit_rate=None, default=False, forced=False):
+        self.index = index
+        self.codec_type = codec_type
+        self.codec_name = codec_name
+        self.language = language
+        self.bit_rate = bit_rate
+        self.default = default
+        self.forced = forced
+
+    def as_stream(self):
+        """The track as an ffprobe stream"""
+        stream = {"index": self.index, "codec_type": self.codec_type, "codec_name": self.codec_name}
+        if self.bit_rate is not None:
+            stream["bit_rate"] = str(self.bit_rate)
+        if self.language is not None:
+            stream["tags"] = {"language": self.language}
+        stream["disposition"] = {"default": int(self.default), "forced": int(self.forced)}
+        return stream
+
+
+def read_file_info(path):
+    """The ffprobe style info (streams and format) of a Matroska or MP4 file, or None when ffprobe must be used"""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 16:
+                return None
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                header = read_header(buf)
+    except (OSError, ValueError, IndexError, struct.error, UnicodeDecodeError, Unsupported):
+        return None
+
+    file_format = {"size": str(size)}
+    if header.duration is not None:
+        file_format["duration"] = "{0:.6f}".format(header.duration)
+
+    return {"streams": [t.as_stream() for t in header.tracks], "format": file_format}
+
+
+def set_default_track(path, index):
+    """
+    Make the audio track at index the default one by editing its header flags in place. Returns False (and changes
+    nothing) when the header cannot express it without rewriting the file.
+    """
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                edits = read_header(buf).default_track_edits(index)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError, Unsupported):
+            return False
+
+    if edits is None:
+        return False
+
+    # only the bytes that differ are written, and a file already flagged is not even opened for writing (which
+    # would show up as a change of the file when watching)
+    if edits:
+        with open(path, "r+b") as f:
+            for offset, data in edits:
+                f.seek(offset)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    return True
+
+
+def read_header(buf):
+    """Parse the header of the mapped file with the reader matching its magic bytes"""
+    if buf[:4] == MatroskaHeader.MAGIC:
+        return MatroskaHeader(buf)
+
+    if buf[4:8] in Mp4Header.MAGIC:
+        return Mp4Header(buf)
+
+    raise Unsupported("not a Matroska or MP4 file")
+
+
+#########################################
+#
+# Matroska
+#
+#########################################
+
+def _read_vint(buf, pos, keep_marker=False):
+    """An EBML variable size integer at pos: its value and its length in bytes"""
+    first = buf[pos]
+    if first == 0:
+        raise Unsupported("invalid EBML integer at {0}".format(pos))
+
+    length = 9 - first.bit_length()
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in buf[pos + 1:pos + length]:
+        value = (value << 8) | b
+    return value, length
+
+
+def _ebml_elements(buf, start, end):
+    """Yield (id, data start, data end) for the elements between start and end, with a None end for an unknown size"""
+    pos = start
+    while pos < end:
+        element_id, id_length = _read_vint(buf, pos, keep_marker=True)
+        size, size_length = _read_vint(buf, pos + id_length)
+        data = pos + id_length + size_length
+
+        if size == (1 << (7 * size_length)) - 1:
+            yield element_id, data, None
+            return
+
+        if data + size > end:
+            raise Unsupported("element {0:X} runs past its parent".format(element_id))
+
+        yield element_id, data, data + size
+        pos = data + size
+
+
+class MatroskaHeader(object):
+    """The tracks and duration of a Matroska (or WebM) file, from its EBML header, Info and Tracks elements"""
+    MAGIC = b"\x1a\x45\xdf\xa3"
+
+    EBML, DOC_TYPE, SEGMENT = 0x1A45DFA3, 0x4282, 0x18538067
+    SEEK_HEAD, SEEK, SEEK_ID, SEEK_POSITION = 0x114D9B74, 0x4DBB, 0x53AB, 0x53AC
+    INFO, TIMESTAMP_SCALE, DURATION = 0x1549A966, 0x2AD7B1, 0x4489
+    TRACKS, TRACK_ENTRY, TRACK_TYPE, CODEC_ID = 0x1654AE6B, 0xAE, 0x83, 0x86
+    LANGUAGE, LANGUAGE_BCP47 = 0x22B59C, 0x22B59D
+    FLAG_DEFAULT, FLAG_FORCED = 0x88, 0x55AA
+    ATTACHMENTS, CLUSTER = 0x1941A469, 0x1F43B675
+
+    TRACK_TYPES = {1: "video", 2: "audio", 17: "subtitle"}
+    CODECS = {"V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc", "V_MPEG4/ISO/SP": "mpeg4",
+              "V_MPEG4/ISO/ASP": "mpeg4", "V_MPEG4/ISO/AP": "mpeg4", "V_MPEG1": "mpeg1video",
+              "V_MPEG2": "mpeg2video", "V_VP8": "vp8", "V_VP9": "vp9", "V_AV1": "av1",
+              "A_AC3": "ac3", "A_EAC3": "eac3", "A_TRUEHD": "truehd", "A_FLAC": "flac", "A_MPEG/L3": "mp3",
+              "A_MPEG/L2": "mp2", "A_OPUS": "opus", "A_VORBIS": "vorbis",
+              "S_TEXT/UTF8": "subrip", "S_TEXT/SSA": "ass", "S_TEXT/ASS": "ass", "S_SSA": "ass", "S_ASS": "ass",
+              "S_TEXT/WEBVTT": "webvtt", "S_HDMV/PGS": "hdmv_pgs_subtitle", "S_HDMV/TEXTST": "hdmv_text_subtitle",
+              "S_VOBSUB": "dvd_subtitle", "S_DVBSUB": "dvb_subtitle"}
+    CODEC_PREFIXES = (("A_AAC", "aac"), ("A_DTS", "dts"))
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.tracks = []
+        # the positions of the FlagDefault and FlagForced data of each track, None when the element is left out
+        self.flags = []
+        self.duration = None
+
+        ebml_id, data, end = next(_ebml_elements(buf, 0, len(buf)))
+        if ebml_id != self.EBML or end is None:
+            raise Unsupported("missing EBML header")
+
+        doc_type = self._children(data, end).get(self.DOC_TYPE)
+        if doc_type is None or self._string(*doc_type) not in ("matroska", "webm"):
+            raise Unsupported("not a Matroska document")
+
+        segment_id, segment_start, segment_end = next(_ebml_elements(buf, end, len(buf)))
+        if segment_id != self.SEGMENT:
+            raise Unsupported("missing segment")
+
+        # a segment of unknown size (or from a truncated file) runs to the end of the file
+        segment_end = len(buf) if segment_end is None else segment_end
+        self.segment_start = segment_start
+
+        top_level = self._top_level(segment_start, segment_end)
+        if self.TRACKS not in top_level:
+            raise Unsupported("no tracks")
+        if self.ATTACHMENTS in top_level:
+            # ffprobe lists attachments as streams, which the remap would have to keep
+            raise Unsupported("attachments")
+
+        if self.INFO in top_level:
+            self._read_info(*top_level[self.INFO])
+        self._read_tracks(*top_level[self.TRACKS])
+
+    def _top_level(self, start, end):
+        """The positions of the level 1 elements, using the seek head for the ones after the first cluster"""
+        found = {}
+        seeks = {}
+
+        for element_id, data, data_end in _ebml_elements(self.buf, start, end):
+            if element_id == self.CLUSTER or data_end is None:
+                break
+
+            found.setdefault(element_id, (data, data_end))
+            if element_id == self.SEEK_HEAD:
+                seeks.update(self._seeks(data, data_end))
+        else:
+            return found
+
+        if not seeks:
+            raise Unsupported("no seek head to find the elements after the first cluster")
+
+        # a seek head can point to a second seek head (mkvmerge writes one at the end of the file)
+        if self.SEEK_HEAD in seeks and seeks[self.SEEK_HEAD] != found[self.SEEK_HEAD][0]:
+            data, data_end = self._seek_to(self.SEEK_HEAD, seeks[self.SEEK_HEAD], end)
+            for element_id, position in self._seeks(data, data_end).items():
+                seeks.setdefault(element_id, position)
+
+        for element_id in (self.INFO, self.TRACKS, self.ATTACHMENTS):
+            if element_id in seeks and element_id not in found:
+                found[element_id] = self._seek_to(element_id, seeks[element_id], end)
+
+        return found
+
+    def _seeks(self, start, end):
+        seeks = {}
+        for element_id, data, data_end in _ebml_elements(self.buf, start, end):
+            if element_id == self.SEEK:
+                seek = self._children(data, data_end)
+                if self.SEEK_ID in seek and self.SEEK_POSITION in seek:
+                    seeks[self._uint(*seek[self.SEEK_ID])] = self._uint(*seek[self.SEEK_POSITION])
+        return seeks
+
+    def _seek_to(self, element_id, position, end):
+        """The data of the element a seek head entry points to (positions are relative to the segment data)"""
+        found_id, data, data_end = next(_ebml_elements(self.buf, self.segment_start + position, end))
+        if found_id != element_id or data_end is None:
+            raise Unsupported("seek head entry for {0:X} does not point to it".format(element_id))
+        return data, data_end
+
+    def _read_info(self, start, end):
+        info = self._children(start, end)
+        if self.DURATION in info:
+            scale = self._uint(*info[self.TIMESTAMP_SCALE]) if self.TIMESTAMP_SCALE in info else 1000000
+            self.duration = self._float(*info[self.DURATION]) * scale / 1000000000
+
+    def _read_tracks(self, start, end):
+        for element_id, data, data_end in _ebml_elements(self.buf, start, end):
+            if element_id == self.TRACK_ENTRY:
+                self.tracks.append(self._read_track(len(self.tracks), data, data_end))
+
+    def _read_track(self, index, start, end):
+        entry = self._children(start, end)
+
+        if self.TRACK_TYPE not in entry or self.CODEC_ID not in entry:
+            raise Unsupported("incomplete track entry")
+        if self.LANGUAGE_BCP47 in entry:
+            raise Unsupported("BCP 47 language")
+
+        codec_type = self.TRACK_TYPES.get(self._uint(*entry[self.TRACK_TYPE]))
+        codec_name = self._codec_name(self._string(*entry[self.CODEC_ID]))
+        if codec_type is None or codec_name is None:
+            raise Unsupported("track type or codec")
+
+        flag_default, flag_forced = entry.get(self.FLAG_DEFAULT), entry.get(self.FLAG_FORCED)
+        self.flags.append((flag_default, flag_forced))
+
+        # the language defaults to english, and undetermined is left out like ffprobe does
+        language = self._string(*entry[self.LANGUAGE]) if self.LANGUAGE in entry else "eng"
+        return Track(index, codec_type, codec_name, None if language == "und" else language,
+                     default=self._flag(flag_default, True), forced=self._flag(flag_forced, False))
+
+    def default_track_edits(self, index):
+        """
+        The writes setting FlagDefault on the audio track at index and clearing FlagDefault and FlagForced on the
+        other audio tracks, or None when a flag that must change is left out of the header (it cannot be inserted)
+        """
+        edits = []
+        for track, (flag_default, flag_forced) in zip(self.tracks, self.flags):
+            if track.codec_type != "audio":
+                continue
+
+            if track.index == index:
+                # a missing FlagDefault already defaults to 1
+                wanted = [(flag_default, 1, 1)]
+            else:
+                wanted = [(flag_default, 0, 1), (flag_forced, 0, 0)]
+
+            for position, value, default in wanted:
+                edit = self._uint_edit(position, value, default)
+                if edit is False:
+                    return None
+                if edit is not None:
+                    edits.append(edit)
+
+        return edits
+
+    def _flag(self, position, default):
+        """The value of a flag element, its default when it is left out (or empty)"""
+        if position is None or position[0] == position[1]:
+            return default
+        return bool(self._uint(*position))
+
+    def _uint_edit(self, position, value, default):
+        """The (offset, bytes) write to store value in the element, None when nothing changes, False when it can't"""
+        if position is None or position[0] == position[1]:
+            # a left out (or empty) element has its default value
+            return None if value == default else False
+
+        start, end = position
+        data = value.to_bytes(end - start, "big")
+        return None if self.buf[start:end] == data else (start, data)
+
+    def _codec_name(self, codec_id):
+        if codec_id in self.CODECS:
+            return self.CODECS[codec_id]
+
+        for prefix, name in self.CODEC_PREFIXES:
+            if codec_id.startswith(prefix):
+                return name
+
+        return None
+
+    def _children(self, start, end):
+        """The first of each child element, as {id: (data start, data end)}"""
+        children = {}
+        for element_id, data, data_end in _ebml_elements(self.buf, start, end):
+            if data_end is None:
+                raise Unsupported("child element of unknown size")
+            children.setdefault(element_id, (data, data_end))
+        return children
+
+    def _uint(self, start, end):
+        return int.from_bytes(self.buf[start:end], "big")
+
+    def _float(self, start, end):
+        if end - start == 4:
+            return struct.unpack(">f", self.buf[start:end])[0]
+        if end - start == 8:
+            return struct.unpack(">d", self.buf[start:end])[0]
+        return 0.0
+
+    def _string(self, start, end):
+        return self.buf[start:end].rstrip(b"\0").decode("utf-8")
+
+
+#########################################
+#
+# MP4
+#
+#########################################
+
+def _boxes(buf, start, end):
+    """Yield (type, data start, data end) for the boxes between start and end"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+
+        if size < header or pos + size > end:
+            raise Unsupported("box {0} runs past its parent".format(box_type))
+
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _child_boxes(buf, start, end):
+    """The first of each child box, as {type: (data start, data end)}"""
+    children = {}
+    for box_type, data, data_end in _boxes(buf, start, end):
+        children.setdefault(box_type, (data, data_end))
+    return children
+
+
+def _descriptor(buf, pos):
+    """An MPEG-4 descriptor at pos: its tag and the position of its data"""
+    tag = buf[pos]
+    pos += 1
+    for _ in range(4):
+        b = buf[pos]
+        pos += 1
+        if not b & 0x80:
+            break
+    return tag, pos
+
+
+class Mp4Header(object):
+    """The tracks and duration of an MP4 (or QuickTime) file, from its moov box"""
+    MAGIC = (b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide")
+
+    TRACK_ENABLED = 0x1
+
+    HANDLERS = {b"vide": "video", b"soun": "audio", b"subt": "subtitle", b"sbtl": "subtitle"}
+    CODECS = {b"avc1": "h264", b"avc3": "h264", b"hvc1": "hevc", b"hev1": "hevc", b"av01": "av1", b"vp09": "vp9",
+              b"ac-3": "ac3", b"ec-3": "eac3", b"Opus": "opus", b"fLaC": "flac", b".mp3": "mp3", b"mlpa": "truehd",
+              b"dtsc": "dts", b"dtsh": "dts", b"dtsl": "dts", b"dtse": "dts",
+              b"tx3g": "mov_text", b"wvtt": "webvtt", b"stpp": "ttml"}
+    # the object type of an mp4a sample entry decides its codec
+    OBJECT_TYPES = {0x40: "aac", 0x66: "aac", 0x67: "aac", 0x68: "aac", 0x69: "mp3", 0x6B: "mp3",
+                    0xA5: "ac3", 0xA6: "eac3", 0xA9: "dts"}
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.tracks = []
+        self.duration = None
+
+        # the position of the flags in the tkhd box of each track
+        self.track_flags = []
+
+        moov = None
+        for box_type, data, data_end in _boxes(buf, 0, len(buf)):
+            if box_type == b"moov":
+                moov = (data, data_end)
+                break
+
+        if moov is None:
+            raise Unsupported("no moov box")
+
+        for box_type, data, data_end in _boxes(buf, *moov):
+            if box_type == b"mvhd":
+                self._read_mvhd(data)
+            elif box_type == b"trak":
+                self.tracks.append(self._read_trak(len(self.tracks), data, data_end))
+            elif box_type == b"cmov":
+                raise Unsupported("compressed moov")
+
+    def _read_mvhd(self, pos):
+        if self.buf[pos] == 1:
+            timescale, duration = struct.unpack_from(">IQ", self.buf, pos + 20)
+        else:
+            timescale, duration = struct.unpack_from(">II", self.buf, pos + 12)
+
+        if timescale:
+            self.duration = duration / timescale
+
+    def _read_trak(self, index, start, end):
+        trak = _child_boxes(self.buf, start, end)
+        if b"tkhd" not in trak or b"mdia" not in trak:
+            raise Unsupported("track without header or media")
+        mdia = trak[b"mdia"]
+
+        media = _child_boxes(self.buf, *mdia)
+        if b"mdhd" not in media or b"hdlr" not in media or b"minf" not in media:
+            raise Unsupported("incomplete track media")
+
+        codec_type = self.HANDLERS.get(self.buf[media[b"hdlr"][0] + 8:media[b"hdlr"][0] + 12])
+        if codec_type is None:
+            raise Unsupported("track handler")
+
+        timescale, duration, language = self._read_mdhd(media[b"mdhd"][0])
+
+        stbl = _child_boxes(self.buf, *media[b"minf"]).get(b"stbl")
+        if stbl is None:
+            raise Unsupported("track without sample table")
+
+        sample_table = _child_boxes(self.buf, *stbl)
+        if b"stsd" not in sample_table:
+            raise Unsupported("track without sample description")
+
+        codec_name = self._codec_name(*sample_table[b"stsd"])
+        if codec_name is None:
+            raise Unsupported("track codec")
+
+        # the average over the whole track, the way ffprobe reports the bitrate of mp4 streams
+        bit_rate = None
+        data_size = self._data_size(*sample_table[b"stsz"]) if b"stsz" in sample_table else 0
+        if data_size and duration:
+            bit_rate = (data_size * 8 * timescale + duration // 2) // duration
+
+        flags = trak[b"tkhd"][0] + 1
+        self.track_flags.append(flags)
+        enabled = bool(int.from_bytes(self.buf[flags:flags + 3], "big") & self.TRACK_ENABLED)
+        return Track(index, codec_type, codec_name, language, bit_rate, default=enabled)
+
+    def default_track_edits(self, index):
+        """The writes enabling the audio track at index and disabling the other audio tracks"""
+        edits = []
+        for track, position in zip(self.tracks, self.track_flags):
+            if track.codec_type != "audio":
+                continue
+
+            flags = int.from_bytes(self.buf[position:position + 3], "big")
+            wanted = flags | self.TRACK_ENABLED if track.index == index else flags & ~self.TRACK_ENABLED
+            if wanted != flags:
+                edits.append((position, wanted.to_bytes(3, "big")))
+
+        return edits
+
+    def _read_mdhd(self, pos):
+        if self.buf[pos] == 1:
+            timescale, duration, code = struct.unpack_from(">IQH", self.buf, pos + 20)
+        else:
+            timescale, duration, code = struct.unpack_from(">IIH", self.buf, pos + 12)
+
+        return timescale, duration, self._language(code & 0x7FFF)
+
+    @staticmethod
+    def _language(code):
+        """The ISO 639-2 code packed in mdhd, ffprobe reads the old Macintosh code 0 as english"""
+        if code == 0x7FFF:
+            return None
+        if code >= 0x400:
+            return "".join(chr(0x60 + ((code >> shift) & 0x1F)) for shift in (10, 5, 0))
+        if code == 0:
+            return "eng"
+        raise Unsupported("Macintosh language code")
+
+    def _codec_name(self, start, end):
+        entries = list(_boxes(self.buf, start + 8, end))
+        if not entries:
+            raise Unsupported("empty sample description")
+
+        fourcc, data, data_end = entries[0]
+        if fourcc != b"mp4a":
+            return self.CODECS.get(fourcc)
+
+        # the esds box follows the audio sample entry fields, longer for the QuickTime sound versions
+        version = struct.unpack_from(">H", self.buf, data + 8)[0]
+        offset = {0: 28, 1: 44, 2: 64}.get(version)
+        if offset is None:
+            raise Unsupported("sound sample entry version")
+
+        children = _child_boxes(self.buf, data + offset, data_end)
+        if b"esds" not in children and b"wave" in children:
+            children = _child_boxes(self.buf, *children[b"wave"])
+        if b"esds" not in children:
+            raise Unsupported("mp4a without esds")
+
+        return self.OBJECT_TYPES.get(self._object_type(*children[b"esds"]))
+
+    def _object_type(self, start, end):
+        buf = self.buf
+        tag, pos = _descriptor(buf, start + 4)
+        if tag != 0x03:
+            raise Unsupported("esds without an ES descriptor")
+
+        flags = buf[pos + 2]
+        pos += 3
+        if flags & 0x80:
+            pos += 2
+        if flags & 0x40:
+            pos += 1 + buf[pos]
+        if flags & 0x20:
+            pos += 2
+
+        tag, pos = _descriptor(buf, pos)
+        if tag != 0x04:
+            raise Unsupported("esds without a decoder config")
+        return buf[pos]
+
+    def _data_size(self, start, end):
+        sample_size, count = struct.unpack_from(">II", self.buf, start + 4)
+        if sample_size:
+            return sample_size * count
+
+        sizes = array.array("I", self.buf[start + 12:start + 12 + 4 * count])
+        if sys.byteorder == "little":
+            sizes.byteswap()
+        return sum(sizes)
@@ -1,10 +1,43 @@
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import filecmp
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import logging.config
+import logging.handlers
 import pathlib
 import os
-import pexpect
+import queue
+import re
+import select
+import shlex
+import shutil
+import socket
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import types
 import yaml
+import zlib
+
+import mediaheaders
 import io
 
 __version__ = "2.4"
@@ -16,15 +49,87 @@ __author__ = 'cody'
 # global variables
 cfg = {}
 logger = logging.root
+# the Config compiled from cfg, see current_config
+_config = None
+# the listener handing the queued log records to the handlers, see queue_logging
+_log_listener = None
+
+TEMP_SUFFIX = ".tmp"
+# the ioctl cloning a whole file (a reflink) on btrfs, xfs and other copy on write filesystems
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
 
 
 def load_config():
+    global _config
+
     try:
         with io.open("config.yml") as cfg_file:
-            cfg.update(yaml.load(cfg_file))
+            # the libyaml loader when pyyaml was built with it
+            cfg.update(yaml.load(cfg_file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)))
     except Exception as e:
         print("Failed to load config: {0}".format(str(e)))
 
+    # compiled again on first use, so changes made to cfg right after loading are picked up
+    _config = None
+
+
+def current_config():
+    """The Config compiled from cfg as it was loaded"""
+    global _config
+
+    if _config is None:
+        _config = Config.from_dict(cfg)
+    return _config
+
+
+class Config(collections.namedtuple("Config", [
+        "dry_run", "extensions", "safe_codecs", "codec_priority", "codec_ranks", "min_bit_rate",
+        "extra_encode_params", "native_probe", "fast_probe", "fast_probe_size", "fast_probe_analyze_usecs",
+        "probe_timeout_secs", "cost_copy_mb_per_sec", "cost_convert_speed", "scratch_dir", "encode_timeout_secs",
+        "remap_mode"])):
+    """
+    The settings a FileProcessor uses, compiled once from cfg: sets for the membership checks, the codec priority as
+    ranks and the extra encode params already split. Immutable and picklable, so one instance is shared by every
+    processor (and can be sent to other processes as is).
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+        # the ranks are shared by every processor, so they are read-only like the rest
+        if not isinstance(self.codec_ranks, types.MappingProxyType):
+            self = self._replace(codec_ranks=types.MappingProxyType(dict(self.codec_ranks)))
+        return self
+
+    def __getnewargs__(self):
+        # a mapping proxy can't be pickled, the ranks are wrapped again when unpickled
+        return tuple(self._replace(codec_ranks=dict(self.codec_ranks)))
+
+    @classmethod
+    def from_dict(cls, settings):
+        codec_priority = tuple(settings.get("audio_codec_priority") or ())
+        encode_timeout_mins = settings.get("encode_timeout_mins")
+
+        return cls(dry_run=settings.get("dry-run", False),
+                   extensions=frozenset(settings.get("extensions") or ()),
+                   safe_codecs=frozenset(settings.get("safe_codecs") or ()),
+                   codec_priority=codec_priority,
+                   # the first of a repeated codec wins, like the priority loop always did
+                   codec_ranks={c: i for i, c in reversed(list(enumerate(codec_priority)))},
+                   min_bit_rate=settings.get("audio_min_bitrate", 320000),
+                   extra_encode_params=tuple(shlex.split(settings.get("extra_encode_params") or "")),
+                   native_probe=settings.get("native_probe", True),
+                   fast_probe=settings.get("fast_probe", True),
+                   fast_probe_size=settings.get("fast_probe_size", 1000000),
+                   fast_probe_analyze_usecs=settings.get("fast_probe_analyze_usecs", 1000000),
+                   probe_timeout_secs=settings.get("probe_timeout_secs", 30),
+                   cost_copy_mb_per_sec=settings.get("cost_copy_mb_per_sec", 100),
+                   cost_convert_speed=settings.get("cost_convert_speed", 20),
+                   scratch_dir=settings.get("scratch_dir"),
+                   encode_timeout_secs=None if encode_timeout_mins is None else encode_timeout_mins * 60,
+                   remap_mode=settings.get("remap_mode", "reorder"))
+
 
 def configure_logging():
     if "logging" not in cfg:
@@ -37,18 +142,1144 @@ def configure_logging():
             print("Failed to configre logging: {0}".format(str(e)))
             exit()
 
+        if cfg.get("log_queue", True):
+            queue_logging()
+
+
+def queue_logging():
+    """
+    Move the root handlers behind a queue, so logging never blocks the threads on the console or the log file: the
+    records are only queued and a listener thread hands them to the handlers
+    """
+    global _log_listener
+    stop_logging()
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _log_listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_logging():
+    """Write out the queued records and put the handlers back on the root logger"""
+    global _log_listener
+    if _log_listener is None:
+        return
+
+    _log_listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    for handler in _log_listener.handlers:
+        root.addHandler(handler)
+    _log_listener = None
+
 
 def collect_candidate_files():
-    """Scan the directories for all matchig files"""
+    """Scan the directories for all matching files, yielding them as they are found"""
     directories = [pathlib.Path(d) for d in cfg.get("directories", [])]
 
-    matching_files = []
     for directory in directories:
         logging.info("Searching directory: {0}".format(directory))
-        matching_files.extend((d for d in directory.rglob('*') if d.is_file()))
+        files = walk_directory(directory, **scan_rules())
+
+        if not metrics.enabled:
+            yield from files
+            continue
+
+        # time only the scanning, not the work done on each file between yields
+        while True:
+            with metrics.timed("scan"):
+                f = next(files, None)
+            if f is None:
+                break
+            yield f
+
+
+def scan_rules():
+    """The configured rules deciding which files are candidates, as keyword arguments for walk_directory"""
+    return {"extensions": cfg.get("extensions", []),
+            "exclude": cfg.get("exclude") or [],
+            "min_size": cfg.get("min_size", 0),
+            "skip_hidden": cfg.get("skip_hidden", False)}
+
+
+def has_matching_extension(name, extensions):
+    return os.path.splitext(name)[1].lstrip(".") in extensions
+
+
+def is_left_out(name, path, exclude=(), skip_hidden=False):
+    """True when a file or directory is hidden or excluded by name"""
+    if skip_hidden and name.startswith("."):
+        return True
+
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(path, p) for p in exclude)
+
+
+def is_candidate_file(path, extensions, exclude=(), min_size=0, skip_hidden=False):
+    """Check a single file against the scan rules (its directory is expected to have been checked already)"""
+    name = os.path.basename(str(path))
+    if is_left_out(name, str(path), exclude, skip_hidden):
+        return False
+
+    if not has_matching_extension(name, extensions) or is_temp_file(name):
+        return False
+
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        return False
+
+    return stat.S_ISREG(st.st_mode) and st.st_size >= min_size
+
+
+def walk_directory(directory, extensions, exclude=(), min_size=0, skip_hidden=False):
+    """
+    Walk a directory tree with os.scandir, yielding only the files that can match the rules.
+
+    Each directory is visited in sorted order, descending into sub directories as they are reached, so the files come
+    out in the same order as sorting the full path list. Names are filtered before anything is stat'ed and the size
+    check reuses the stat cached on the directory entry.
+    """
+    stack = [iter(_sorted_entries(directory))]
+
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+
+        if is_left_out(entry.name, entry.path, exclude, skip_hidden):
+            continue
+
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(iter(_sorted_entries(entry.path)))
+                continue
+
+            if not has_matching_extension(entry.name, extensions) or not entry.is_file():
+                continue
+
+            if is_temp_file(entry.name):
+                logger.debug("Leaving out temporary file: {0}".format(entry.path))
+                continue
+
+            if min_size > 0 and entry.stat().st_size < min_size:
+                continue
+        except OSError as e:
+            logger.warning("Unable to read file {0}: {1}".format(entry.path, e))
+            continue
+
+        yield pathlib.Path(entry.path)
+
+
+def _sorted_entries(directory):
+    try:
+        with os.scandir(str(directory)) as it:
+            return sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        logger.warning("Unable to scan directory {0}: {1}".format(directory, e))
+        return []
+
+
+def file_identity(file_path):
+    """The (device, inode, size, mtime) tuple that changes whenever the file is replaced or modified"""
+    st = os.stat(str(file_path))
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def is_temp_file(name):
+    """True for the temporary ffmpeg outputs named by FileProcessor.temp_file_name"""
+    return os.path.splitext(os.path.splitext(name)[0])[1] == TEMP_SUFFIX
+
+
+def sibling_temp_file(file_path):
+    """The temp file next to the file, where its replacement is staged so the final rename is atomic"""
+    return file_path.with_suffix("{0}{1}".format(TEMP_SUFFIX, file_path.suffix))
+
+
+def place_file(source, target):
+    """
+    Atomically replace target with source in the cheapest way that works, returning the way used: a rename on the
+    same filesystem, otherwise a copy (reflink, copy_file_range or buffered) to a temp file next to the target that
+    is then renamed over it
+    """
+    try:
+        os.rename(source, target)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    staging = str(sibling_temp_file(pathlib.Path(target)))
+    try:
+        with io.open(source, "rb", buffering=0) as src, io.open(staging, "wb", buffering=0) as dst:
+            method = _copy_file(src, dst)
+            os.fsync(dst.fileno())
+        os.rename(staging, target)
+    except BaseException:
+        if os.path.isfile(staging):
+            os.remove(staging)
+        raise
+
+    os.remove(source)
+    return method
+
+
+def _copy_file(src, dst):
+    # a reflink shares the blocks, it works across mounts of the same filesystem (btrfs subvolumes, bind mounts)
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except OSError:
+        pass
+
+    # copy_file_range copies in the kernel (or server side on NFS 4.2), when the filesystems allow it
+    size = os.fstat(src.fileno()).st_size
+    try:
+        copied = 0
+        while copied < size:
+            count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if count == 0:
+                break
+            copied += count
+        if copied == size:
+            return "copy_file_range"
+    except (AttributeError, OSError):
+        pass
+
+    src.seek(0)
+    dst.seek(0)
+    dst.truncate()
+    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    return "copy"
+
+
+def relink_file(target, link):
+    """
+    Atomically make link a hard link of target again, after target was replaced by a new file. Returns False when
+    link still is target (the file was edited in place), a rename over the same file would leave the staging link.
+    """
+    if os.path.samefile(target, link):
+        return False
+
+    staging = str(sibling_temp_file(pathlib.Path(link)))
+    os.link(target, staging)
+    try:
+        os.rename(staging, link)
+    except BaseException:
+        os.remove(staging)
+        raise
+    return True
+
+
+class Deduplicator(object):
+    """
+    Lets each file through once however many paths lead to it: the paths to an already seen (device, inode) are hard
+    links or reached through symlinks. With `content` set, the files with the same size are also compared (a hash of
+    their first and last `hash_bytes`, then byte by byte) to find copies of the same content at different paths.
+
+    Once a file is replaced by its re-encode, its other hard links are linked to the new file (the rename broke them).
+    The copies are only reported, each is processed on its own in a later run.
+    """
+
+    def __init__(self, content=False, hash_bytes=65536):
+        self.content = content
+        self.hash_bytes = hash_bytes
+        self.hardlinks = 0
+        self.symlinks = 0
+        self.copies = 0
+        self._lock = threading.Lock()
+        self._first = {}
+        self._links = collections.defaultdict(list)
+        self._copies = collections.defaultdict(list)
+        self._by_size = collections.defaultdict(list)
+        self._hashes = {}
+        self._replaced = set()
+
+    def unique(self, file_paths):
+        """The files, leaving out the ones already seen under another path"""
+        for file_path in file_paths:
+            try:
+                st = os.stat(str(file_path))
+            except OSError:
+                # left to the probe to report
+                yield file_path
+                continue
+
+            with self._lock:
+                first = self._first.setdefault((st.st_dev, st.st_ino), file_path)
+            # the same path again is a file that changed (when watching)
+            if first != file_path:
+                self._add_link(first, file_path)
+                continue
+
+            if self.content:
+                original = self._same_content(file_path, st.st_size)
+                if original is not None:
+                    logger.info("Same content as {0}, leaving out: {1}".format(original, file_path))
+                    with self._lock:
+                        self._copies[original].append(file_path)
+                        self.copies += 1
+                    continue
+
+            yield file_path
+
+    def add_links(self, file_path, links):
+        """Record hard links of the file found before, such as the ones stored in a plan"""
+        with self._lock:
+            self._links[file_path].extend(links)
+            self.hardlinks += len(links)
+
+    def links_of(self, file_path):
+        """The hard links found to the file"""
+        with self._lock:
+            return list(self._links.get(file_path, ()))
+
+    def replaced(self, file_path):
+        """The file was replaced by a new one: link its hard links to it and report its copies"""
+        with self._lock:
+            self._replaced.add(file_path)
+            links = list(self._links.get(file_path, ()))
+            copies = list(self._copies.get(file_path, ()))
+            try:
+                st = os.stat(str(file_path))
+                # the relinked paths show up again when watching, as links of the new file
+                self._first[(st.st_dev, st.st_ino)] = file_path
+            except OSError:
+                pass
+
+        for link in links:
+            self._relink(file_path, link)
+        for copy in copies:
+            logger.info("Left the copy of the re-encoded {0} as it is: {1}".format(file_path, copy))
+
+    def _add_link(self, first, file_path):
+        with self._lock:
+            if file_path in self._links[first]:
+                return
+
+        if os.path.realpath(str(first)) == os.path.realpath(str(file_path)):
+            # the same path through a symlink, the replacement is found through it as well
+            logger.debug("Same file as {0} (symlinked), leaving out: {1}".format(first, file_path))
+            with self._lock:
+                self.symlinks += 1
+            return
+
+        logger.debug("Hard link of {0}, leaving out: {1}".format(first, file_path))
+        with self._lock:
+            self._links[first].append(file_path)
+            self.hardlinks += 1
+            replaced = first in self._replaced
+        if replaced:
+            self._relink(first, file_path)
+
+    def _relink(self, file_path, link):
+        try:
+            if relink_file(str(file_path), str(link)):
+                logger.info("Linked the hard link to the re-encoded file: {0}".format(link))
+        except OSError as e:
+            logger.warning("Unable to link {0} to the re-encoded {1}: {2}".format(link, file_path, e))
+
+    def _same_content(self, file_path, size):
+        """The file seen before with the same content, None when there is none"""
+        candidates = self._by_size[size]
+        try:
+            if candidates:
+                # the file may have changed since it was hashed (when watching)
+                self._hashes.pop(file_path, None)
+                digest = self._partial_hash(file_path, size)
+                for candidate in candidates:
+                    if candidate != file_path and self._partial_hash(candidate, size) == digest and \
+                            filecmp.cmp(str(candidate), str(file_path), shallow=False):
+                        return candidate
+        except OSError as e:
+            logger.warning("Unable to compare the content of {0}: {1}".format(file_path, e))
+
+        if file_path not in candidates:
+            candidates.append(file_path)
+        return None
+
+    def _partial_hash(self, file_path, size):
+        digest = self._hashes.get(file_path)
+        if digest is None:
+            h = hashlib.sha1()
+            with io.open(str(file_path), "rb") as f:
+                h.update(f.read(self.hash_bytes))
+                if size > self.hash_bytes:
+                    f.seek(max(self.hash_bytes, size - self.hash_bytes))
+                    h.update(f.read(self.hash_bytes))
+            digest = self._hashes[file_path] = h.digest()
+        return digest
+
+
+def open_dedup():
+    """The deduplicator of the files of a run, configured by dedup_content and dedup_hash_bytes"""
+    return Deduplicator(cfg.get("dedup_content", False), cfg.get("dedup_hash_bytes", 65536))
+
+
+class ProbeCache(object):
+    """Persistent cache of the parsed ffprobe results, keyed on the file identity (device, inode, size, mtime)"""
+    COMMIT_EVERY = 200
+    # the version of the compact info, bumped whenever it keeps more of the ffprobe output
+    INFO_VERSION = 2
+
+    def __init__(self, path, max_entries=500000, refresh=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS probes (
+                              dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                              info TEXT NOT NULL, last_used INTEGER NOT NULL,
+                              PRIMARY KEY (dev, ino, size, mtime_ns))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def compact_file_info(file_info):
+        """Keep only the parts of the ffprobe output used to make decisions"""
+        streams = []
+        for s in file_info.get("streams", []):
+            stream = {k: s[k] for k in ("index", "codec_type", "codec_name", "bit_rate") if k in s}
+            if "language" in s.get("tags", {}):
+                stream["tags"] = {"language": s["tags"]["language"]}
+            if "disposition" in s:
+                stream["disposition"] = {k: s["disposition"][k] for k in ("default", "forced")
+                                         if k in s["disposition"]}
+            streams.append(stream)
+
+        file_format = {k: v for k, v in file_info.get("format", {}).items() if k in ("duration", "size", "bit_rate")}
+        return {"streams": streams, "format": file_format, "version": ProbeCache.INFO_VERSION}
+
+    def get(self, identity):
+        """Return the cached file info for the identity, or None when it must be probed"""
+        with self._lock:
+            row = None
+            if not self.refresh:
+                row = self._db.execute("SELECT info FROM probes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                                       identity).fetchone()
+
+            file_info = None if row is None else json.loads(row[0])
+            # entries cached by an older version may lack fields the decisions now use
+            if file_info is None or file_info.get("version") != self.INFO_VERSION:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute("UPDATE probes SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                             (time.time_ns(),) + tuple(identity))
+            self._written()
+
+        return file_info
+
+    def put(self, identity, file_info):
+        info = json.dumps(self.compact_file_info(file_info), separators=(",", ":"))
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)",
+                             tuple(identity) + (info, time.time_ns()))
+            self._written()
+
+    def _written(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.COMMIT_EVERY:
+            self._evict()
+            self._db.commit()
+            self._pending_writes = 0
+
+    def _evict(self):
+        """Drop the least recently used entries above the size limit"""
+        count = self._db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute("DELETE FROM probes WHERE rowid IN "
+                             "(SELECT rowid FROM probes ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._db.commit()
+            self._db.close()
+
+
+def open_probe_cache(refresh=False):
+    cache_file = cfg.get("probe_cache", None)
+    if cache_file is None:
+        return None
+
+    try:
+        return ProbeCache(cache_file, max_entries=cfg.get("probe_cache_max_entries", 500000), refresh=refresh)
+    except sqlite3.Error:
+        logger.exception("Unable to open the probe cache, files will always be probed: {0}".format(cache_file))
+        return None
+
+
+class CommandResult(object):
+    """Exit code of a finished command, with its captured output and the last lines of its stderr"""
+
+    def __init__(self, code, output, tail):
+        self.code = code
+        self.output = output
+        self.tail = tail
+
+    def tail_text(self):
+        return "\n".join(self.tail)
+
+
+def run_command(args, timeout=None, capture_output=False, on_line=None, on_output_line=None, tail_lines=50,
+                on_start=None):
+    """
+    Run a command over plain pipes (no terminal), streaming its output as it is produced.
+
+    stderr is read line by line: each line is passed to `on_line` and only the last `tail_lines` lines are kept for
+    error reports. stdout is either captured whole (`capture_output`, e.g. for the ffprobe json) or passed line by line
+    to `on_output_line`. The process is killed and subprocess.TimeoutExpired raised when it runs over the timeout.
+    `on_start` is called with the pid of the process as soon as it is started.
+    """
+    tail = collections.deque(maxlen=tail_lines)
+    output = []
+
+    def read_stderr(stream):
+        for line in stream:
+            line = line.rstrip("\r\n")
+            tail.append(line)
+            if on_line is not None:
+                on_line(line)
+
+    def read_stdout(stream):
+        if capture_output:
+            output.append(stream.read())
+            return
+
+        for line in stream:
+            if on_output_line is not None:
+                on_output_line(line.rstrip("\r\n"))
+
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True, encoding="utf-8", errors="replace")
+    if on_start is not None:
+        on_start(process.pid)
+    readers = [threading.Thread(target=read_stdout, args=(process.stdout,), daemon=True),
+               threading.Thread(target=read_stderr, args=(process.stderr,), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    try:
+        code = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        process.stdout.close()
+        process.stderr.close()
+
+    return CommandResult(code, "".join(output), list(tail))
+
+
+class Journal(object):
+    """
+    Persistent record of the decision and outcome for each file, so an interrupted run can be resumed.
+
+    Files that were skipped or re-encoded are not probed again while their identity is unchanged, and the temp file
+    of an encode that never finished is reclaimed on the next start.
+    """
+    COMMIT_EVERY = 200
+    STARTED = "started"
+    DONE = "done"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    INTERRUPTED = "interrupted"
+
+    def __init__(self, path, refresh=False):
+        self.path = path
+        self.refresh = refresh
+        self.resumed = 0
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                              path TEXT PRIMARY KEY,
+                              dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                              state TEXT, outcome TEXT, temp_file TEXT, updated REAL)""")
+        self._db.commit()
+
+    def is_complete(self, file_path, identity):
+        """True when the file was already skipped or re-encoded and has not changed since"""
+        if self.refresh:
+            return False
+
+        with self._lock:
+            row = self._db.execute("SELECT dev, ino, size, mtime_ns, outcome FROM files WHERE path=?",
+                                   (str(file_path),)).fetchone()
+
+        return row is not None and tuple(row[:4]) == tuple(identity) and row[4] in (self.DONE, self.SKIPPED)
+
+    def pending(self, file_paths):
+        """Yield only the files that still need to be checked"""
+        for f in file_paths:
+            try:
+                if self.is_complete(f, file_identity(f)):
+                    self.resumed += 1
+                    continue
+            except OSError:
+                pass
+            yield f
+
+    def record_decision(self, processor):
+        outcome = None if processor.needs_processing() else self.SKIPPED
+        self._record(processor.file_path, processor.state, outcome, commit=False)
+
+    def record_started(self, processor):
+        self._record(processor.file_path, processor.state, self.STARTED, temp_file=processor.temp_file_name)
+
+    def record_finished(self, processor, succeeded):
+        self._record(processor.file_path, processor.state, self.DONE if succeeded else self.FAILED)
+
+    def reclaim_interrupted(self):
+        """Delete the temp files left behind by encodes that were running when a previous run died"""
+        with self._lock:
+            rows = self._db.execute("SELECT path, temp_file FROM files WHERE outcome=?", (self.STARTED,)).fetchall()
+
+        for path, temp_file in rows:
+            # a copy from the scratch directory may also have been cut short next to the file
+            temp_files = {temp_file, str(sibling_temp_file(pathlib.Path(path)))}
+            if not all([self._remove_temp_file(temp) for temp in temp_files]):
+                continue
 
-    # sort the file list so it looks logical in the logs
-    return sorted(matching_files)
+            with self._lock:
+                self._db.execute("UPDATE files SET outcome=?, updated=? WHERE path=?",
+                                 (self.INTERRUPTED, time.time(), path))
+                self._db.commit()
+
+        return len(rows)
+
+    @staticmethod
+    def _remove_temp_file(temp_file):
+        if temp_file and os.path.isfile(temp_file):
+            logger.warning("Reclaiming interrupted temp file: {0}".format(temp_file))
+            try:
+                os.remove(temp_file)
+            except OSError:
+                logger.exception("Unable to remove the temp file: {0}".format(temp_file))
+                return False
+        return True
+
+    def _record(self, file_path, state, outcome, temp_file=None, commit=True):
+        try:
+            identity = file_identity(file_path)
+        except OSError:
+            identity = (None, None, None, None)
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (str(file_path),) + tuple(identity) +
+                             (state, outcome, None if temp_file is None else str(temp_file), time.time()))
+
+            # starts and finishes are committed straight away so a crash can always be recovered from
+            self._pending_writes += 1
+            if commit or self._pending_writes >= self.COMMIT_EVERY:
+                self._db.commit()
+                self._pending_writes = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def open_journal(refresh=False):
+    journal_file = cfg.get("journal", None)
+    if journal_file is None:
+        return None
+
+    try:
+        return Journal(journal_file, refresh=refresh)
+    except sqlite3.Error:
+        logger.exception("Unable to open the journal, runs will not be resumable: {0}".format(journal_file))
+        return None
+
+
+class LeaseManager(object):
+    """
+    Claims files for this process with lease files in a directory shared by every host working on the library, so
+    each file is probed and encoded by one host only.
+
+    A lease is created with an exclusive create (atomic on local filesystems and NFS 3+) and kept alive by touching
+    it every `heartbeat_secs`. A lease not touched for `ttl_secs` belongs to a dead host: it is renamed aside and
+    claimed again. Hosts racing for it may each move aside a different lease, so a lease found to be live once aside is
+    linked back only when no host created a new one in the meantime; otherwise the new one wins and the file is left
+    as busy. The hosts must mount the library at the same path.
+    """
+
+    def __init__(self, lease_dir, ttl_secs=300, heartbeat_secs=60, owner=None):
+        self.lease_dir = pathlib.Path(lease_dir)
+        self.ttl_secs = ttl_secs
+        self.heartbeat_secs = heartbeat_secs
+        self.owner = owner or "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), os.urandom(4).hex())
+        self.busy = 0
+        self.reclaimed = 0
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+
+    def lease_file(self, file_path):
+        return self.lease_dir / "{0}.lease".format(hashlib.sha1(str(file_path).encode("utf-8")).hexdigest())
+
+    def claim(self, file_path):
+        """True when this process now holds the lease of the file, False when another live host does"""
+        lease_file = self.lease_file(file_path)
+
+        # a second attempt is only made after reclaiming an expired lease
+        for _ in range(2):
+            try:
+                fd = os.open(str(lease_file), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self._reclaim_expired(lease_file):
+                    continue
+                self.busy += 1
+                return False
+
+            with os.fdopen(fd, "w") as f:
+                json.dump({"owner": self.owner, "path": str(file_path), "claimed": time.time()}, f)
+
+            with self._lock:
+                self._held[str(file_path)] = lease_file
+            self._start_heartbeat()
+            return True
+
+        self.busy += 1
+        return False
+
+    def claimed(self, file_paths):
+        """Yield only the files this process could claim"""
+        for f in file_paths:
+            if self.claim(f):
+                yield f
+
+    def holds(self, file_path):
+        with self._lock:
+            return str(file_path) in self._held
+
+    def release(self, file_path):
+        with self._lock:
+            lease_file = self._held.pop(str(file_path), None)
+
+        if lease_file is None:
+            return
+
+        # never remove a lease that was reclaimed by another host in the meantime (or one that can't be read now,
+        # it expires)
+        try:
+            if self._owner_of(lease_file) == self.owner:
+                os.remove(str(lease_file))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not release the lease of {0}: {1}".format(file_path, e))
+
+    def heartbeat(self):
+        """
+        Touch the held leases, dropping the ones another host took over. A lease that can't be read for another reason
+        (a stale NFS handle, an I/O error) is kept and touched again on the next heartbeat.
+        """
+        with self._lock:
+            held = list(self._held.items())
+
+        for file_path, lease_file in held:
+            try:
+                owner = self._owner_of(lease_file)
+            except OSError as e:
+                logger.warning("Could not check the lease of {0}, retrying: {1}".format(file_path, e))
+                continue
+
+            if owner != self.owner:
+                logger.warning("Lost the lease of: {0}".format(file_path))
+                with self._lock:
+                    self._held.pop(file_path, None)
+                continue
+
+            try:
+                os.utime(str(lease_file))
+            except OSError:
+                # gone or unreachable, the next heartbeat tells which
+                pass
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+        with self._lock:
+            held = list(self._held)
+        for file_path in held:
+            self.release(file_path)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._beat, daemon=True, name="lease-heartbeat")
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_secs):
+            self.heartbeat()
+
+    def _reclaim_expired(self, lease_file):
+        try:
+            if time.time() - os.stat(str(lease_file)).st_mtime < self.ttl_secs:
+                return False
+        except FileNotFoundError:
+            # released in the meantime, try to claim it again
+            return True
+
+        # move it aside first, then check it again: another host may have claimed the file since the check above
+        aside = "{0}.{1}.expired".format(lease_file, self.owner.replace(":", "-"))
+        try:
+            os.rename(str(lease_file), aside)
+        except FileNotFoundError:
+            return True
+
+        try:
+            # the holder may have come back to life between the check and the rename, put its lease back unless a
+            # third host created a new one in the meantime (the link fails rather than overwriting it)
+            if time.time() - os.stat(aside).st_mtime < self.ttl_secs:
+                try:
+                    os.link(aside, str(lease_file))
+                except FileExistsError:
+                    pass
+                return False
+        finally:
+            if os.path.exists(aside):
+                os.remove(aside)
+
+        logger.warning("Reclaimed an expired lease: {0}".format(lease_file))
+        self.reclaimed += 1
+        return True
+
+    @staticmethod
+    def _owner_of(lease_file):
+        """The owner written in the lease, None when there is no lease (or one still being written)"""
+        try:
+            with io.open(str(lease_file)) as f:
+                return json.load(f).get("owner")
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+def open_leases():
+    lease_dir = cfg.get("lease_dir", None)
+    if lease_dir is None:
+        return None
+
+    return LeaseManager(lease_dir, ttl_secs=cfg.get("lease_ttl_secs", 300),
+                        heartbeat_secs=cfg.get("lease_heartbeat_secs", 60))
+
+
+def _parse_float(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class EncodeProgress(object):
+    """Follows the key=value blocks written by `ffmpeg -progress` for one file"""
+
+    def __init__(self, file_path, duration, status=None):
+        self.file_path = file_path
+        self.duration = duration
+        self.status = status
+        self.out_time = 0.0
+        self.speed = None
+        self.fps = None
+        self.total_size = 0
+        self._last_log = time.monotonic()
+
+        if self.status is not None:
+            self.status.started(self)
+
+    def feed(self, line):
+        key, _, value = line.partition("=")
+        value = value.strip()
+
+        if key == "out_time_us" or key == "out_time_ms":
+            # both are in microseconds
+            self.out_time = max(0.0, _parse_float(value, 0.0) / 1000000)
+        elif key == "speed":
+            self.speed = _parse_float(value.rstrip("x"))
+        elif key == "fps":
+            self.fps = _parse_float(value)
+        elif key == "total_size":
+            self.total_size = int(_parse_float(value, 0))
+        elif key == "progress":
+            # the end of each block
+            self._report()
+
+    @property
+    def percent(self):
+        if not self.duration:
+            return None
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    @property
+    def eta(self):
+        """Seconds left to encode the file"""
+        if not self.duration or not self.speed:
+            return None
+        return max(0.0, self.duration - self.out_time) / self.speed
+
+    def as_dict(self):
+        return {"file": str(self.file_path),
+                "percent": self.percent,
+                "eta_secs": self.eta,
+                "out_time_secs": self.out_time,
+                "duration_secs": self.duration,
+                "speed": self.speed,
+                "fps": self.fps,
+                "total_size": self.total_size}
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_log >= cfg.get("progress_interval_secs", 30):
+            self._last_log = now
+            logger.info("Progress: {0} {1} (eta {2}, speed {3}x, {4} fps)".format(
+                self.file_path,
+                "?" if self.percent is None else "{0:.1f}%".format(self.percent),
+                "?" if self.eta is None else time.strftime("%H:%M:%S", time.gmtime(self.eta)),
+                self.speed, self.fps))
+
+        if self.status is not None:
+            self.status.updated(self)
+
+    def finish(self, succeeded=True):
+        if self.status is not None:
+            self.status.finished(self, succeeded)
+
+
+class RunStatus(object):
+    """
+    Aggregates the progress of the running encodes into throughput figures for the whole run, and writes them to a
+    json status file that can be scraped while the run is going.
+    """
+
+    def __init__(self, status_file=None, interval_secs=None):
+        self.status_file = status_file
+        self.interval_secs = cfg.get("progress_interval_secs", 30) if interval_secs is None else interval_secs
+        self.start = time.monotonic()
+        self.files_done = 0
+        self.bytes_written = 0
+        self.media_secs = 0.0
+        self._active = {}
+        self._lock = threading.Lock()
+        # the workers all write through the same temp file
+        self._write_lock = threading.Lock()
+        self._last_write = 0.0
+
+    def started(self, progress):
+        with self._lock:
+            self._active[id(progress)] = progress
+        self._write()
+
+    def updated(self, progress):
+        self._write()
+
+    def finished(self, progress, succeeded=True):
+        with self._lock:
+            self._active.pop(id(progress), None)
+            if succeeded:
+                self.files_done += 1
+            self.bytes_written += progress.total_size
+            self.media_secs += progress.out_time
+        self._write(force=True)
+
+    def snapshot(self):
+        with self._lock:
+            active = [p.as_dict() for p in self._active.values()]
+            elapsed = max(time.monotonic() - self.start, 1e-6)
+            bytes_written = self.bytes_written + sum(a["total_size"] for a in active)
+            media_secs = self.media_secs + sum(a["out_time_secs"] for a in active)
+
+            return {"updated": time.time(),
+                    "elapsed_secs": elapsed,
+                    "files_done": self.files_done,
+                    "bytes_written": bytes_written,
+                    "mb_per_sec": bytes_written / elapsed / 1000000,
+                    "realtime_factor": media_secs / elapsed,
+                    "active": active}
+
+    def summary(self):
+        snapshot = self.snapshot()
+        return "{0:.1f} MB/s, {1:.1f}x realtime".format(snapshot["mb_per_sec"], snapshot["realtime_factor"])
+
+    def _write(self, force=False):
+        if self.status_file is None:
+            return
+
+        with self._write_lock:
+            now = time.monotonic()
+            if not force and now - self._last_write < self.interval_secs:
+                return
+            self._last_write = now
+
+            # write then rename so a scraper never reads a partial file
+            temp_file = "{0}.tmp".format(self.status_file)
+            try:
+                with io.open(temp_file, "w") as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(temp_file, str(self.status_file))
+            except OSError:
+                logger.exception("Unable to write the status file: {0}".format(self.status_file))
+
+
+class Metrics(object):
+    """
+    Times the phases of the run (scan, probe, decide, encode, place) into histograms and counts the files by state.
+    Each timing is appended to a json lines file as it happens, and the totals are written to a Prometheus textfile
+    collector file when the run ends. Disabled (timing nothing) unless one of the files is set.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800, 7200)
+
+    def __init__(self):
+        self.enabled = False
+        self.jsonl_file = None
+        self.prometheus_file = None
+        self._out = None
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._files = collections.Counter()
+
+    def open(self, jsonl_file=None, prometheus_file=None):
+        self.jsonl_file = jsonl_file
+        self.prometheus_file = prometheus_file
+        self._out = None if jsonl_file is None else io.open(str(jsonl_file), "a")
+        self._phases = {}
+        self._files = collections.Counter()
+        self.enabled = jsonl_file is not None or prometheus_file is not None
+
+    def timed(self, phase, file_path=None):
+        """A context timing the phase, for the file when given"""
+        if not self.enabled:
+            return _NOT_TIMED
+        return _PhaseTimer(self, phase, file_path)
+
+    def observe(self, phase, secs, file_path=None):
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+            # the first bucket the time fits in (le), times past the last bucket only count toward +Inf
+            bucket = bisect.bisect_left(self.BUCKETS, secs)
+            if bucket < len(self.BUCKETS):
+                histogram[0][bucket] += 1
+            histogram[1] += secs
+            histogram[2] += 1
+
+            if self._out is not None:
+                self._out.write(json.dumps({"time": time.time(), "phase": phase,
+                                            "file": None if file_path is None else str(file_path),
+                                            "secs": secs}) + "\n")
+
+    def file_state(self, state):
+        if self.enabled:
+            with self._lock:
+                self._files[FileState.short_name(state)] += 1
+
+    def summary(self):
+        """The totals of the run: the count, total and average seconds of each phase and the files by state"""
+        with self._lock:
+            phases = {phase: {"count": count, "secs": total, "avg_secs": total / count if count else 0.0}
+                      for phase, (_, total, count) in self._phases.items()}
+            return {"phases": phases, "files": dict(self._files)}
+
+    def prometheus_text(self):
+        lines = ["# HELP streamix_phase_seconds Time spent in each phase of the run",
+                 "# TYPE streamix_phase_seconds histogram"]
+        with self._lock:
+            for phase, (buckets, total, count) in sorted(self._phases.items()):
+                cumulative = 0
+                for le, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append('streamix_phase_seconds_bucket{{phase="{0}",le="{1}"}} {2}'.format(
+                        phase, le, cumulative))
+                lines.append('streamix_phase_seconds_bucket{{phase="{0}",le="+Inf"}} {1}'.format(phase, count))
+                lines.append('streamix_phase_seconds_sum{{phase="{0}"}} {1}'.format(phase, total))
+                lines.append('streamix_phase_seconds_count{{phase="{0}"}} {1}'.format(phase, count))
+
+            lines += ["# HELP streamix_files_total Files checked by state",
+                      "# TYPE streamix_files_total counter"]
+            for state, count in sorted(self._files.items()):
+                lines.append('streamix_files_total{{state="{0}"}} {1}'.format(state, count))
+
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if not self.enabled:
+            return
+
+        if self._out is not None:
+            self._out.write(json.dumps(dict(self.summary(), time=time.time(), phase="run")) + "\n")
+            self._out.close()
+            self._out = None
+
+        if self.prometheus_file is not None:
+            # node_exporter must never read a partial file
+            temp_file = "{0}.tmp".format(self.prometheus_file)
+            try:
+                with io.open(temp_file, "w") as f:
+                    f.write(self.prometheus_text())
+                os.replace(temp_file, str(self.prometheus_file))
+            except OSError:
+                logger.exception("Unable to write the metrics file: {0}".format(self.prometheus_file))
+
+        self.enabled = False
+
+
+class _PhaseTimer(object):
+    __slots__ = ("metrics", "phase", "file_path", "start")
+
+    def __init__(self, metrics, phase, file_path):
+        self.metrics = metrics
+        self.phase = phase
+        self.file_path = file_path
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.phase, time.perf_counter() - self.start, self.file_path)
+        return False
+
+
+_NOT_TIMED = contextlib.nullcontext()
+metrics = Metrics()
 
 
 class FileState:
@@ -58,6 +1289,11 @@ class FileState:
     Convert = "File will be converted"
     Unknown = "File does not match any given rules"
 
+    @staticmethod
+    def short_name(state):
+        return {FileState.Ignore: "ignore", FileState.Skip: "skip", FileState.Remap: "remap",
+                FileState.Convert: "convert", FileState.Unknown: "unknown"}.get(state, "unknown")
+
 
 class FileProcessor(object):
     """Determines if a file should be processed and builds the ffmpeg command to process the file"""
@@ -67,33 +1303,68 @@ class FileProcessor(object):
     # UNKNOWN = "unknown"
     # IGNORED_EXTENSION = "ignored extension"
 
-    def __init__(self, file_path: pathlib.Path):
-        self.dry_run = cfg.get("dry-run", False)
-        self.extensions = cfg.get('extensions', [])
-        self.safe_codecs = cfg.get('safe_codecs', [])
-        self.codec_priority = cfg.get('audio_codec_priority', [])
-        self.min_bit_rate = cfg.get("audio_min_bitrate", 320000)
+    def __init__(self, file_path: pathlib.Path, probe_cache=None, file_info=None, config=None):
+        self._init_settings(file_path, config, probe_cache)
+
+        # load the file info (unless it was already probed) and re-initialize the state
+        if file_info is None:
+            with metrics.timed("probe", file_path):
+                file_info = self._read_file_info()
+        self.file_info = file_info
+        self._file_info_loaded()
+
+    def _init_settings(self, file_path, config=None, probe_cache=None):
+        """Set the settings of the config and initialize the state to empty values, for probed and planned files"""
+        self.config = config or current_config()
+        self.dry_run = self.config.dry_run
+        self.extensions = self.config.extensions
+        self.safe_codecs = self.config.safe_codecs
+        self.codec_priority = self.config.codec_priority
+        self.codec_ranks = self.config.codec_ranks
+        self.min_bit_rate = self.config.min_bit_rate
         self.file_path = file_path
+        self.probe_cache = probe_cache
 
-        # initialize the state to empty values
-        self.raw_streams = []
-        self.file_streams = FileStreams([], self.safe_codecs, self.codec_priority)
+        self.duration = None
+        self.size = None
+        self.file_info = None
+        self.file_streams = FileStreams([], self.safe_codecs, self.codec_priority, self.codec_ranks)
         self.state = FileState.Unknown
 
-        # load the file info and re-initialize the state
-        self.file_info = self._read_file_info()
-        self._file_info_loaded()
-
     def _file_info_loaded(self):
-        self.raw_streams = self.file_info.get("streams", [])
-        self.file_streams = FileStreams(self.raw_streams, self.safe_codecs, self.codec_priority)
-        self.state = self._get_file_state()
+        # keep only the compact stream records, the raw ffprobe json is dropped once they are extracted
+        file_format = self.file_info.get("format", {})
+        self.duration = _parse_float(file_format.get("duration"))
+        self.size = _parse_float(file_format.get("size"))
+
+        # without a size, the total bitrate over the duration gives the amount of data
+        bit_rate = _parse_float(file_format.get("bit_rate"))
+        if self.size is None and bit_rate is not None and self.duration is not None:
+            self.size = bit_rate * self.duration / 8
+        self.file_streams = FileStreams(self.file_info.get("streams", []), self.safe_codecs, self.codec_priority, self.codec_ranks)
+        self.file_info = None
+
+        with metrics.timed("decide", self.file_path):
+            self.state = self._get_file_state()
+        metrics.file_state(self.state)
 
     def needs_processing(self):
         return self.state == FileState.Remap or self.state == FileState.Convert
 
-    def print_file_header(self):
-        log_level = logging.INFO if self.needs_processing() else logging.DEBUG
+    def print_file_header(self, compact=None):
+        """
+        Log the decision for the file: a banner (or a single line when compact) for a file to process, a single debug
+        line for the others, which are only counted by state in the summary
+        """
+        if not self.needs_processing():
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("{0}: {1}".format(self.state, self.file_path))
+            return
+
+        if cfg.get("log_compact", False) if compact is None else compact:
+            logger.info("{0}: {1}".format(FileState.short_name(self.state), self.file_path))
+            return
+
         header = """
 
 
@@ -105,31 +1376,42 @@ class FileProcessor(object):
 *
 ********************************************************
 """
-        logger.log(log_level, header.format(filename=self.file_path, state=self.state))
+        logger.info(header.format(filename=self.file_path, state=self.state))
 
     def _get_command(self):
-        logger.info(self.state)
+        """The ffmpeg command as a readable string for the logs"""
+        params = self._get_params()
+        return None if params is None else self._build_ffmpeg_command(*params)
+
+    def _get_command_args(self):
+        """The ffmpeg command as the argument vector to execute"""
+        params = self._get_params()
+        return None if params is None else self._build_ffmpeg_args(*params)
 
+    def _get_params(self):
         if self.state == FileState.Remap:
-            return self._remap_command()
+            return self._remap_params()
 
         if self.state == FileState.Convert:
-            return self._convert_command()
+            return self._convert_params()
 
         return None
 
     def _remap_command(self):
+        return self._build_ffmpeg_command(*self._remap_params())
+
+    def _remap_params(self):
         new_stream_order = self._remap_stream_order()
 
         in_params = []
         for s in new_stream_order:
-            in_params.append("-map 0:{0}".format(s["index"]))
+            in_params.append("-map 0:{0}".format(s.index))
 
         out_params = []
         for index, s in enumerate(new_stream_order):
-            out_params.append("-c:{0} copy".format(s["index"]))
+            out_params.append("-c:{0} copy".format(s.index))
 
-        return self._build_ffmpeg_command(in_params, out_params)
+        return in_params, out_params
 
     def _build_ffmpeg_command(self, ins, outs):
         return ("ffmpeg -i \"{input}\" -metadata title=\"{filename}\" {ins} {outs} {extra} \"{output}\""
@@ -137,9 +1419,19 @@ class FileProcessor(object):
                         filename=self.file_path.name,
                         ins=" ".join(ins),
                         outs=" ".join(outs),
-                        extra=cfg.get("extra_encode_params", ""),
+                        extra=" ".join(self.config.extra_encode_params),
                         output=self.temp_file_name))
 
+    def _build_ffmpeg_args(self, ins, outs):
+        # the stream params never hold file names so they can be split on whitespace
+        # ffmpeg writes its progress as key=value blocks on stdout
+        return (["ffmpeg", "-progress", "pipe:1", "-nostats",
+                 "-i", str(self.file_path), "-metadata", "title={0}".format(self.file_path.name)] +
+                " ".join(ins).split() +
+                " ".join(outs).split() +
+                list(self.config.extra_encode_params) +
+                [str(self.temp_file_name)])
+
     def _remap_stream_order(self):
         new_first = self.file_streams.first_safe_eng()
         current_first = self.file_streams.first_audio()
@@ -148,51 +1440,53 @@ class FileProcessor(object):
 
         for s in self.file_streams.streams:
             # when we reach the new first audio, skip it
-            if s.raw == new_first.raw:
+            if s is new_first:
                 continue
 
             # when we reach the current first audio, add the new first audio, just before
-            if s.raw == current_first.raw:
-                new_stream_order.append(new_first.raw)
+            if s is current_first:
+                new_stream_order.append(new_first)
 
             # add the stream if it is not subs or if is english (or unknown lang)
             if not s.is_sub() or not s.non_eng():
-                new_stream_order.append(s.raw)
+                new_stream_order.append(s)
 
         return new_stream_order
 
     def _convert_command(self):
+        return self._build_ffmpeg_command(*self._convert_params())
+
+    def _convert_params(self):
         new_order, conversion_index = self._convert_stream_order()
 
         in_params = []
         for s in new_order:
-            in_params.append("-map 0:{0}".format(s["index"]))
+            in_params.append("-map 0:{0}".format(s.index))
 
         out_params = []
         for index, s in enumerate(new_order):
             if index != conversion_index:
                 out_params.append("-c:{0} copy".format(index))
             else:
-                bitrate = max([self.min_bit_rate, Stream(s, []).get_bitrate()])
+                bitrate = max([self.min_bit_rate, s.get_bitrate()])
                 out_params.append("-c:{index} aac -b:{index} {bitrate}".format(index=index, bitrate=bitrate))
 
-        return self._build_ffmpeg_command(in_params, out_params)
+        return in_params, out_params
 
     def _convert_stream_order(self):
         selected_stream = self._select_stream()
         fist_audio_stream = self.file_streams.audio[0]
         new_order = []
         conversion_index = 0
-        for index, s in enumerate(self.raw_streams):
-            if s == fist_audio_stream.raw:
+        for index, s in enumerate(self.file_streams.streams):
+            if s is fist_audio_stream:
                 # note the index for when we build the ffmpeg params
                 conversion_index = index
                 # insert the selected stream first
-                new_order.append(selected_stream.raw)
+                new_order.append(selected_stream)
 
             # only add streams that are not subs or are english (or unknown lang) subs
-            stream = Stream.from_raw_stream(s)
-            if not stream.is_sub() or not stream.non_eng():
+            if not s.is_sub() or not s.non_eng():
                 new_order.append(s)
         return new_order, conversion_index
 
@@ -203,30 +1497,90 @@ class FileProcessor(object):
                 return highest_priority_streams[0]
             highest_bitrate = self.file_streams.highest_bitrate(highest_priority_streams)
 
-            if highest_bitrate != self.file_streams.EMPTY_STREAM:
+            if highest_bitrate is not self.file_streams.EMPTY_STREAM:
                 return highest_bitrate
 
             return highest_priority_streams[0]
 
         highest_bitrate = self.file_streams.select_eng_by_bitrate()
-        if highest_bitrate != self.file_streams.EMPTY_STREAM:
+        if highest_bitrate is not self.file_streams.EMPTY_STREAM:
             return highest_bitrate
 
         return self.file_streams.english_audio[0]
 
     def _read_file_info(self):
+        if self.probe_cache is None:
+            return self._probe_file()
+
         try:
-            ffprobe_cmd = "ffprobe -v quiet -print_format json -show_format -show_streams \"{0}\"".format(
-                self.file_path)
+            identity = file_identity(self.file_path)
+        except OSError:
+            logger.exception("Error reading file identity")
+            return self._probe_file()
+
+        file_info = self.probe_cache.get(identity)
+        if file_info is None:
+            file_info = self._probe_file()
+            if "streams" in file_info:
+                self.probe_cache.put(identity, file_info)
+
+        return file_info
+
+    def _probe_file(self):
+        """
+        Read the tracks from the Matroska/MP4 headers when possible, otherwise probe with the fast ffprobe tier (only
+        the fields used to make decisions, reading as little of the file as possible). A full probe is only made when
+        a conversion needs bitrates the cheaper tiers did not report.
+        """
+        if self.config.native_probe:
+            file_info = mediaheaders.read_file_info(str(self.file_path))
+            if file_info is not None and not self._needs_deep_probe(file_info):
+                return file_info
+
+        if self.config.fast_probe:
+            file_info = self._run_ffprobe(self._fast_probe_args())
+            if "streams" in file_info and not self._needs_deep_probe(file_info):
+                return file_info
+
+            logger.debug("Escalating to a deep probe: {0}".format(self.file_path))
+
+        return self._run_ffprobe(["-show_format", "-show_streams"])
+
+    def _fast_probe_args(self):
+        return ["-probesize", str(self.config.fast_probe_size),
+                "-analyzeduration", str(self.config.fast_probe_analyze_usecs),
+                "-show_entries", "format=duration,size:stream=index,codec_type,codec_name,bit_rate:stream_tags=language:"
+                "stream_disposition=default,forced"]
 
-            ffprobe_json, code = pexpect.runu(ffprobe_cmd, timeout=30, withexitstatus=True)
-            return json.loads(ffprobe_json)
+    def _needs_deep_probe(self, file_info):
+        """True when the file will be converted and a stream the conversion picks from has no bitrate"""
+        raw_streams = file_info.get("streams", [])
+        file_streams = FileStreams(raw_streams, self.safe_codecs, self.codec_priority, self.codec_ranks)
+
+        # only conversions use bitrates (to pick the stream and to set the aac bitrate)
+        if not file_streams.has_eng() or file_streams.has_safe_eng():
+            return False
+
+        candidates = file_streams.select_eng_by_priority() or file_streams.english_audio
+        indexes = {s.index for s in candidates}
+        return any("bit_rate" not in r for r in raw_streams if r.get("index") in indexes)
+
+    def _run_ffprobe(self, show_args):
+        try:
+            ffprobe_cmd = ["ffprobe", "-v", "quiet", "-print_format", "json"] + show_args + [str(self.file_path)]
+
+            result = run_command(ffprobe_cmd, timeout=self.config.probe_timeout_secs, capture_output=True)
+            if result.code != 0:
+                logger.error("ffprobe returned an error ({0}): {1}".format(result.code, result.tail_text()))
+                return {}
+
+            return json.loads(result.output)
         except Exception:
             logger.exception("Error reading file info")
             return {}
 
     def _get_file_state(self):
-        if self.file_path.suffix.lstrip(".") not in self.extensions:
+        if not has_matching_extension(self.file_path.name, self.extensions):
             return FileState.Ignore
 
         first = self.file_streams.first_audio()
@@ -241,45 +1595,137 @@ class FileProcessor(object):
             return FileState.Skip
 
         if self.file_streams.has_safe_eng():
+            # the flags remap only marks the stream as the default, which is then as good as moving it first
+            if self.config.remap_mode == "flags" and \
+                    self.file_streams.is_default_audio(self.file_streams.first_safe_eng()):
+                return FileState.Skip
             return FileState.Remap
 
         if self.file_streams.has_eng():
             return FileState.Convert
 
+    def estimate_cost(self):
+        """Rough number of seconds the file will take to process (0 when it needs nothing)"""
+        if not self.needs_processing():
+            return 0.0
+
+        size = self.size
+        if size is None:
+            try:
+                size = os.stat(str(self.file_path)).st_size
+            except OSError:
+                size = 0
+
+        # every job copies the whole file, a conversion also encodes the audio for the full duration
+        cost = size / (self.config.cost_copy_mb_per_sec * 1000000)
+        if self.state == FileState.Convert and self.duration:
+            cost += self.duration / self.config.cost_convert_speed
+        return cost
+
+    def modified_ns(self):
+        try:
+            return file_identity(self.file_path)[3]
+        except OSError:
+            return 0
+
     @property
     def temp_file_name(self):
-        return self.file_path.with_suffix(".tmp{0}".format(self.file_path.suffix))
+        scratch_dir = self.config.scratch_dir
+        if not scratch_dir:
+            return sibling_temp_file(self.file_path)
+
+        # files with the same name in different directories must not share a scratch file
+        tag = "{0:08x}".format(zlib.crc32(str(self.file_path).encode("utf-8")))
+        return pathlib.Path(scratch_dir) / "{0}.{1}{2}{3}".format(self.file_path.stem, tag, TEMP_SUFFIX,
+                                                                   self.file_path.suffix)
 
-    def run(self):
-        timeout_sec = cfg.get("encode_timeout_mins", None)
-        if timeout_sec is not None:
-            timeout_sec *= 60
+    def run(self, status=None, governor=None):
+        """
+        Run ffmpeg for the file, returns True when the file was re-encoded (or would have been in a dry-run).
+        The ffmpeg process gets its share of the machine from the governor, when given.
+        """
+        timeout_sec = self.config.encode_timeout_secs
+
+        logger.info(self.state)
 
-        cmd = self._get_command()
+        if self.state == FileState.Remap and self.config.remap_mode == "flags":
+            with metrics.timed("flags", self.file_path):
+                if self._remap_in_place():
+                    return True
 
-        logger.info("Executing: {0}".format(cmd))
+        args = self._get_command_args()
+
+        logger.info("Executing: {0}".format(self._get_command()))
 
         # stop now if dry run set
         if self.dry_run:
             logger.warning("Execution skipping (dry-run)!")
-            return
+            return True
 
+        progress = EncodeProgress(self.file_path, self.duration, status)
         try:
-            output, code = pexpect.runu(cmd, timeout=timeout_sec, withexitstatus=True)
+            self.temp_file_name.parent.mkdir(parents=True, exist_ok=True)
+            shared = governor.share(self.state) if governor is not None else contextlib.nullcontext(UNGOVERNED)
+            with shared as share, metrics.timed("encode", self.file_path):
+                logger.debug("Encoding with {0}".format(share))
+                result = run_command(share.command_args(args), timeout=timeout_sec, on_line=logger.debug,
+                                     on_output_line=progress.feed,
+                                     on_start=None if governor is None else functools.partial(governor.apply, share))
         except Exception as exc:
+            progress.finish(succeeded=False)
             logger.exception("Failed to encode file: {0}".format(self.file_path))
             self._cleanup_failed_run()
             raise exc
         else:
-            if code != 0:
-                logger.error("ffmpeg returned an error: {0}".format(output))
+            progress.finish(succeeded=result.code == 0)
+
+            if result.code != 0:
+                logger.error("ffmpeg returned an error ({0}): {1}".format(result.code, result.tail_text()))
                 self._cleanup_failed_run()
-                return
-            else:
-                logger.debug(output)
+                return False
 
-            os.rename(str(self.temp_file_name), str(self.file_path))
+            try:
+                with metrics.timed("place", self.file_path):
+                    method = place_file(str(self.temp_file_name), str(self.file_path))
+            except OSError:
+                logger.exception("Unable to move the re-encoded file into place: {0}".format(self.file_path))
+                self._cleanup_failed_run()
+                return False
+
+            logger.debug("Placed the re-encoded file with: {0}".format(method))
             logger.info("Successfully re-encoded: {0}".format(self.file_path))
+            return True
+
+    def _default_stream_index(self):
+        """The index of the audio stream a remap moves first"""
+        return self.file_streams.first_safe_eng().index
+
+    def _remap_in_place(self):
+        """
+        Mark the english safe codec stream as the default audio by editing the header flags in place, instead of
+        rewriting the whole file. Returns False when the header can't express it and the file needs a real remap.
+        """
+        index = self._default_stream_index()
+        if index is None:
+            return False
+
+        if self.dry_run:
+            logger.info("Marking stream {0} as the default audio in place".format(index))
+            logger.warning("Execution skipping (dry-run)!")
+            return True
+
+        try:
+            edited = mediaheaders.set_default_track(str(self.file_path), index)
+        except OSError:
+            logger.exception("Unable to edit the track flags of: {0}".format(self.file_path))
+            return False
+
+        if not edited:
+            logger.info("Track flags can't be edited in place, remapping with ffmpeg")
+            return False
+
+        logger.info("Marked stream {0} as the default audio in place: {1}".format(index, self.file_path))
+        return True
 
     def _cleanup_failed_run(self):
         # delete any temp file
@@ -289,74 +1735,109 @@ class FileProcessor(object):
 
 
 class Stream:
+    """The fields of an ffprobe stream used to make decisions, extracted and normalized once"""
+    __slots__ = ("index", "codec_type", "codec", "language", "bitrate", "safe", "default", "forced")
+
     def __init__(self, raw_stream, safe_codecs):
-        self.raw = raw_stream
-        self.safe_codecs = safe_codecs
+        get = raw_stream.get
+        self.index = get("index")
+        self.codec_type = get("codec_type", "").lower()
+        self.codec = get("codec_name", "").lower()
+        self.safe = self.codec in safe_codecs
+
+        disposition = get("disposition") or {}
+        self.default = bool(disposition.get("default"))
+        self.forced = bool(disposition.get("forced"))
+
+        # None when the language is unknown (no tag at all)
+        tags = get("tags")
+        language = tags.get("language") if tags else None
+        self.language = None if language is None else language.lower()
+
+        bitrate = get("bit_rate", 0)
+        try:
+            self.bitrate = bitrate if type(bitrate) is int else int(bitrate)
+        except ValueError:
+            # only an error if the bitrate is ever needed
+            self.bitrate = None
 
     def is_safe(self):
-        return self.get_codec() in self.safe_codecs
+        return self.safe
 
     def is_eng(self):
-        return self.raw.get("tags", {}).get("language", "").lower() == "eng"
+        return self.language == "eng"
 
     def non_eng(self):
         """return true if the stream is a language other than eng, defaults to false if unkown language"""
-        return self.raw.get("tags", {"language": "eng"}).get("language", "eng").lower() != "eng"
+        return self.language is not None and self.language != "eng"
 
     def is_audio(self):
-        return self.raw.get("codec_type", "").lower() == "audio"
+        return self.codec_type == "audio"
 
     def get_codec(self):
-        return self.raw.get("codec_name", "").lower()
+        return self.codec
 
     def get_bitrate(self):
-        bitrate = self.raw.get("bit_rate", 0)
+        if self.bitrate is None:
+            raise Exception("Unable to parse the bitrate of stream {0}".format(self.index))
 
-        try:
-            return int(bitrate)
-        except ValueError:
-            raise Exception("Unable to parse the bitrate '{0}'".format(bitrate))
+        return self.bitrate
 
     def is_sub(self):
-        return self.raw.get("codec_type", "").lower() == "subtitle"
+        return self.codec_type == "subtitle"
 
     @classmethod
     def from_raw_stream(cls, raw_stream):
         return cls(raw_stream, [])
 
 
-
 class FileStreams:
     EMPTY_STREAM = Stream({}, [])
 
-    def __init__(self, raw_streams, safe_codecs, codec_priority):
+    def __init__(self, raw_streams, safe_codecs, codec_priority, codec_ranks=None):
+        """
+        :param codec_priority: the codecs in order of priority
+        :param codec_ranks: the ranks of the codecs as {codec: rank}, when already compiled (see Config)
+        """
         self.safe_codecs = safe_codecs
         self.codec_priority = codec_priority
+        if codec_ranks is None:
+            codec_ranks = {c: i for i, c in reversed(list(enumerate(codec_priority)))}
+        self.codec_ranks = codec_ranks
         self.streams = [Stream(s, self.safe_codecs) for s in raw_streams]
         self.audio = [s for s in self.streams if s.is_audio()]
         self.english_audio = [s for s in self.audio if s.is_eng()]
+        self._first_safe_eng = next((s for s in self.english_audio if s.safe), None)
 
     def first_audio(self):
-        return next((s for s in self.audio), None)
+        return self.audio[0] if self.audio else None
 
     def has_eng(self):
         return len(self.english_audio) > 0
 
     def first_safe_eng(self):
-        return next((s for s in self.english_audio if s.is_safe()), None)
+        return self._first_safe_eng
+
+    def is_default_audio(self, stream):
+        """True when players pick the stream by default: the only audio stream flagged default (or forced)"""
+        return stream.default and not any(s.default or s.forced for s in self.audio if s is not stream)
 
     def has_safe_eng(self):
-        return self.first_safe_eng() is not None
+        return self._first_safe_eng is not None
 
     def select_eng_by_priority(self):
+        """The english audio streams with the best ranked codec, in stream order"""
         selected_streams = []
+        best_rank = None
 
-        for c in self.codec_priority:
-            for s in self.english_audio:
-                if s.get_codec() == c:
-                    selected_streams.append(s)
-            if len(selected_streams) > 0:
-                break
+        for s in self.english_audio:
+            rank = self.codec_ranks.get(s.codec)
+            if rank is None or (best_rank is not None and rank > best_rank):
+                continue
+            if rank != best_rank:
+                best_rank = rank
+                selected_streams = []
+            selected_streams.append(s)
 
         return selected_streams
 
@@ -368,68 +1849,1204 @@ class FileStreams:
         """
         :param list[Stream] streams: list of streams
         """
-        selected_stream = streams[0] if len(streams) > 0 else FileStreams.EMPTY_STREAM
+        if len(streams) == 0:
+            return FileStreams.EMPTY_STREAM
+
+        # the first stream wins ties, like a strictly greater comparison in order
+        return max(streams, key=Stream.get_bitrate)
+
+
+class StreamColumns(object):
+    """
+    The streams of many files laid out in flat columns (one entry per stream) with per-file offsets, so the decision
+    rules can be applied to a whole library in a few passes instead of one FileProcessor at a time.
+    """
+    OTHER, AUDIO, SUBTITLE = 0, 1, 2
+    UNKNOWN_LANGUAGE, ENG, NON_ENG = 0, 1, 2
+    BAD_BITRATE = -(2 ** 63)
+    KINDS = {"audio": AUDIO, "subtitle": SUBTITLE}
+
+    def __init__(self):
+        self.codecs = {}
+        self.codec_ids = array.array("H")
+        self.kinds = bytearray()
+        self.languages = bytearray()
+        self.bitrates = array.array("q")
+        self.indexes = array.array("l")
+        self.offsets = array.array("L", [0])
+        self.names = []
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, file_info, name=None):
+        """Append the streams of one ffprobe document (full or compact)"""
+        codecs = self.codecs
+        for s in file_info.get("streams", []):
+            get = s.get
+            codec = get("codec_name", "").lower()
+            codec_id = codecs.get(codec)
+            if codec_id is None:
+                codec_id = codecs[codec] = len(codecs)
+
+            tags = get("tags")
+            language = tags.get("language") if tags else None
+            bitrate = get("bit_rate", 0)
+            try:
+                bitrate = bitrate if type(bitrate) is int else int(bitrate)
+            except ValueError:
+                bitrate = self.BAD_BITRATE
 
-        for s in streams:
-            if s.get_bitrate() > selected_stream.get_bitrate():
-                selected_stream = s
+            self.codec_ids.append(codec_id)
+            self.kinds.append(self.KINDS.get(get("codec_type", "").lower(), self.OTHER))
+            self.languages.append(self.UNKNOWN_LANGUAGE if language is None else
+                                  self.ENG if language.lower() == "eng" else self.NON_ENG)
+            self.bitrates.append(bitrate)
+            self.indexes.append(get("index", -1))
 
-        return selected_stream
+        self.offsets.append(len(self.kinds))
+        self.names.append(name)
 
+    @classmethod
+    def from_infos(cls, file_infos, names=None):
+        columns = cls()
+        for i, file_info in enumerate(file_infos):
+            columns.add(file_info, None if names is None else names[i])
+        return columns
+
+
+def plan_batch(columns, safe_codecs, codec_priority, extensions=None):
+    """
+    Classify every file in the columns, returning a (state, selected stream index) tuple per file.
+
+    The rules follow FileProcessor._get_file_state and _select_stream in the reorder remap mode: remap_mode and the
+    default/forced dispositions are not in the columns, so a file already flagged in the flags mode still comes out as
+    a Remap here (where _get_file_state would skip it). The Remap counts are therefore not final; plan_files builds a
+    FileProcessor again for every Remap and Convert, which decides the actual state and command.
+
+    The selected index is the stream moved first for a remap or converted for a conversion, None otherwise (or when a
+    needed bitrate cannot be parsed). When extensions are given, files whose name does not match are ignored.
+    """
+    # per codec lookup tables
+    safe_codec_ids = bytearray(len(columns.codecs) + 1)
+    unranked = len(codec_priority)
+    codec_ranks = [unranked] * (len(columns.codecs) + 1)
+    for codec, codec_id in columns.codecs.items():
+        safe_codec_ids[codec_id] = codec in safe_codecs
+    for rank in range(len(codec_priority) - 1, -1, -1):
+        codec_id = columns.codecs.get(codec_priority[rank])
+        if codec_id is not None:
+            codec_ranks[codec_id] = rank
+
+    # whole column passes: one flag per stream
+    audio_kind, eng = StreamColumns.AUDIO, StreamColumns.ENG
+    audio = bytes(k == audio_kind for k in columns.kinds)
+    eng_audio = bytes(k == audio_kind and l == eng for k, l in zip(columns.kinds, columns.languages))
+    safe_eng_audio = bytes(e and safe_codec_ids[c] for e, c in zip(eng_audio, columns.codec_ids))
+
+    # per file passes over the flag columns using the offsets
+    offsets = columns.offsets
+    plans = []
+    for f in range(len(columns)):
+        start, end = offsets[f], offsets[f + 1]
+
+        name = columns.names[f]
+        if extensions is not None and name is not None and not has_matching_extension(name, extensions):
+            plans.append((FileState.Ignore, None))
+            continue
+
+        first = audio.find(1, start, end)
+        if first < 0:
+            plans.append((FileState.Unknown, None))
+        elif safe_eng_audio[first] or eng_audio.find(1, start, end) < 0:
+            plans.append((FileState.Skip, None))
+        else:
+            first_safe_eng = safe_eng_audio.find(1, start, end)
+            if first_safe_eng >= 0:
+                plans.append((FileState.Remap, columns.indexes[first_safe_eng]))
+            else:
+                plans.append((FileState.Convert, _select_in_columns(columns, eng_audio, codec_ranks, unranked, start, end)))
+
+    return plans
 
-def main():
-    load_config()
-    configure_logging()
+
+def _select_in_columns(columns, eng_audio, codec_ranks, unranked, start, end):
+    """The _select_stream rules over one file: best priority codec, then highest bitrate, first stream on ties"""
+    codec_ids, bitrates = columns.codec_ids, columns.bitrates
+    candidates = [i for i in range(start, end) if eng_audio[i]]
+    ranks = [codec_ranks[codec_ids[i]] for i in candidates]
+
+    best_rank = min(ranks)
+    if best_rank < unranked:
+        candidates = [i for i, r in zip(candidates, ranks) if r == best_rank]
+        if len(candidates) == 1:
+            return columns.indexes[candidates[0]]
+
+    if any(bitrates[i] == StreamColumns.BAD_BITRATE for i in candidates):
+        return None
+
+    return columns.indexes[max(candidates, key=bitrates.__getitem__)]
+
+
+def process_files(file_paths, probe_cache=None, journal=None, config=None, leases=None, dedup=None):
+    """
+    Stream the files through the scan -> probe -> decide -> execute stages.
+
+    Each stage hands over to the next through a bounded queue, so the first file starts encoding as soon as it has
+    been classified and only a fixed number of files are held in memory whatever the size of the library. Returns the
+    number of files checked and the scheduler holding the run counts.
+
+    With leases, only the files this host could claim are checked, the others are being handled by another host.
+    Each file is checked once, under the first path found to it (see Deduplicator).
+    """
+    dedup = dedup or open_dedup()
+    scheduler = EncodeScheduler(journal=journal, leases=leases, dedup=dedup)
+    checked = 0
+
+    file_paths = dedup.unique(file_paths)
+    if journal is not None:
+        file_paths = journal.pending(file_paths)
+    if leases is not None:
+        file_paths = leases.claimed(file_paths)
 
     try:
-        video_files = collect_candidate_files()
-        logging.root.info("""
+        # a file that can't be probed is never decided, its lease is handed back right away
+        for p in probe_files(buffered(file_paths, cfg.get("queue_size", 100)), probe_cache=probe_cache,
+                             config=config, on_error=None if leases is None else leases.release):
+            checked += 1
+            _decide(p, scheduler, journal, leases)
+    finally:
+        scheduler.join()
 
+    return checked, scheduler
 
 
+def _decide(processor, scheduler, journal=None, leases=None):
+    processor.print_file_header()
+    scheduler.states[processor.state] += 1
 
+    if journal is not None and not processor.dry_run:
+        journal.record_decision(processor)
 
+    if processor.needs_processing():
+        scheduler.submit(processor)
+    elif leases is not None:
+        leases.release(processor.file_path)
 
-********************************************************
-*
-* START
-*
-* Checking {0} files
-*
-********************************************************
-""".format(len(video_files)))
 
-        processors = []
-        for f in video_files:
+class StableFiles(object):
+    """Holds back changed files until their size and modified time have stopped changing for the debounce interval"""
+
+    def __init__(self, debounce_secs):
+        self.debounce_secs = debounce_secs
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, path):
+        self._pending[pathlib.Path(path)] = (None, time.monotonic())
+
+    def ready(self):
+        """Return the files that have been stable for long enough, in sorted order"""
+        now = time.monotonic()
+        ready = []
+
+        for path, (signature, since) in list(self._pending.items()):
+            try:
+                st = os.stat(str(path))
+            except OSError:
+                # the file has gone (renamed or deleted) before settling
+                del self._pending[path]
+                continue
+
+            current = (st.st_size, st.st_mtime_ns)
+            if current != signature:
+                self._pending[path] = (current, now)
+            elif now - since >= self.debounce_secs:
+                del self._pending[path]
+                ready.append(path)
+
+        return sorted(ready)
+
+
+class InotifyWatcher(object):
+    """Reports the files written or moved into the directory trees, using the linux inotify api through libc"""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directories, exclude=(), skip_hidden=False):
+        self.exclude = exclude
+        self.skip_hidden = skip_hidden
+        self._watches = {}
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        for directory in directories:
+            self._add_tree(str(directory))
+
+    def _add_tree(self, directory):
+        """Watch a directory and all the directories below it, returning the files already in there"""
+        files = []
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = [d for d in dirs if not is_left_out(d, os.path.join(root, d), self.exclude, self.skip_hidden)]
+
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), self.WATCH_MASK)
+            if wd < 0:
+                logger.warning("Unable to watch directory {0}: {1}".format(root, os.strerror(ctypes.get_errno())))
+                continue
+
+            self._watches[wd] = root
+            files.extend(os.path.join(root, n) for n in names)
+        return files
+
+    def changes(self, timeout):
+        """
+        Wait up to `timeout` seconds and return the paths of the files that changed. Returns None when the kernel
+        queue overflowed and events were lost, in which case the caller has to rescan.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0"))
+            offset += self.EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                # a new directory may already hold files by the time it is watched
+                if not is_left_out(name, path, self.exclude, self.skip_hidden) and mask & (self.IN_CREATE |
+                                                                                             self.IN_MOVED_TO):
+                    changed.extend(self._add_tree(path))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed.append(path)
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """Reports the files that changed by rescanning the directories, for when inotify is not available or reliable"""
+
+    def __init__(self, directories, interval_secs, rules):
+        self.directories = directories
+        self.interval_secs = interval_secs
+        self.rules = rules
+        self._next_scan = time.monotonic() + interval_secs
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for path in walk_directory(directory, **self.rules):
+                try:
+                    st = os.stat(str(path))
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout):
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+
+        time.sleep(max(0.0, wait))
+        self._next_scan = time.monotonic() + self.interval_secs
+
+        snapshot = self._scan()
+        changed = [path for path, signature in snapshot.items() if self._snapshot.get(path) != signature]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(directories):
+    rules = scan_rules()
+    mode = cfg.get("watch_mode", "auto")
+
+    if mode != "poll" and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories, exclude=rules["exclude"], skip_hidden=rules["skip_hidden"])
+        except (OSError, AttributeError):
+            if mode == "inotify":
+                raise
+            logger.exception("Unable to use inotify, falling back to polling")
+
+    return PollingWatcher(directories, cfg.get("watch_poll_secs", 60), rules)
+
+
+def watch_directories(probe_cache=None, journal=None, stop=None, config=None, leases=None, dedup=None):
+    """
+    Process files as they arrive in the directories, until `stop` is set (or forever).
+
+    Changed files are only checked once they have been stable for `watch_debounce_secs`, then each one goes through
+    the same probe -> decide -> execute stages as a full scan.
+    """
+    stop = stop or threading.Event()
+    directories = [pathlib.Path(d) for d in cfg.get("directories", [])]
+    rules = scan_rules()
+    stable = StableFiles(cfg.get("watch_debounce_secs", 60))
+    watcher = open_watcher(directories)
+    dedup = dedup or open_dedup()
+    scheduler = EncodeScheduler(journal=journal, leases=leases, dedup=dedup)
+
+    logger.info("Watching {0} directories for new files".format(len(directories)))
+    try:
+        while not stop.is_set():
+            # only wake up regularly while there are files waiting to settle
+            changed = watcher.changes(timeout=1 if len(stable) > 0 else 5)
+
+            if changed is None:
+                logger.warning("Missed file events, rescanning the directories")
+                changed = list(collect_candidate_files())
+
+            for path in changed:
+                if is_candidate_file(path, **rules):
+                    stable.add(path)
+
+            ready = stable.ready()
+            if ready:
+                file_paths = dedup.unique(ready)
+                if journal is not None:
+                    file_paths = journal.pending(file_paths)
+                if leases is not None:
+                    file_paths = leases.claimed(file_paths)
+                for p in probe_files(file_paths, probe_cache=probe_cache, config=config,
+                                     on_error=None if leases is None else leases.release):
+                    _decide(p, scheduler, journal, leases)
+    finally:
+        watcher.close()
+        scheduler.join()
+
+    return scheduler
+
+
+def buffered(iterable, maxsize):
+    """Consume an iterable on a background thread, handing its items over through a bounded queue"""
+    items = queue.Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(done, e)
+        else:
+            put(done)
+
+    threading.Thread(target=produce, daemon=True, name="buffered").start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # let the producer exit when the consumer stops early
+        stop.set()
+
+
+def probe_files(file_paths, probe_cache=None, workers=None, config=None, on_error=None):
+    """
+    Build a processor for each file, running up to `workers` probes at once.
+
+    Processors are yielded in the same order as the files. Only a bounded window of probes is in flight, so a slow
+    file only holds back the delivery (never the probing) of the files behind it, for at most the probe timeout.
+    With device_probe_workers set, the probes are spread over the devices instead (see _probe_by_device).
+    A file that can't be read is logged and passed to `on_error`.
+    """
+    workers = max(1, workers or cfg.get("probe_workers", 4))
+    config = config or current_config()
+
+    per_device = cfg.get("device_probe_workers", 0)
+    if per_device and per_device < workers:
+        yield from _probe_by_device(file_paths, probe_cache, workers, config, per_device, on_error)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as pool:
+        submitted = ((f, pool.submit(FileProcessor, f, probe_cache=probe_cache, config=config)) for f in file_paths)
+
+        for f, future in buffered(submitted, workers * 2):
             try:
-                processors.append(FileProcessor(f))
+                yield future.result()
             except Exception:
                 logger.exception("Error reading file: {0}".format(f))
+                if on_error is not None:
+                    on_error(f)
+
+
+def _probe_by_device(file_paths, probe_cache, workers, config, per_device, on_error=None):
+    """
+    Probe the files with at most `per_device` probes reading from the same device. The files are read ahead (up to
+    queue_size) into a queue per device and the free workers take them from the devices in turn, so a scan going
+    through one device at a time still keeps the other devices busy. Processors are yielded as they are done.
+    """
+    devices = DeviceMap()
+    lookahead = max(workers, cfg.get("queue_size", 100))
+    waiting = collections.OrderedDict()
+    running = collections.Counter()
+    probing = {}
+    queued = 0
+    file_paths = iter(file_paths)
+    scanned = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as pool:
+        while True:
+            while not scanned and queued < lookahead:
+                f = next(file_paths, None)
+                if f is None:
+                    scanned = True
+                    break
+                waiting.setdefault(devices.key(f), collections.deque()).append(f)
+                queued += 1
+
+            # one file from each device with a free slot in turn, until the workers are all busy
+            submitted = True
+            while submitted and len(probing) < workers:
+                submitted = False
+                for device in list(waiting):
+                    if len(probing) >= workers:
+                        break
+                    if running[device] >= per_device:
+                        continue
+
+                    f = waiting[device].popleft()
+                    if waiting[device]:
+                        waiting.move_to_end(device)
+                    else:
+                        del waiting[device]
+                    queued -= 1
+                    running[device] += 1
+                    probing[pool.submit(FileProcessor, f, probe_cache=probe_cache, config=config)] = (f, device)
+                    submitted = True
+
+            if not probing:
+                if scanned:
+                    return
+                continue
+
+            done, _ = concurrent.futures.wait(probing, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                f, device = probing.pop(future)
+                running[device] -= 1
+                try:
+                    yield future.result()
+                except Exception:
+                    logger.exception("Error reading file: {0}".format(f))
+                    if on_error is not None:
+                        on_error(f)
+
+
+JOB_ORDERS = {
+    # in the order the files were found
+    "scan": lambda processor: 0,
+    # the most files done in the time available
+    "cheapest": lambda processor: processor.estimate_cost(),
+    # the long jobs start first so the workers finish close together (the shortest total time)
+    "longest": lambda processor: -processor.estimate_cost(),
+    "newest": lambda processor: -processor.modified_ns(),
+}
+
+
+def job_order(order=None):
+    """The priority function of the configured job order, lower runs first"""
+    order = order or cfg.get("job_order", "scan")
+    if order not in JOB_ORDERS:
+        raise ValueError("Unknown job_order: {0} (expected one of {1})".format(order, ", ".join(JOB_ORDERS)))
+    return JOB_ORDERS[order]
+
+
+class DeviceMap(object):
+    """
+    Groups files by the disk they are read from: the device (st_dev) for local filesystems, and the server export
+    for network filesystems, since every mount of the same export reads from the same disks.
+    """
+    NETWORK_FILESYSTEMS = frozenset(["nfs", "nfs4", "cifs", "smb3", "smbfs", "ceph", "glusterfs", "fuse.sshfs", "9p"])
+
+    def __init__(self, mounts_file="/proc/self/mounts"):
+        self._mounts = self._read_mounts(mounts_file)
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def key(self, file_path):
+        """The group of the file, None when it can't be read"""
+        try:
+            dev = os.stat(str(file_path)).st_dev
+        except OSError:
+            return None
+
+        with self._lock:
+            key = self._keys.get(dev)
+            if key is None:
+                key = self._keys[dev] = self._device_key(os.path.abspath(str(file_path)), dev)
+        return key
+
+    def _device_key(self, path, dev):
+        for mount_point, source, fs_type in self._mounts:
+            if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+                if fs_type in self.NETWORK_FILESYSTEMS:
+                    return source
+                break
+        return dev
+
+    @staticmethod
+    def _read_mounts(mounts_file):
+        """(mount point, source, type) of each mount, the deepest mount points first"""
+        mounts = []
+        try:
+            with io.open(mounts_file) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        # spaces and other special characters are escaped as octal in the mounts file
+                        mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                        mounts.append((mount_point, fields[0], fields[2]))
+        except OSError:
+            pass
+        return sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+
+
+class DeviceLane(object):
+    """
+    The jobs waiting for a lane's workers, kept per device in job_order. Free workers take the jobs round-robin
+    across the devices that have a free slot, so one busy disk never holds back the others.
+    """
+
+    def __init__(self, maxsize, slots, condition):
+        self.maxsize = maxsize
+        self._slots = slots
+        self._condition = condition
+        self._waiting = {}
+        self._devices = collections.deque()
+        self._size = 0
+        self._closed = False
+
+    def put(self, device, priority, job):
+        with self._condition:
+            # blocks once the lane is full, which holds back the scanning and probing feeding it
+            while self._size >= self.maxsize:
+                self._condition.wait()
+
+            if device not in self._waiting:
+                self._waiting[device] = []
+                self._devices.append(device)
+            heapq.heappush(self._waiting[device], (priority, job))
+            self._size += 1
+            self._condition.notify_all()
+
+    def get(self):
+        """The next (device, job) to run, None once the lane is closed and empty"""
+        with self._condition:
+            while True:
+                for _ in range(len(self._devices)):
+                    device = self._devices[0]
+                    self._devices.rotate(-1)
+                    if self._slots.acquire(device):
+                        return device, self._take(device)
+
+                if self._closed and self._size == 0:
+                    return None
+                self._condition.wait()
+
+    def done(self, device):
+        with self._condition:
+            self._slots.release(device)
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _take(self, device):
+        waiting = self._waiting[device]
+        _, job = heapq.heappop(waiting)
+        if not waiting:
+            del self._waiting[device]
+            self._devices.remove(device)
+        self._size -= 1
+        self._condition.notify_all()
+        return job
+
+
+class DeviceSlots(object):
+    """How many jobs run on each device, capped at `per_device` (no cap when 0). Guarded by the lanes' condition."""
+
+    def __init__(self, per_device=0):
+        self.per_device = per_device
+        self._active = collections.Counter()
+
+    def acquire(self, device):
+        if self.per_device and self._active[device] >= self.per_device:
+            return False
+        self._active[device] += 1
+        return True
+
+    def release(self, device):
+        self._active[device] -= 1
+
+
+class CpuShare(collections.namedtuple("CpuShare", ["cpus", "threads", "nice", "ioprio"])):
+    """The cpus, thread count and priorities one ffmpeg process runs with, None for those left as they are"""
+    __slots__ = ()
+
+    def command_args(self, args):
+        """The ffmpeg args with the thread count set as an output option (just before the output file)"""
+        if not self.threads:
+            return args
+        return args[:-1] + ["-threads", str(self.threads)] + args[-1:]
+
+
+UNGOVERNED = CpuShare(None, None, 0, None)
+
+
+class CpuGovernor(object):
+    """
+    Splits the cpus between the running conversions so concurrent encodes don't oversubscribe the machine: each
+    conversion is pinned to its own partition of (convert_cpu_share of) the cpus and runs as many ffmpeg threads.
+    Remaps hardly use the cpu and are only given their (idle by default) I/O priority.
+    """
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+    IOPRIO_CLASS_SHIFT = 13
+    # the syscall has no wrapper in libc (nor in os)
+    IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+
+    def __init__(self, convert_workers=None, cpus=None, convert_cpu_share=None, convert_nice=None,
+                 convert_ionice=None, remap_nice=None, remap_ionice=None):
+        if cpus is None:
+            cpus = cfg.get("encode_cpus") or self._available_cpus()
+        cpus = sorted(cpus)
+        share = convert_cpu_share or cfg.get("convert_cpu_share", 1.0)
+        cpus = cpus[:max(1, int(len(cpus) * share))]
+
+        partitions = min(len(cpus), max(1, convert_workers or cfg.get("convert_workers", 1)))
+        self.partitions = [frozenset(cpus[i * len(cpus) // partitions:(i + 1) * len(cpus) // partitions])
+                           for i in range(partitions)]
+        self._running = [0] * partitions
+        self._lock = threading.Lock()
+
+        self.convert_nice = cfg.get("convert_nice", 0) if convert_nice is None else convert_nice
+        self.convert_ioprio = self.ioprio(cfg.get("convert_ionice") if convert_ionice is None else convert_ionice)
+        self.remap_nice = cfg.get("remap_nice", 0) if remap_nice is None else remap_nice
+        self.remap_ioprio = self.ioprio(cfg.get("remap_ionice", "idle") if remap_ionice is None else remap_ionice)
+        self._ioprio_set = self._ioprio_syscall()
+
+    @contextlib.contextmanager
+    def share(self, state):
+        """The share of the machine for a job while it runs, a conversion takes the least busy cpu partition"""
+        if state != FileState.Convert:
+            yield CpuShare(None, None, self.remap_nice, self.remap_ioprio)
+            return
+
+        with self._lock:
+            partition = self._running.index(min(self._running))
+            self._running[partition] += 1
+        try:
+            cpus = self.partitions[partition]
+            yield CpuShare(cpus, len(cpus), self.convert_nice, self.convert_ioprio)
+        finally:
+            with self._lock:
+                self._running[partition] -= 1
+
+    def apply(self, share, pid):
+        """
+        Set the affinity and priorities of a started ffmpeg process. ffmpeg starts its threads once the input is open,
+        so they inherit them. A priority that can't be set is left as it is.
+        """
+        try:
+            if share.cpus and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(pid, share.cpus)
+            if share.nice:
+                os.setpriority(os.PRIO_PROCESS, pid, share.nice)
+            if share.ioprio is not None and self._ioprio_set is not None:
+                if self._ioprio_set(self.IOPRIO_WHO_PROCESS, pid, share.ioprio) < 0:
+                    raise OSError(ctypes.get_errno(), "ioprio_set failed")
+        except OSError as e:
+            logger.warning("Unable to set the cpu share of process {0}: {1}".format(pid, e))
+
+    @classmethod
+    def ioprio(cls, ionice):
+        """The ioprio value of an ionice setting: a class (realtime, best-effort or idle) and optional level (0-7)"""
+        if not ionice:
+            return None
+
+        io_class, _, level = str(ionice).partition(":")
+        if io_class not in cls.IOPRIO_CLASSES:
+            raise ValueError("Unknown ionice class: {0} (expected one of {1})".format(
+                io_class, ", ".join(cls.IOPRIO_CLASSES)))
+        return (cls.IOPRIO_CLASSES[io_class] << cls.IOPRIO_CLASS_SHIFT) | int(level or 4)
+
+    @staticmethod
+    def _available_cpus():
+        if hasattr(os, "sched_getaffinity"):
+            return os.sched_getaffinity(0)
+        return range(os.cpu_count() or 1)
+
+    @classmethod
+    def _ioprio_syscall(cls):
+        """ioprio_set, through the raw syscall"""
+        number = cls.IOPRIO_SET_SYSCALLS.get(os.uname().machine) if hasattr(os, "uname") else None
+        if number is None:
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except OSError:
+            return None
+        return functools.partial(libc.syscall, number)
+
+
+class EncodeScheduler(object):
+    """
+    Runs the processors on separately sized worker pools: remaps (stream copies, I/O bound) and conversions
+    (re-encodes, CPU bound) each get their own lane so quick remaps never wait behind a long conversion.
+    The jobs waiting in a lane run in the configured job_order for each device, the devices taking turns, with at
+    most device_encode_workers jobs (of both lanes) reading from the same device.
+    """
+
+    def __init__(self, remap_workers=None, convert_workers=None, queue_size=None, journal=None, order=None,
+                 leases=None, dedup=None):
+        self.processed = 0
+        self.failed = 0
+        # the jobs left out because their lease was lost to another host
+        self.lost = 0
+        self.journal = journal
+        self.leases = leases
+        self.dedup = dedup
+        # the files decided, by FileState
+        self.states = collections.Counter()
+        self.status = RunStatus(cfg.get("status_file", None))
+        self._lock = threading.Lock()
+        self._priority = job_order(order)
+        self._submitted = itertools.count()
+
+        self._devices = DeviceMap()
+        self.governor = CpuGovernor(convert_workers)
+
+        # the lanes share the device slots, and so the condition guarding them
+        queue_size = queue_size or cfg.get("queue_size", 100)
+        slots = DeviceSlots(cfg.get("device_encode_workers", 0))
+        condition = threading.Condition()
+        self._lanes = {FileState.Remap: DeviceLane(queue_size, slots, condition),
+                       FileState.Convert: DeviceLane(queue_size, slots, condition)}
+        self._workers = {FileState.Remap: [], FileState.Convert: []}
+
+        sizes = {FileState.Remap: remap_workers or cfg.get("remap_workers", 1),
+                 FileState.Convert: convert_workers or cfg.get("convert_workers", 1)}
+        for state, lane in self._lanes.items():
+            for i in range(max(1, sizes[state])):
+                worker = threading.Thread(target=self._work, args=(lane,), daemon=True,
+                                          name="{0}-{1}".format("remap" if state == FileState.Remap else "convert", i))
+                worker.start()
+                self._workers[state].append(worker)
+
+    def submit(self, processor):
+        # the submission count keeps equal priorities in order (and the processors from ever being compared)
+        priority = (self._priority(processor), next(self._submitted))
+        self._lanes[processor.state].put(self._devices.key(processor.file_path), priority, processor)
+
+    def join(self):
+        """Wait for all submitted jobs to finish and stop the workers"""
+        for lane in self._lanes.values():
+            lane.close()
+
+        for workers in self._workers.values():
+            for worker in workers:
+                worker.join()
+
+    def _work(self, lane):
+        while True:
+            job = lane.get()
+            if job is None:
+                return
+
+            device, processor = job
+            try:
+                self._run(processor)
+            finally:
+                lane.done(device)
+
+    def _run(self, processor):
+        if self.leases is not None and not self.leases.holds(processor.file_path):
+            logger.warning("Not processing, the lease was lost to another host: {0}".format(processor.file_path))
+            with self._lock:
+                self.lost += 1
+            return
+
+        journal = None if processor.dry_run else self.journal
+        if journal is not None:
+            journal.record_started(processor)
+
+        succeeded = False
+        try:
+            succeeded = processor.run(self.status, governor=self.governor)
+        except Exception:
+            logger.exception("Error processing file: {0}".format(processor.file_path))
+
+        if journal is not None:
+            journal.record_finished(processor, succeeded)
+        if succeeded and self.dedup is not None and not processor.dry_run:
+            self.dedup.replaced(processor.file_path)
+        if self.leases is not None:
+            self.leases.release(processor.file_path)
+
+        with self._lock:
+            if succeeded:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+
+class PlannedJob(FileProcessor):
+    """A file from a saved plan, runs the planned ffmpeg command without probing the file again"""
+
+    def __init__(self, entry, config=None):
+        self._init_settings(pathlib.Path(entry["path"]), config)
+        self.identity = tuple(entry["identity"])
+        self.state = entry["state"]
+        self.args = entry["args"]
+        # where the planned command writes, whatever the scratch_dir is now (plans without it write to the last arg)
+        self.temp_file = pathlib.Path(entry.get("temp_file") or self.args[-1])
+        self.cost = entry.get("cost", 0.0)
+        self.default_stream = entry.get("default_stream")
+        self.duration = entry.get("duration")
+
+    def _get_command_args(self):
+        return list(self.args)
+
+    @property
+    def temp_file_name(self):
+        return self.temp_file
+
+    def _default_stream_index(self):
+        return self.default_stream
+
+    def _get_command(self):
+        return shlex.join(self.args)
+
+    def estimate_cost(self):
+        return self.cost
+
+    def modified_ns(self):
+        return self.identity[3]
 
-        count = 0
-        for p in processors:
+    @staticmethod
+    def plan_entry(processor):
+        entry = {"path": str(processor.file_path),
+                 "identity": list(file_identity(processor.file_path)),
+                 "state": processor.state,
+                 "args": processor._get_command_args(),
+                 "temp_file": str(processor.temp_file_name),
+                 "duration": processor.duration,
+                 "cost": processor.estimate_cost()}
+        if processor.state == FileState.Remap:
+            entry["default_stream"] = processor._default_stream_index()
+        return entry
+
+
+def write_plan(plan_file, file_paths, probe_cache=None, config=None, dedup=None):
+    """
+    Probe and classify the files, writing the ones to process to a json lines plan file for `apply`. The hard links
+    to the planned files follow the jobs, so apply can link them to the re-encoded files.
+    """
+    planned = []
+    states = collections.Counter()
+    temp_file = "{0}.tmp".format(plan_file)
+    dedup = dedup or open_dedup()
+    file_paths = buffered(dedup.unique(file_paths), cfg.get("queue_size", 100))
+
+    with io.open(temp_file, "w") as f:
+        for p in plan_files(file_paths, probe_cache=probe_cache, config=config, states=states):
             p.print_file_header()
+            states[p.state] += 1
 
             if p.needs_processing():
                 try:
-                    p.run()
-                    count += 1
-                except Exception:
-                    logger.exception("Error processing file: {0}".format(p.file_path))
+                    entry = PlannedJob.plan_entry(p)
+                except OSError:
+                    logger.exception("Unable to plan file: {0}".format(p.file_path))
+                    continue
+
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                planned.append(p.file_path)
+
+        # the links found at any point of the scan are only all known at the end
+        for file_path in planned:
+            for link in dedup.links_of(file_path):
+                f.write(json.dumps({"path": str(link), "hardlink_of": str(file_path)}, separators=(",", ":")) + "\n")
+
+    checked = sum(states.values())
+    os.replace(temp_file, str(plan_file))
+    logger.info("Planned {0} of {1} files into: {2} ({3})".format(len(planned), checked, plan_file,
+                                                                  count_states(states)))
+    return checked, len(planned)
+
+
+def plan_files(file_paths, probe_cache=None, config=None, states=None, batch_size=10000):
+    """
+    Classify the files, yielding a processor for each one that may need processing. With a probe cache, the files
+    are taken in batches: the cached ones are classified together by plan_batch and only counted in `states` when
+    they need nothing, so re-planning a probed library never builds a processor per file. The others are probed.
+    """
+    config = config or current_config()
+    if probe_cache is None:
+        yield from probe_files(file_paths, config=config)
+        return
+
+    file_paths = iter(file_paths)
+    while True:
+        batch = list(itertools.islice(file_paths, batch_size))
+        if not batch:
+            return
+
+        cached, infos, probed = [], [], []
+        for file_path in batch:
+            try:
+                file_info = probe_cache.get(file_identity(file_path))
+            except OSError:
+                file_info = None
+            if file_info is None:
+                probed.append(file_path)
+            else:
+                cached.append(file_path)
+                infos.append(file_info)
+
+        columns = StreamColumns.from_infos(infos, [p.name for p in cached])
+        plans = plan_batch(columns, config.safe_codecs, config.codec_priority, config.extensions)
+        for file_path, file_info, (state, _) in zip(cached, infos, plans):
+            if state in (FileState.Remap, FileState.Convert):
+                # the processor builds the command (and may still find nothing to do, in the flags remap mode)
+                yield FileProcessor(file_path, file_info=file_info, config=config)
+            else:
+                logger.debug("{0}: {1}".format(state, file_path))
+                if states is not None:
+                    states[state] += 1
 
-        logger.info("""
+        yield from probe_files(probed, probe_cache=probe_cache, config=config)
+
+
+def read_plan(plan_file, config=None, dedup=None):
+    """The jobs of a plan file, the hard links listed in it are added to `dedup`"""
+    with io.open(str(plan_file)) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+            if "hardlink_of" in entry:
+                if dedup is not None:
+                    dedup.add_links(pathlib.Path(entry["hardlink_of"]), [pathlib.Path(entry["path"])])
+                continue
+            yield PlannedJob(entry, config=config)
+
+
+def apply_plan(plan_file, journal=None, config=None, leases=None, dedup=None):
+    """
+    Run the jobs of a plan file on the scheduler. Files already completed (per the journal) are skipped, and files
+    whose identity changed since they were planned are left alone since the planned command may no longer fit them.
+    """
+    dedup = dedup or Deduplicator()
+    scheduler = EncodeScheduler(journal=journal, leases=leases, dedup=dedup)
+    checked = 0
+    changed = 0
+
+    # the whole plan is known, so it is ordered up front rather than only as far as the lanes hold
+    jobs = sorted(read_plan(plan_file, config=config, dedup=dedup), key=job_order())
+
+    try:
+        for job in jobs:
+            checked += 1
+
+            # claimed before the identity check, another host may have just finished the file
+            if leases is not None and not leases.claim(job.file_path):
+                continue
+
+            try:
+                identity = file_identity(job.file_path)
+            except OSError:
+                identity = None
+
+            if journal is not None and identity is not None and journal.is_complete(job.file_path, identity):
+                journal.resumed += 1
+            elif identity != job.identity:
+                logger.warning("File changed since it was planned, skipping: {0}".format(job.file_path))
+                changed += 1
+            else:
+                job.print_file_header()
+                scheduler.states[job.state] += 1
+                scheduler.submit(job)
+                continue
+
+            if leases is not None:
+                leases.release(job.file_path)
+    finally:
+        scheduler.join()
+
+    return checked, changed, scheduler
+
+
+def count_states(states):
+    """The counts of files by state for the logs, such as: 3 remap, 120 skip"""
+    return ", ".join("{0} {1}".format(count, FileState.short_name(state))
+                     for state, count in sorted(states.items(), key=lambda s: FileState.short_name(s[0]))) or "none"
+
+
+def log_summary(checked, scheduler, journal=None, probe_cache=None):
+    logger.info("""
 ********************************************************
 *
 * END
 *
-* Processed {0} files
+* Checked {0} files ({1} already complete): {7}
+*
+* Processed {2} files ({3} failed, {8} lost to other hosts)
+*
+* Throughput: {4}
+*
+* Probe cache: {5}
+*
+* Duplicates left out: {6}
 *
 ********************************************************
 
 
-""".format(count))
+""".format(checked, 0 if journal is None else journal.resumed,
+           scheduler.processed, scheduler.failed, scheduler.status.summary(),
+           "disabled" if probe_cache is None else
+           "{0} hits, {1} misses".format(probe_cache.hits, probe_cache.misses),
+           "none" if scheduler.dedup is None else "{0} hard links, {1} symlinked, {2} copies".format(
+               scheduler.dedup.hardlinks, scheduler.dedup.symlinks, scheduler.dedup.copies),
+           count_states(scheduler.states), scheduler.lost))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk reordering of video streams")
+    parser.add_argument("--watch", action="store_true",
+                        help="after the scan, keep running and process new files as they arrive")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached ffprobe results and the journal, probing and checking every file again")
+
+    commands = parser.add_subparsers(dest="command", metavar="command",
+                                     help="plan or apply (without a command, files are checked and processed at once)")
+    plan = commands.add_parser("plan", help="check the files and write the ffmpeg commands to a plan file")
+    plan.add_argument("plan_file")
+    apply = commands.add_parser("apply", help="run the commands of a plan file without probing the files again")
+    apply.add_argument("plan_file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_config()
+    configure_logging()
+    config = current_config()
+
+    probe_cache = open_probe_cache(refresh=args.refresh)
+    journal = open_journal(refresh=args.refresh)
+    leases = open_leases()
+    dedup = open_dedup()
+    metrics.open(cfg.get("metrics_file"), cfg.get("metrics_prometheus_file"))
+    try:
+        if journal is not None:
+            journal.reclaim_interrupted()
+
+        logging.root.info("""
+
+
+
+
+
+
+********************************************************
+*
+* START
+*
+* {0}
+*
+********************************************************
+""".format("Applying plan: {0}".format(args.plan_file) if args.command == "apply" else
+           "Checking {0} directories".format(len(cfg.get("directories", [])))))
+
+        if args.command == "plan":
+            write_plan(args.plan_file, collect_candidate_files(), probe_cache=probe_cache, config=config, dedup=dedup)
+            return
+
+        if args.command == "apply":
+            checked, changed, scheduler = apply_plan(args.plan_file, journal=journal, config=config, leases=leases,
+                                                     dedup=dedup)
+        else:
+            checked, scheduler = process_files(collect_candidate_files(), probe_cache=probe_cache, journal=journal,
+                                               config=config, leases=leases, dedup=dedup)
+
+        log_summary(checked, scheduler, journal=journal, probe_cache=probe_cache)
+        if leases is not None:
+            logger.info("Left {0} files claimed by other hosts".format(leases.busy))
+
+        if args.watch:
+            watch_directories(probe_cache=probe_cache, journal=journal, config=config, leases=leases, dedup=dedup)
+    except KeyboardInterrupt:
+        logger.info("Stopped")
     except Exception:
         logger.exception("FATAL ERROR")
+    finally:
+        if probe_cache is not None:
+            probe_cache.close()
+        if journal is not None:
+            journal.close()
+        if leases is not None:
+            leases.close()
+        metrics.close()
+        stop_logging()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,199 @@
+import mediaheaders
+import streamix
+import testhelper
+import unittest.mock
+
+__author__ = 'cody'
+
+
+MKV_TRACKS = [(1, "V_MPEG4/ISO/AVC", None),
+              (2, "A_DTS", "fre"),
+              (2, "A_AAC/MPEG4/LC", "eng"),
+              (17, "S_TEXT/UTF8", "und")]
+
+
+def _write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_matroska_tracks_match_ffprobe_streams(tmp_path):
+    info = mediaheaders.read_file_info(_write(tmp_path, "file.mkv", testhelper.build_mkv(MKV_TRACKS, duration=90.5)))
+
+    # the tracks leave out FlagDefault, which then defaults to set
+    assert info["streams"] == [{"index": 0, "codec_type": "video", "codec_name": "h264",
+                                "tags": {"language": "eng"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 1, "codec_type": "audio", "codec_name": "dts",
+                                "tags": {"language": "fre"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 2, "codec_type": "audio", "codec_name": "aac",
+                                "tags": {"language": "eng"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 3, "codec_type": "subtitle", "codec_name": "subrip", "disposition": {"default": 1, "forced": 0}}]
+    assert info["format"]["duration"] == "90.500000"
+
+
+def test_matroska_tracks_after_the_first_cluster_are_found_through_the_seek_head(tmp_path):
+    data = testhelper.build_mkv(MKV_TRACKS, tracks_after_cluster=True)
+    info = mediaheaders.read_file_info(_write(tmp_path, "file.mkv", data))
+
+    assert [s["codec_name"] for s in info["streams"]] == ["h264", "dts", "aac", "subrip"]
+
+
+def test_matroska_falls_back_for_attachments_and_unknown_codecs(tmp_path):
+    with_attachments = testhelper.build_mkv(MKV_TRACKS, attachments=True)
+    unknown_codec = testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None), (2, "A_MS/ACM", "eng")])
+
+    assert mediaheaders.read_file_info(_write(tmp_path, "a.mkv", with_attachments)) is None
+    assert mediaheaders.read_file_info(_write(tmp_path, "b.mkv", unknown_codec)) is None
+
+
+def test_mp4_tracks_match_ffprobe_streams(tmp_path):
+    data = testhelper.build_mp4([(b"vide", b"avc1", "und", [1000] * 10),
+                                 (b"soun", 0x40, "eng", [100] * 600),
+                                 (b"soun", b"ac-3", "fre", [2000] * 60),
+                                 (b"sbtl", b"tx3g", None, [])], duration=60)
+    info = mediaheaders.read_file_info(_write(tmp_path, "file.mp4", data))
+
+    assert info["streams"] == [{"index": 0, "codec_type": "video", "codec_name": "h264", "bit_rate": "1333",
+                                "tags": {"language": "und"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 1, "codec_type": "audio", "codec_name": "aac", "bit_rate": "8000",
+                                "tags": {"language": "eng"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 2, "codec_type": "audio", "codec_name": "ac3", "bit_rate": "16000",
+                                "tags": {"language": "fre"}, "disposition": {"default": 1, "forced": 0}},
+                               {"index": 3, "codec_type": "subtitle", "codec_name": "mov_text", "disposition": {"default": 1, "forced": 0}}]
+    assert info["format"]["duration"] == "60.000000"
+
+
+def test_other_files_fall_back_to_ffprobe(tmp_path):
+    assert mediaheaders.read_file_info(_write(tmp_path, "empty.mkv", b"")) is None
+    assert mediaheaders.read_file_info(_write(tmp_path, "file.avi", b"RIFF" + b"\0" * 100)) is None
+    assert mediaheaders.read_file_info(_write(tmp_path, "truncated.mkv", testhelper.build_mkv(MKV_TRACKS)[:60])) is None
+    assert mediaheaders.read_file_info(str(tmp_path / "missing.mkv")) is None
+
+
+@unittest.mock.patch("streamix.run_command")
+def test_file_processor_reads_headers_without_ffprobe(mock_run_command, tmp_path):
+    streamix.load_config()
+    path = _write(tmp_path, "file.mkv", testhelper.build_mkv(MKV_TRACKS))
+
+    processor = streamix.FileProcessor(streamix.pathlib.Path(path))
+
+    assert processor.state == streamix.FileState.Remap
+    assert processor._remap_stream_order()[1].index == 2
+    assert not mock_run_command.called
+
+
+@unittest.mock.patch("streamix.run_command")
+def test_file_processor_probes_when_a_conversion_needs_bitrates(mock_run_command, tmp_path):
+    streamix.load_config()
+    mock_run_command.return_value = streamix.CommandResult(0, "{}", [])
+    path = _write(tmp_path, "file.mkv", testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None),
+                                                              (2, "A_DTS", "fre"),
+                                                              (2, "A_DTS", "eng"),
+                                                              (2, "A_DTS", "eng")]))
+
+    streamix.FileProcessor(streamix.pathlib.Path(path))
+
+    assert mock_run_command.called
+
+
+def _matroska_flags(path):
+    with open(path, "rb") as f:
+        header = mediaheaders.MatroskaHeader(f.read())
+    return [tuple(None if p is None else header._uint(*p) for p in flags) for flags in header.flags]
+
+
+def _mp4_enabled(path):
+    with open(path, "rb") as f:
+        header = mediaheaders.Mp4Header(f.read())
+    return [header.buf[p + 2] & header.TRACK_ENABLED for p in header.track_flags]
+
+
+def test_set_default_track_edits_matroska_flags_in_place(tmp_path):
+    path = _write(tmp_path, "file.mkv", testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None, 1, None),
+                                                              (2, "A_DTS", "fre", 1, 1),
+                                                              (2, "A_AAC", "eng", 0, 0),
+                                                              (17, "S_TEXT/UTF8", "fre", 1, None)]))
+    size = streamix.os.path.getsize(path)
+
+    assert mediaheaders.set_default_track(path, 2)
+
+    assert _matroska_flags(path) == [(1, None), (0, 0), (1, 0), (1, None)]
+    assert streamix.os.path.getsize(path) == size
+
+
+def test_set_default_track_needs_a_remap_when_a_flag_is_left_out(tmp_path):
+    data = testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None), (2, "A_DTS", "fre"), (2, "A_AAC", "eng", 0)])
+    path = _write(tmp_path, "file.mkv", data)
+
+    # the french track is default when FlagDefault is left out, and it can't be inserted in place
+    assert not mediaheaders.set_default_track(path, 2)
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_set_default_track_edits_mp4_enabled_flags_in_place(tmp_path):
+    path = _write(tmp_path, "file.mp4", testhelper.build_mp4([(b"vide", b"avc1", "und", [1000]),
+                                                              (b"soun", b"ac-3", "fre", [100]),
+                                                              (b"soun", 0x40, "eng", [100])]))
+
+    assert mediaheaders.set_default_track(path, 2)
+
+    assert _mp4_enabled(path) == [1, 0, 1]
+
+
+@unittest.mock.patch("streamix.run_command")
+def test_flags_remap_mode_does_not_rewrite_the_file(mock_run_command, tmp_path):
+    config = testhelper.build_config(remap_mode="flags", **{"dry-run": False})
+    path = _write(tmp_path, "file.mkv", testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None),
+                                                              (2, "A_DTS", "fre", 1),
+                                                              (2, "A_AAC", "eng", 0)]))
+    processor = streamix.FileProcessor(streamix.pathlib.Path(path), config=config)
+
+    assert processor.state == streamix.FileState.Remap
+    assert processor.run()
+
+    assert not mock_run_command.called
+    assert _matroska_flags(path)[1:] == [(0, None), (1, None)]
+
+    # the next run finds the stream flagged as the default and leaves the file alone
+    assert streamix.FileProcessor(streamix.pathlib.Path(path), config=config).state == streamix.FileState.Skip
+    reordered = streamix.FileProcessor(streamix.pathlib.Path(path), config=testhelper.build_config())
+    assert reordered.state == streamix.FileState.Remap
+
+
+@unittest.mock.patch("streamix.run_command")
+def test_flags_remap_mode_leaves_hard_links_as_they_are(mock_run_command, tmp_path):
+    config = testhelper.build_config(remap_mode="flags", **{"dry-run": False})
+    path = _write(tmp_path, "file.mkv", testhelper.build_mkv([(1, "V_MPEG4/ISO/AVC", None),
+                                                              (2, "A_DTS", "fre", 1),
+                                                              (2, "A_AAC", "eng", 0)]))
+    link = str(tmp_path / "link.mkv")
+    streamix.os.link(path, link)
+    dedup = streamix.Deduplicator()
+    assert list(dedup.unique([streamix.pathlib.Path(path), streamix.pathlib.Path(link)])) == \
+        [streamix.pathlib.Path(path)]
+
+    assert streamix.FileProcessor(streamix.pathlib.Path(path), config=config).run()
+    dedup.replaced(streamix.pathlib.Path(path))
+
+    # the flags were edited in place, so the link already is the edited file
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["file.mkv", "link.mkv"]
+    assert streamix.os.path.samefile(path, link)
+    assert _matroska_flags(link)[1:] == [(0, None), (1, None)]
+
+
+def test_flags_remap_mode_skips_only_when_no_other_audio_is_default():
+    config = testhelper.build_config(remap_mode="flags")
+
+    def state(fre_disposition, eng_disposition):
+        fre = testhelper.build_audio_stream("dts", language="fre")
+        eng = testhelper.build_audio_stream("aac", language="eng")
+        fre["disposition"], eng["disposition"] = fre_disposition, eng_disposition
+        return testhelper.build_file_processor_for_streams([testhelper.build_video_stream(), fre, eng],
+                                                           config=config).state
+
+    assert state({"default": 0}, {"default": 1}) == streamix.FileState.Skip
+    assert state({"default": 1}, {"default": 1}) == streamix.FileState.Remap
+    assert state({"default": 0, "forced": 1}, {"default": 1}) == streamix.FileState.Remap
+    assert state({"default": 0}, {"default": 0}) == streamix.FileState.Remap
@@ -1,7 +1,18 @@
+import collections
 import json
+import logging
+import logging.handlers
 import testhelper
 import streamix
+import bench_streamix
+import synthetic_probe
 import io
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
 import unittest.mock
 
 __author__ = 'cody'
@@ -111,7 +122,7 @@ def test_remap_moves_safe_eng_to_first():
     # noinspection PyProtectedMember
     stream_order = file_processor._remap_stream_order()
 
-    assert stream_order == [s1, s3, s2, s4]
+    assert [s.index for s in stream_order] == [s["index"] for s in [s1, s3, s2, s4]]
 
 
 def test_remap_moves_first_safe_eng_to_first():
@@ -125,7 +136,7 @@ def test_remap_moves_first_safe_eng_to_first():
     # noinspection PyProtectedMember
     stream_order = file_processor._remap_stream_order()
 
-    assert stream_order == [s1, s3, s2, s4, s5]
+    assert [s.index for s in stream_order] == [s["index"] for s in [s1, s3, s2, s4, s5]]
 
 
 #########################################
@@ -142,9 +153,9 @@ def test_convert_selects_eng():
     file_processor = testhelper.build_file_processor_for_streams([s1, s2, s3, s4])
 
     # noinspection PyProtectedMember
-    selected_stream = file_processor._select_stream().raw
+    selected_stream = file_processor._select_stream().index
 
-    assert selected_stream == s3
+    assert selected_stream == s3["index"]
 
 
 def test_convert_selects_by_priority():
@@ -156,9 +167,9 @@ def test_convert_selects_by_priority():
     file_processor = testhelper.build_file_processor_for_streams([s1, s2, s3, s4, s5])
 
     # noinspection PyProtectedMember
-    selected_stream = file_processor._select_stream().raw
+    selected_stream = file_processor._select_stream().index
 
-    assert selected_stream == s4
+    assert selected_stream == s4["index"]
 
 
 def test_convert_uses_bitrate():
@@ -170,9 +181,9 @@ def test_convert_uses_bitrate():
     file_processor = testhelper.build_file_processor_for_streams([s1, s2, s3, s4, s5])
 
     # noinspection PyProtectedMember
-    selected_stream = file_processor._select_stream().raw
+    selected_stream = file_processor._select_stream().index
 
-    assert selected_stream == s4
+    assert selected_stream == s4["index"]
 
 
 def test_convert_uses_bitrate_after_priority():
@@ -186,9 +197,9 @@ def test_convert_uses_bitrate_after_priority():
     file_processor = testhelper.build_file_processor_for_streams([s1, s2, s3, s4, s5, s6, s7])
 
     # noinspection PyProtectedMember
-    selected_stream = file_processor._select_stream().raw
+    selected_stream = file_processor._select_stream().index
 
-    assert selected_stream == s6
+    assert selected_stream == s6["index"]
 
 
 #########################################
@@ -244,7 +255,7 @@ def test_remap_command_respects_stream_order():
     for i, t in enumerate(tokens):
         if t.startswith("-map"):
             # the command following the -map should match the stream order (using the index)
-            assert tokens[i+1] == "0:{0}".format(stream_order[stream_index]["index"])
+            assert tokens[i+1] == "0:{0}".format(stream_order[stream_index].index)
             stream_index += 1
 
 
@@ -412,8 +423,8 @@ def test_subprocess_call(mock_rename):
     file_processor = testhelper.build_file_processor_for_streams([s1, s2])
 
     with unittest.mock.patch("streamix.logger") as mock_logger:
-        with unittest.mock.patch("streamix.FileProcessor._get_command") as mock_get_command:
-            mock_get_command.return_value = "ls -la"
+        with unittest.mock.patch("streamix.FileProcessor._get_command_args") as mock_get_command_args:
+            mock_get_command_args.return_value = ["ls", "-la"]
             file_processor.run()
 
         assert mock_logger.info.called
@@ -425,8 +436,8 @@ def test_command_with_client_json():
     file_processor = testhelper.build_file_processor_for_json_file("test-info_client.json")
 
     with unittest.mock.patch("streamix.os.rename"):
-        with unittest.mock.patch("streamix.pexpect.runu") as mock_run:
-            mock_run.return_value = "", 0
+        with unittest.mock.patch("streamix.run_command") as mock_run:
+            mock_run.return_value = streamix.CommandResult(0, "", [])
 
             with unittest.mock.patch("streamix.logger") as mock_logger:
                 file_processor.run()
@@ -437,3 +448,1650 @@ def test_command_with_client_json():
     ffmpeg_command = execution_message[len(executing_token):]
 
     assert ffmpeg_command == 'ffmpeg -i "file.mkv" -metadata title="file.mkv" -map 0:0 -map 0:1 -map 0:1 -c:0 copy -c:1 aac -b:1 1536000 -c:2 copy -strict experimental "file.tmp.mkv"'
+    assert mock_run.call_args[0][0] == ["ffmpeg", "-progress", "pipe:1", "-nostats", "-i", "file.mkv", "-metadata", "title=file.mkv",
+                                        "-map", "0:0", "-map", "0:1", "-map", "0:1",
+                                        "-c:0", "copy", "-c:1", "aac", "-b:1", "1536000", "-c:2", "copy",
+                                        "-strict", "experimental", "file.tmp.mkv"]
+
+
+#########################################
+#
+# Test file scanning
+#
+#########################################
+
+def _touch(path, size=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def test_walk_directory_yields_sorted_paths(tmp_path):
+    _touch(tmp_path / "b.mkv")
+    _touch(tmp_path / "a" / "z.mkv")
+    _touch(tmp_path / "a.mkv")
+    _touch(tmp_path / "a" / "b" / "c.mkv")
+
+    files = list(streamix.walk_directory(tmp_path, extensions=["mkv"]))
+
+    assert files == sorted(files)
+    assert len(files) == 4
+
+
+def test_walk_directory_filters_extensions(tmp_path):
+    _touch(tmp_path / "movie.mkv")
+    _touch(tmp_path / "movie.srt")
+    _touch(tmp_path / "movie.nfo")
+
+    files = list(streamix.walk_directory(tmp_path, extensions=["mkv"]))
+
+    assert files == [tmp_path / "movie.mkv"]
+
+
+def test_walk_directory_applies_exclude_hidden_and_min_size(tmp_path):
+    _touch(tmp_path / "keep.mkv", size=10)
+    _touch(tmp_path / "small.mkv", size=1)
+    _touch(tmp_path / ".hidden.mkv", size=10)
+    _touch(tmp_path / ".hidden" / "movie.mkv", size=10)
+    _touch(tmp_path / "Extras" / "movie.mkv", size=10)
+    _touch(tmp_path / "movie-sample.mkv", size=10)
+
+    files = list(streamix.walk_directory(tmp_path, extensions=["mkv"], exclude=["Extras", "*sample*"],
+                                         min_size=5, skip_hidden=True))
+
+    assert files == [tmp_path / "keep.mkv"]
+
+
+def test_collect_candidate_files_uses_scan_rules(tmp_path):
+    _touch(tmp_path / "movie.mkv", size=10)
+    _touch(tmp_path / "movie.srt", size=10)
+    _touch(tmp_path / "tiny.mkv", size=1)
+
+    scan_cfg = {"directories": [str(tmp_path)], "extensions": ["mkv"], "min_size": 5}
+    with unittest.mock.patch.dict(streamix.cfg, scan_cfg):
+        files = list(streamix.collect_candidate_files())
+
+    assert files == [tmp_path / "movie.mkv"]
+
+
+#########################################
+#
+# Test probe cache
+#
+#########################################
+
+def test_probe_cache_round_trips_compact_info(tmp_path):
+    with io.open("test-info_client.json") as f:
+        info = json.load(f)
+
+    cache = streamix.ProbeCache(tmp_path / "cache.db")
+    cache.put((1, 2, 3, 4), info)
+    cached = cache.get((1, 2, 3, 4))
+    cache.close()
+
+    assert [s["index"] for s in cached["streams"]] == [s["index"] for s in info["streams"]]
+    assert cached["streams"][1] == {"index": 1, "codec_type": "audio", "codec_name": "dca", "bit_rate": "1536000",
+                                    "tags": {"language": "eng"}, "disposition": {"default": 1, "forced": 0}}
+    assert cached["format"]["duration"] == info["format"]["duration"]
+
+
+def test_probe_cache_misses_entries_of_an_older_version(tmp_path):
+    cache = streamix.ProbeCache(tmp_path / "cache.db")
+    cache._db.execute("INSERT INTO probes VALUES (1, 2, 3, 4, ?, 0)", (json.dumps({"streams": [], "format": {}}),))
+
+    assert cache.get((1, 2, 3, 4)) is None
+    cache.close()
+
+
+def test_probe_cache_hit_skips_ffprobe(tmp_path):
+    video = _touch(tmp_path / "file.mkv", size=10)
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac")])
+    cache = streamix.ProbeCache(tmp_path / "cache.db")
+
+    with unittest.mock.patch("streamix.FileProcessor._probe_file") as mock_probe:
+        mock_probe.return_value = info
+        streamix.FileProcessor(video, probe_cache=cache)
+        processor = streamix.FileProcessor(video, probe_cache=cache)
+
+    assert mock_probe.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert processor.state == streamix.FileState.Skip
+
+
+def test_probe_cache_misses_when_file_changes(tmp_path):
+    video = _touch(tmp_path / "file.mkv", size=10)
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac")])
+    cache = streamix.ProbeCache(tmp_path / "cache.db")
+
+    with unittest.mock.patch("streamix.FileProcessor._probe_file") as mock_probe:
+        mock_probe.return_value = info
+        streamix.FileProcessor(video, probe_cache=cache)
+        _touch(video, size=20)
+        streamix.FileProcessor(video, probe_cache=cache)
+
+    assert mock_probe.call_count == 2
+
+
+def test_probe_cache_refresh_always_probes(tmp_path):
+    cache = streamix.ProbeCache(tmp_path / "cache.db", refresh=True)
+    cache.put((1, 2, 3, 4), {"streams": []})
+
+    assert cache.get((1, 2, 3, 4)) is None
+    assert cache.misses == 1
+
+
+def test_probe_cache_evicts_least_recently_used(tmp_path):
+    cache = streamix.ProbeCache(tmp_path / "cache.db", max_entries=2)
+    for i in range(5):
+        cache.put((i, i, i, i), {"streams": []})
+    cache.close()
+
+    cache = streamix.ProbeCache(tmp_path / "cache.db", max_entries=2)
+    assert len(cache) == 2
+    assert cache.get((4, 4, 4, 4)) is not None
+    assert cache.get((0, 0, 0, 0)) is None
+
+
+#########################################
+#
+# Test concurrent probing
+#
+#########################################
+
+def test_probe_files_keeps_input_order():
+    def slow_probe(processor):
+        # make the earlier files the slowest so they finish last
+        time.sleep(0.01 * (10 - int(processor.file_path.stem)))
+        return {}
+
+    files = [streamix.pathlib.Path("{0}.mkv".format(i)) for i in range(10)]
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", autospec=True, side_effect=slow_probe):
+        processors = list(streamix.probe_files(files, workers=4))
+
+    assert [p.file_path for p in processors] == files
+
+
+def test_probe_files_runs_probes_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    def blocking_probe(processor):
+        # only returns once three probes are running at the same time
+        barrier.wait()
+        return {}
+
+    files = [streamix.pathlib.Path("{0}.mkv".format(i)) for i in range(3)]
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", autospec=True, side_effect=blocking_probe):
+        processors = list(streamix.probe_files(files, workers=3))
+
+    assert len(processors) == 3
+
+
+def test_probe_files_skips_failed_files():
+    def failing_probe(processor):
+        if processor.file_path.stem == "1":
+            raise RuntimeError("probe failed")
+        return {}
+
+    files = [streamix.pathlib.Path("{0}.mkv".format(i)) for i in range(3)]
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", autospec=True, side_effect=failing_probe):
+        processors = list(streamix.probe_files(files, workers=2))
+
+    assert [p.file_path.stem for p in processors] == ["0", "2"]
+
+
+#########################################
+#
+# Test encode scheduler
+#
+#########################################
+
+class FakeJob(object):
+    def __init__(self, state, run=None):
+        self.state = state
+        self.file_path = streamix.pathlib.Path("file.mkv")
+        self.dry_run = False
+        self._run = run
+
+    def run(self, status=None, governor=None):
+        return self._run() if self._run is not None else True
+
+
+def test_scheduler_remaps_do_not_wait_for_conversions():
+    convert_started = threading.Event()
+    release_convert = threading.Event()
+    remaps_done = []
+
+    def slow_convert():
+        convert_started.set()
+        assert release_convert.wait(5)
+        return True
+
+    def remap():
+        remaps_done.append(True)
+        if len(remaps_done) == 3:
+            release_convert.set()
+        return True
+
+    scheduler = streamix.EncodeScheduler(remap_workers=1, convert_workers=1)
+    scheduler.submit(FakeJob(streamix.FileState.Convert, slow_convert))
+    assert convert_started.wait(5)
+    for _ in range(3):
+        scheduler.submit(FakeJob(streamix.FileState.Remap, remap))
+    scheduler.join()
+
+    assert len(remaps_done) == 3
+    assert scheduler.processed == 4
+
+
+def test_scheduler_counts_failures_separately():
+    def raise_error():
+        raise RuntimeError("ffmpeg crashed")
+
+    scheduler = streamix.EncodeScheduler(remap_workers=2, convert_workers=2)
+    scheduler.submit(FakeJob(streamix.FileState.Remap))
+    scheduler.submit(FakeJob(streamix.FileState.Remap, lambda: False))
+    scheduler.submit(FakeJob(streamix.FileState.Convert, raise_error))
+    scheduler.submit(FakeJob(streamix.FileState.Convert))
+    scheduler.join()
+
+    assert scheduler.processed == 2
+    assert scheduler.failed == 2
+
+
+@unittest.mock.patch("streamix.os.rename")
+def test_run_returns_false_when_ffmpeg_fails(mock_rename):
+    file_processor = testhelper.build_file_processor_for_json_file("test-info_client.json")
+
+    with unittest.mock.patch("streamix.run_command") as mock_run:
+        mock_run.return_value = streamix.CommandResult(1, "", ["error"])
+        with unittest.mock.patch("streamix.FileProcessor._cleanup_failed_run") as mock_cleanup:
+            assert file_processor.run() is False
+
+    assert mock_cleanup.called
+    assert not mock_rename.called
+
+
+#########################################
+#
+# Test pipeline
+#
+#########################################
+
+def test_first_file_is_processed_before_scan_finishes():
+    first_run = threading.Event()
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                                  testhelper.build_audio_stream("abc", language="eng")])
+
+    def scan():
+        yield streamix.pathlib.Path("0.mkv")
+        # the scan only continues once the first file has started processing
+        assert first_run.wait(5)
+        yield streamix.pathlib.Path("1.mkv")
+
+    def run(processor, status=None, governor=None):
+        first_run.set()
+        return True
+
+    streamix.load_config()
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", return_value=info):
+        with unittest.mock.patch("streamix.FileProcessor.run", autospec=True, side_effect=run):
+            checked, scheduler = streamix.process_files(scan())
+
+    assert checked == 2
+    assert scheduler.processed == 2
+
+
+def test_buffered_is_bounded():
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    consumer = streamix.buffered(items(), maxsize=5)
+    assert next(consumer) == 0
+    time.sleep(0.1)
+
+    # the first item, the five queued items and the one waiting to be queued
+    assert len(produced) <= 7
+    assert list(consumer) == list(range(1, 100))
+
+
+def test_buffered_raises_producer_errors():
+    def items():
+        yield 1
+        raise RuntimeError("scan failed")
+
+    consumer = streamix.buffered(items(), maxsize=5)
+
+    assert next(consumer) == 1
+    try:
+        next(consumer)
+        assert False, "expected the producer error"
+    except RuntimeError:
+        pass
+
+
+#########################################
+#
+# Test command runner
+#
+#########################################
+
+def test_run_command_captures_output():
+    result = streamix.run_command([sys.executable, "-c", "import json; print(json.dumps({'streams': []}))"], capture_output=True)
+
+    assert result.code == 0
+    assert json.loads(result.output) == {"streams": []}
+
+
+def test_run_command_streams_lines_and_keeps_tail():
+    lines = []
+    script = "import sys\nfor i in range(100): print(i, file=sys.stderr)\nsys.exit(3)"
+    result = streamix.run_command([sys.executable, "-c", script], on_line=lines.append, tail_lines=5)
+
+    assert result.code == 3
+    assert lines == [str(i) for i in range(100)]
+    assert result.tail == ["95", "96", "97", "98", "99"]
+
+
+def test_run_command_kills_on_timeout():
+    start = time.time()
+    try:
+        streamix.run_command([sys.executable, "-c", "import time; time.sleep(30)"], timeout=0.5)
+        assert False, "expected a timeout"
+    except streamix.subprocess.TimeoutExpired:
+        pass
+
+    assert time.time() - start < 10
+
+
+#########################################
+#
+# Test progress
+#
+#########################################
+
+def _progress_block(out_time_us, speed, total_size):
+    return ["fps=250.0", "total_size={0}".format(total_size), "out_time_us={0}".format(out_time_us),
+            "out_time=00:00:00.000000", "speed={0}x".format(speed), "progress=continue"]
+
+
+def test_progress_reports_percent_and_eta():
+    progress = streamix.EncodeProgress(streamix.pathlib.Path("file.mkv"), duration=100.0)
+
+    for line in _progress_block(25000000, 5.0, 1000):
+        progress.feed(line)
+
+    assert progress.percent == 25.0
+    assert progress.eta == 15.0
+    assert progress.fps == 250.0
+    assert progress.total_size == 1000
+
+
+def test_progress_without_duration_has_no_percent():
+    progress = streamix.EncodeProgress(streamix.pathlib.Path("file.mkv"), duration=None)
+
+    for line in _progress_block(25000000, 5.0, 1000):
+        progress.feed(line)
+
+    assert progress.percent is None
+
+
+def test_run_status_writes_status_file(tmp_path):
+    status_file = tmp_path / "status.json"
+    status = streamix.RunStatus(status_file, interval_secs=0)
+    progress = streamix.EncodeProgress(streamix.pathlib.Path("file.mkv"), 100.0, status)
+
+    for line in _progress_block(50000000, 2.0, 5000000):
+        progress.feed(line)
+
+    with io.open(str(status_file)) as f:
+        running = json.load(f)
+    progress.finish()
+    with io.open(str(status_file)) as f:
+        finished = json.load(f)
+
+    assert running["active"][0]["percent"] == 50.0
+    assert finished["active"] == []
+    assert finished["files_done"] == 1
+    assert finished["bytes_written"] == 5000000
+    assert finished["realtime_factor"] > 0
+
+
+def test_run_status_is_written_safely_from_many_workers(tmp_path):
+    status_file = tmp_path / "status.json"
+    status = streamix.RunStatus(status_file, interval_secs=0)
+
+    def work():
+        for _ in range(100):
+            progress = streamix.EncodeProgress(streamix.pathlib.Path("file.mkv"), 100.0, status)
+            progress.finish()
+
+    with unittest.mock.patch.object(streamix.logger, "exception") as mock_exception:
+        workers = [threading.Thread(target=work) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    assert not mock_exception.called
+    with io.open(str(status_file)) as f:
+        assert json.load(f)["files_done"] == 400
+
+
+@unittest.mock.patch("streamix.os.rename")
+def test_run_feeds_ffmpeg_progress(mock_rename):
+    file_processor = testhelper.build_file_processor_for_json_file("test-info_client.json")
+    status = streamix.RunStatus()
+
+    def fake_run(args, on_output_line=None, **kwargs):
+        for line in _progress_block(3714112500, 1.0, 1000):
+            on_output_line(line)
+        return streamix.CommandResult(0, "", [])
+
+    with unittest.mock.patch("streamix.run_command", side_effect=fake_run):
+        assert file_processor.run(status)
+
+    snapshot = status.snapshot()
+    assert snapshot["files_done"] == 1
+    assert snapshot["bytes_written"] == 1000
+
+
+#########################################
+#
+# Test journal
+#
+#########################################
+
+def _build_journaled_processor(video, streams):
+    with unittest.mock.patch("streamix.FileProcessor._probe_file") as mock_probe:
+        mock_probe.return_value = testhelper.build_info(streams)
+        return streamix.FileProcessor(video)
+
+
+def test_journal_skips_completed_files_until_they_change(tmp_path):
+    streamix.load_config()
+    video = _touch(tmp_path / "file.mkv", size=10)
+    journal = streamix.Journal(tmp_path / "journal.db")
+    processor = _build_journaled_processor(video, [testhelper.build_video_stream(),
+                                                   testhelper.build_audio_stream("aac")])
+
+    journal.record_decision(processor)
+    assert list(journal.pending([video])) == []
+    assert journal.resumed == 1
+
+    _touch(video, size=20)
+    assert list(journal.pending([video])) == [video]
+
+
+def test_journal_does_not_skip_files_still_to_process(tmp_path):
+    streamix.load_config()
+    video = _touch(tmp_path / "file.mkv", size=10)
+    journal = streamix.Journal(tmp_path / "journal.db")
+    processor = _build_journaled_processor(video, [testhelper.build_video_stream(),
+                                                   testhelper.build_audio_stream("aac"),
+                                                   testhelper.build_audio_stream("aac", language="eng")])
+
+    journal.record_decision(processor)
+    assert list(journal.pending([video])) == [video]
+
+    journal.record_started(processor)
+    journal.record_finished(processor, succeeded=True)
+    assert list(journal.pending([video])) == []
+
+
+def test_journal_reclaims_interrupted_temp_files(tmp_path):
+    streamix.load_config()
+    video = _touch(tmp_path / "file.mkv", size=10)
+    processor = _build_journaled_processor(video, [testhelper.build_video_stream(),
+                                                   testhelper.build_audio_stream("aac"),
+                                                   testhelper.build_audio_stream("aac", language="eng")])
+
+    journal = streamix.Journal(tmp_path / "journal.db")
+    journal.record_started(processor)
+    _touch(processor.temp_file_name, size=5)
+    journal.close()
+
+    # a new run after the crash
+    journal = streamix.Journal(tmp_path / "journal.db")
+
+    assert journal.reclaim_interrupted() == 1
+    assert not processor.temp_file_name.exists()
+    assert video.exists()
+    assert list(journal.pending([video])) == [video]
+
+
+def test_walk_directory_leaves_out_temp_files(tmp_path):
+    _touch(tmp_path / "file.mkv")
+    _touch(tmp_path / "file.tmp.mkv")
+
+    files = list(streamix.walk_directory(tmp_path, extensions=["mkv"]))
+
+    assert files == [tmp_path / "file.mkv"]
+
+
+#########################################
+#
+# Test watch mode
+#
+#########################################
+
+def test_stable_files_waits_for_debounce(tmp_path):
+    video = _touch(tmp_path / "file.mkv", size=10)
+    stable = streamix.StableFiles(debounce_secs=0.2)
+    stable.add(video)
+
+    # the first check only records the size and modified time
+    assert stable.ready() == []
+    assert stable.ready() == []
+
+    time.sleep(0.25)
+    assert stable.ready() == [video]
+    assert len(stable) == 0
+
+
+def test_stable_files_restarts_debounce_when_file_grows(tmp_path):
+    video = _touch(tmp_path / "file.mkv", size=10)
+    stable = streamix.StableFiles(debounce_secs=0.2)
+    stable.add(video)
+    stable.ready()
+
+    time.sleep(0.25)
+    _touch(video, size=20)
+
+    assert stable.ready() == []
+    assert len(stable) == 1
+
+
+def test_inotify_watcher_reports_new_files(tmp_path):
+    watcher = streamix.InotifyWatcher([tmp_path])
+    try:
+        video = _touch(tmp_path / "new" / "file.mkv", size=10)
+        changed = []
+        for _ in range(10):
+            changed.extend(watcher.changes(timeout=0.2))
+            if str(video) in changed:
+                break
+    finally:
+        watcher.close()
+
+    assert str(video) in changed
+
+
+def test_polling_watcher_reports_new_files(tmp_path):
+    _touch(tmp_path / "old.mkv", size=10)
+    watcher = streamix.PollingWatcher([tmp_path], interval_secs=0, rules={"extensions": ["mkv"]})
+
+    video = _touch(tmp_path / "new.mkv", size=10)
+
+    assert watcher.changes(timeout=1) == [video]
+
+
+def test_watch_directories_processes_new_files(tmp_path):
+    streamix.load_config()
+    watch_cfg = {"directories": [str(tmp_path)], "extensions": ["mkv"], "watch_mode": "poll",
+                 "watch_poll_secs": 0, "watch_debounce_secs": 0}
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                                  testhelper.build_audio_stream("aac", language="eng")])
+    stop = threading.Event()
+    processed = []
+
+    def run(processor, status=None, governor=None):
+        processed.append(processor.file_path)
+        stop.set()
+        return True
+
+    with unittest.mock.patch.dict(streamix.cfg, watch_cfg):
+        with unittest.mock.patch("streamix.FileProcessor._probe_file", return_value=info):
+            with unittest.mock.patch("streamix.FileProcessor.run", autospec=True, side_effect=run):
+                watcher = threading.Thread(target=streamix.watch_directories, kwargs={"stop": stop})
+                watcher.start()
+                time.sleep(0.1)
+                video = _touch(tmp_path / "file.mkv", size=10)
+                watcher.join(10)
+
+    assert not watcher.is_alive()
+    assert processed == [video]
+
+
+#########################################
+#
+# Test benchmarks
+#
+#########################################
+
+def test_benchmark_decisions_runs():
+    streamix.load_config()
+
+    result = bench_streamix.bench_decisions(200)
+
+    assert sum(result["states"].values()) == 200
+
+
+def test_benchmark_pipeline_runs_with_stubs():
+    streamix.load_config()
+
+    with unittest.mock.patch.dict(streamix.os.environ):
+        with unittest.mock.patch.dict(streamix.cfg):
+            result = bench_streamix.bench_pipeline(4, probe_workers=2)
+
+    assert result["scanned"] == 4
+    assert result["checked"] == 4
+    assert result["failed"] == 0
+
+
+#########################################
+#
+# Test stream records
+#
+#########################################
+
+def test_stream_records_are_normalized_once():
+    stream = streamix.Stream({"index": 3, "codec_type": "Audio", "codec_name": "AAC", "bit_rate": "480000",
+                              "tags": {"language": "ENG"}}, ["aac"])
+
+    assert (stream.index, stream.codec_type, stream.codec, stream.language, stream.bitrate) == \
+        (3, "audio", "aac", "eng", 480000)
+    assert stream.is_safe() and stream.is_eng() and stream.is_audio()
+    assert not hasattr(stream, "__dict__")
+
+
+def test_stream_unknown_language_is_not_eng_or_non_eng():
+    stream = streamix.Stream({"codec_type": "subtitle", "tags": {}}, [])
+
+    assert not stream.is_eng()
+    assert not stream.non_eng()
+
+
+def test_stream_bad_bitrate_only_fails_when_used():
+    stream = streamix.Stream({"codec_type": "audio", "bit_rate": "N/A"}, [])
+
+    try:
+        stream.get_bitrate()
+        assert False, "expected the bitrate to be unparseable"
+    except Exception as e:
+        assert "bitrate" in str(e)
+
+
+def test_processor_drops_raw_probe_json():
+    file_processor = testhelper.build_file_processor_for_json_file("test-info_client.json")
+
+    assert file_processor.file_info is None
+    assert file_processor.duration == 7428.225
+    assert [s.index for s in file_processor.file_streams.streams] == [0, 1]
+
+
+#########################################
+#
+# Test batch planning
+#
+#########################################
+
+def _processor_plan(name, info):
+    processor = streamix.FileProcessor(streamix.pathlib.Path(name), file_info=info)
+    if processor.state == streamix.FileState.Remap:
+        return processor.state, processor.file_streams.first_safe_eng().index
+    if processor.state == streamix.FileState.Convert:
+        try:
+            return processor.state, processor._select_stream().index
+        except Exception:
+            return processor.state, None
+    return processor.state, None
+
+
+def test_plan_batch_matches_file_processor_on_fixtures():
+    streamix.load_config()
+    infos = []
+    for fixture in ("test-info_client.json", "test-info_en.json", "test-info_fr.json"):
+        with io.open(fixture) as f:
+            infos.append(json.load(f))
+    names = ["a.mkv", "b.mkv", "c.srt"]
+
+    plans = streamix.plan_batch(streamix.StreamColumns.from_infos(infos, names), streamix.cfg["safe_codecs"],
+                                streamix.cfg["audio_codec_priority"], streamix.cfg["extensions"])
+
+    assert plans == [_processor_plan(n, i) for n, i in zip(names, infos)]
+    assert plans[0] == (streamix.FileState.Convert, 1)
+    assert plans[2] == (streamix.FileState.Ignore, None)
+
+
+def test_plan_batch_matches_file_processor_on_synthetic_corpus():
+    streamix.load_config()
+    infos = list(synthetic_probe.generate_corpus(3000, seed=7, max_audio=8))
+    # mix in streams without language tags or with unparseable bitrates
+    infos[0]["streams"][1]["bit_rate"] = "N/A"
+    names = ["{0}.mkv".format(i) for i in range(len(infos))]
+
+    plans = streamix.plan_batch(streamix.StreamColumns.from_infos(infos, names), streamix.cfg["safe_codecs"],
+                                streamix.cfg["audio_codec_priority"], streamix.cfg["extensions"])
+
+    expected = [_processor_plan(n, i) for n, i in zip(names, infos)]
+    assert plans == expected
+    assert {state for state, _ in plans} >= {streamix.FileState.Skip, streamix.FileState.Remap,
+                                              streamix.FileState.Convert}
+
+
+#########################################
+#
+# Test plan and apply
+#
+#########################################
+
+def _plan_library(tmp_path, links=False):
+    streamix.load_config()
+    streamix.cfg["dry-run"] = False
+    remap = _touch(tmp_path / "remap.mkv", size=10)
+    skip = _touch(tmp_path / "skip.mkv", size=10)
+    file_paths = [remap, skip]
+    if links:
+        os.link(str(remap), str(tmp_path / "remap-link.mkv"))
+        file_paths.append(tmp_path / "remap-link.mkv")
+    infos = {str(remap): testhelper.build_info([testhelper.build_video_stream(),
+                                                testhelper.build_audio_stream("aac"),
+                                                testhelper.build_audio_stream("aac", language="eng")]),
+             str(skip): testhelper.build_info([testhelper.build_video_stream(),
+                                               testhelper.build_audio_stream("aac", language="eng")])}
+
+    plan_file = tmp_path / "plan.jsonl"
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", autospec=True,
+                             side_effect=lambda p: infos[str(p.file_path)]):
+        checked, planned = streamix.write_plan(plan_file, file_paths)
+
+    assert (checked, planned) == (2, 1)
+    return plan_file, remap
+
+
+def test_plan_classifies_cached_files_in_batches(tmp_path):
+    streamix.load_config()
+    remap = _touch(tmp_path / "remap.mkv", size=10)
+    skip = _touch(tmp_path / "skip.mkv", size=20)
+    missed = _touch(tmp_path / "missed.mkv", size=30)
+    cache = streamix.ProbeCache(tmp_path / "cache.db")
+    cache.put(streamix.file_identity(remap), testhelper.build_info(
+        [testhelper.build_video_stream(), testhelper.build_audio_stream("dts"),
+         testhelper.build_audio_stream("aac", language="eng")]))
+    cache.put(streamix.file_identity(skip), testhelper.build_info(
+        [testhelper.build_video_stream(), testhelper.build_audio_stream("aac", language="eng")]))
+    plan_file = tmp_path / "plan.jsonl"
+
+    probed = []
+    with unittest.mock.patch("streamix.FileProcessor._read_file_info", autospec=True,
+                             side_effect=lambda p: probed.append(p.file_path) or {}), \
+            unittest.mock.patch("streamix.plan_batch", wraps=streamix.plan_batch) as mock_plan_batch:
+        checked, planned = streamix.write_plan(plan_file, [remap, skip, missed], probe_cache=cache)
+    cache.close()
+
+    assert (checked, planned) == (3, 1)
+    # only the file missing from the cache is probed
+    assert probed == [missed]
+    assert mock_plan_batch.call_count == 1
+    with io.open(str(plan_file)) as f:
+        assert [json.loads(line)["path"] for line in f] == [str(remap)]
+
+
+def test_plan_writes_only_files_to_process(tmp_path):
+    plan_file, remap = _plan_library(tmp_path)
+
+    with io.open(str(plan_file)) as f:
+        entries = [json.loads(line) for line in f]
+
+    assert len(entries) == 1
+    assert entries[0]["path"] == str(remap)
+    assert entries[0]["state"] == streamix.FileState.Remap
+    assert entries[0]["identity"] == list(streamix.file_identity(remap))
+    assert entries[0]["args"][0] == "ffmpeg"
+    assert entries[0]["cost"] > 0
+
+
+@unittest.mock.patch("streamix.os.rename")
+@unittest.mock.patch("streamix.run_command")
+def test_apply_runs_planned_commands_without_probing(mock_run_command, mock_rename, tmp_path):
+    plan_file, remap = _plan_library(tmp_path)
+    mock_run_command.return_value = streamix.CommandResult(0, "", [])
+    journal = streamix.Journal(tmp_path / "journal.db")
+
+    with unittest.mock.patch("streamix.FileProcessor._probe_file") as mock_probe:
+        checked, changed, scheduler = streamix.apply_plan(plan_file, journal=journal)
+        assert not mock_probe.called
+
+    assert (checked, changed, scheduler.processed, scheduler.failed) == (1, 0, 1, 0)
+    assert mock_run_command.call_args[0][0][-1] == str(tmp_path / "remap.tmp.mkv")
+
+    # applying again resumes from the journal and runs nothing
+    checked, changed, scheduler = streamix.apply_plan(plan_file, journal=journal)
+    assert scheduler.processed == 0
+    assert journal.resumed == 1
+
+
+def test_planned_job_places_the_planned_output(tmp_path):
+    planned_output = str(tmp_path / "scratch" / "remap.0badf00d.tmp.mkv")
+    entry = {"path": str(tmp_path / "remap.mkv"), "identity": [1, 2, 3, 4], "state": streamix.FileState.Remap,
+             "args": ["ffmpeg", "-i", str(tmp_path / "remap.mkv"), planned_output], "temp_file": planned_output}
+    # the scratch directory changed since planning
+    job = streamix.PlannedJob(entry, config=testhelper.build_config(scratch_dir=str(tmp_path / "other")))
+
+    with unittest.mock.patch("streamix.run_command", return_value=streamix.CommandResult(0, "", [])), \
+            unittest.mock.patch("streamix.place_file", return_value="rename") as mock_place:
+        assert job.run()
+
+    mock_place.assert_called_once_with(planned_output, entry["path"])
+    # plans written before the temp file was stored
+    del entry["temp_file"]
+    assert str(streamix.PlannedJob(entry).temp_file_name) == planned_output
+
+
+def test_planned_job_has_the_settings_of_a_probed_file():
+    config = testhelper.build_config(audio_min_bitrate=1000)
+    entry = {"path": "/library/remap.mkv", "identity": [1, 2, 3, 4], "state": streamix.FileState.Remap,
+             "args": ["ffmpeg", "-i", "/library/remap.mkv", "/library/remap.tmp.mkv"]}
+    job = streamix.PlannedJob(entry, config=config)
+    processor = testhelper.build_file_processor_for_streams([testhelper.build_video_stream()], config=config)
+
+    for name in ("dry_run", "extensions", "safe_codecs", "codec_priority", "codec_ranks", "min_bit_rate"):
+        assert getattr(job, name) == getattr(processor, name), name
+    assert job.min_bit_rate == 1000
+
+
+@unittest.mock.patch("streamix.run_command")
+def test_apply_skips_files_changed_since_planning(mock_run_command, tmp_path):
+    plan_file, remap = _plan_library(tmp_path)
+    _touch(remap, size=20)
+
+    checked, changed, scheduler = streamix.apply_plan(plan_file)
+
+    assert (checked, changed, scheduler.processed) == (1, 1, 0)
+    assert not mock_run_command.called
+
+
+#########################################
+#
+# Test tiered probe
+#
+#########################################
+
+def _probe_with(tmp_path, infos):
+    """Probe a file with ffprobe mocked to return the given infos in turn, returning the processor and the calls"""
+    streamix.load_config()
+    video = _touch(tmp_path / "file.mkv")
+    results = [streamix.CommandResult(0, json.dumps(info), []) for info in infos]
+
+    with unittest.mock.patch("streamix.run_command", side_effect=results) as mock_run_command:
+        processor = streamix.FileProcessor(video)
+
+    return processor, [c[0][0] for c in mock_run_command.call_args_list]
+
+
+def test_fast_probe_asks_only_for_decision_fields(tmp_path):
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                                  testhelper.build_audio_stream("aac", language="eng")])
+    processor, calls = _probe_with(tmp_path, [info])
+
+    assert processor.state == streamix.FileState.Remap
+    assert len(calls) == 1
+    assert "-show_entries" in calls[0]
+    assert "-probesize" in calls[0]
+    assert "-show_streams" not in calls[0]
+
+
+def test_fast_probe_escalates_when_conversion_lacks_bitrates(tmp_path):
+    fast_streams = [testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                    testhelper.build_audio_stream("dts", language="eng"),
+                    testhelper.build_audio_stream("dts", language="eng")]
+    for s in fast_streams:
+        s.pop("bit_rate", None)
+
+    deep_streams = [testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                    testhelper.build_audio_stream("dts", language="eng", bitrate=400000),
+                    testhelper.build_audio_stream("dts", language="eng", bitrate=500000)]
+
+    processor, calls = _probe_with(tmp_path, [testhelper.build_info(fast_streams),
+                                              testhelper.build_info(deep_streams)])
+
+    assert processor.state == streamix.FileState.Convert
+    assert len(calls) == 2
+    assert "-show_streams" in calls[1]
+    assert processor._select_stream().index == 3
+
+
+def test_fast_probe_does_not_escalate_for_remap_without_bitrates(tmp_path):
+    streams = [testhelper.build_video_stream(), testhelper.build_audio_stream("dts"),
+               testhelper.build_audio_stream("aac", language="eng")]
+    for s in streams:
+        s.pop("bit_rate", None)
+
+    processor, calls = _probe_with(tmp_path, [testhelper.build_info(streams)])
+
+    assert processor.state == streamix.FileState.Remap
+    assert len(calls) == 1
+
+
+#########################################
+#
+# Test scratch directory
+#
+#########################################
+
+def _cross_device_rename(scratch_dir):
+    """os.rename failing like it does when moving out of the scratch directory to another filesystem"""
+    real_rename = streamix.os.rename
+
+    def rename(source, target):
+        if str(source).startswith(str(scratch_dir)):
+            raise OSError(streamix.errno.EXDEV, "Invalid cross-device link")
+        real_rename(source, target)
+
+    return rename
+
+
+def test_temp_file_is_in_the_scratch_dir(tmp_path):
+    config = testhelper.build_config(scratch_dir=str(tmp_path / "scratch"))
+    first = testhelper.build_file_processor_for_streams([], "a/file.mkv", config)
+    second = testhelper.build_file_processor_for_streams([], "b/file.mkv", config)
+
+    assert first.temp_file_name.parent == tmp_path / "scratch"
+    assert first.temp_file_name != second.temp_file_name
+    assert streamix.is_temp_file(first.temp_file_name.name)
+
+
+def test_place_file_renames_on_the_same_filesystem(tmp_path):
+    source = tmp_path / "file.tmp.mkv"
+    source.write_bytes(b"new")
+    target = tmp_path / "file.mkv"
+    target.write_bytes(b"old")
+
+    assert streamix.place_file(str(source), str(target)) == "rename"
+    assert target.read_bytes() == b"new"
+    assert not source.exists()
+
+
+def test_place_file_copies_across_filesystems(tmp_path):
+    source = _touch(tmp_path / "scratch" / "file.1234.tmp.mkv")
+    source.write_bytes(b"new" * 1000)
+    target = _touch(tmp_path / "library" / "file.mkv")
+
+    with unittest.mock.patch("streamix.os.rename", side_effect=_cross_device_rename(tmp_path / "scratch")):
+        method = streamix.place_file(str(source), str(target))
+
+    assert method in ("reflink", "copy_file_range", "copy")
+    assert target.read_bytes() == b"new" * 1000
+    assert not source.exists()
+    assert sorted(p.name for p in target.parent.iterdir()) == ["file.mkv"]
+
+
+def test_place_file_falls_back_to_a_buffered_copy(tmp_path):
+    source = _touch(tmp_path / "scratch" / "file.1234.tmp.mkv")
+    source.write_bytes(b"new" * 1000)
+    target = _touch(tmp_path / "library" / "file.mkv")
+
+    with unittest.mock.patch("streamix.os.rename", side_effect=_cross_device_rename(tmp_path / "scratch")), \
+            unittest.mock.patch("streamix.fcntl.ioctl", side_effect=OSError(streamix.errno.EXDEV, "")), \
+            unittest.mock.patch("streamix.os.copy_file_range", side_effect=OSError(streamix.errno.EXDEV, "")):
+        assert streamix.place_file(str(source), str(target)) == "copy"
+
+    assert target.read_bytes() == b"new" * 1000
+
+
+def test_failed_copy_leaves_the_source_untouched(tmp_path):
+    source = _touch(tmp_path / "scratch" / "file.1234.tmp.mkv")
+    target = _touch(tmp_path / "library" / "file.mkv")
+    target.write_bytes(b"old")
+
+    with unittest.mock.patch("streamix.os.rename", side_effect=_cross_device_rename(tmp_path / "scratch")), \
+            unittest.mock.patch("streamix._copy_file", side_effect=OSError(streamix.errno.ENOSPC, "")):
+        try:
+            streamix.place_file(str(source), str(target))
+            assert False, "expected the copy error"
+        except OSError:
+            pass
+
+    assert target.read_bytes() == b"old"
+    assert source.exists()
+    assert sorted(p.name for p in target.parent.iterdir()) == ["file.mkv"]
+
+
+#########################################
+#
+# Test job order
+#
+#########################################
+
+class CostJob(FakeJob):
+    def __init__(self, name, cost, run=None):
+        super().__init__(streamix.FileState.Convert, run)
+        self.file_path = streamix.pathlib.Path(name)
+        self.cost = cost
+
+    def estimate_cost(self):
+        return self.cost
+
+    def modified_ns(self):
+        return int(self.cost)
+
+
+def _run_in_order(order, costs):
+    """Run the jobs on one worker, queued up while a first job holds it, returning the names in the order run"""
+    release = threading.Event()
+    ran = []
+    scheduler = streamix.EncodeScheduler(convert_workers=1, order=order)
+
+    scheduler.submit(CostJob("first", 0, run=lambda: release.wait(5)))
+    for name, cost in costs:
+        scheduler.submit(CostJob(name, cost, run=lambda name=name: ran.append(name) or True))
+    release.set()
+    scheduler.join()
+
+    return ran
+
+
+def test_scheduler_runs_jobs_in_the_configured_order():
+    streamix.load_config()
+    costs = [("b", 30), ("a", 10), ("c", 20)]
+
+    assert _run_in_order("scan", costs) == ["b", "a", "c"]
+    assert _run_in_order("cheapest", costs) == ["a", "c", "b"]
+    assert _run_in_order("longest", costs) == ["b", "c", "a"]
+    assert _run_in_order("newest", costs) == ["b", "c", "a"]
+
+
+def test_unknown_job_order_is_an_error():
+    try:
+        streamix.job_order("random")
+        assert False, "expected an error for the unknown order"
+    except ValueError:
+        pass
+
+
+def test_conversions_cost_more_than_remaps_of_the_same_file():
+    streams = [testhelper.build_video_stream(), testhelper.build_audio_stream("dts"),
+               testhelper.build_audio_stream("dts", language="eng", bitrate=500000)]
+    convert = testhelper.build_file_processor_for_info(
+        {"streams": streams, "format": {"duration": "3600", "bit_rate": "8000000"}})
+    remap = testhelper.build_file_processor_for_info(
+        {"streams": streams[:2] + [testhelper.build_audio_stream("aac", language="eng")],
+         "format": {"duration": "3600", "bit_rate": "8000000"}})
+
+    assert convert.state == streamix.FileState.Convert
+    assert remap.state == streamix.FileState.Remap
+    # 3.6GB copied at 100MB/s, plus an hour of audio at 20x realtime for the conversion
+    assert remap.estimate_cost() == 36
+    assert convert.estimate_cost() == 36 + 180
+
+
+#########################################
+#
+# Test device limits
+#
+#########################################
+
+def _device_of(file_path):
+    """The test jobs are on the device named by the first letter of their name"""
+    return str(file_path)[0]
+
+
+@unittest.mock.patch("streamix.DeviceMap.key", side_effect=_device_of)
+def test_scheduler_takes_turns_between_devices(mock_key):
+    streamix.load_config()
+    costs = [("a1", 0), ("a2", 0), ("a3", 0), ("b1", 0), ("b2", 0)]
+
+    assert _run_in_order("scan", costs) == ["a1", "b1", "a2", "b2", "a3"]
+
+
+@unittest.mock.patch("streamix.DeviceMap.key", side_effect=_device_of)
+def test_scheduler_limits_the_jobs_per_device(mock_key):
+    lock = threading.Lock()
+    active = collections.Counter()
+    most = collections.Counter()
+
+    def run(device):
+        with lock:
+            active[device] += 1
+            most[device] = max(most[device], active[device])
+        time.sleep(0.01)
+        with lock:
+            active[device] -= 1
+        return True
+
+    with unittest.mock.patch.dict(streamix.cfg, {"device_encode_workers": 1}):
+        scheduler = streamix.EncodeScheduler(remap_workers=4, convert_workers=4)
+    for i in range(6):
+        for device in "ab":
+            job = CostJob("{0}{1}".format(device, i), 0, run=lambda device=device: run(device))
+            # the limit is shared by both lanes
+            job.state = streamix.FileState.Remap if i % 2 else streamix.FileState.Convert
+            scheduler.submit(job)
+    scheduler.join()
+
+    assert scheduler.processed == 12
+    assert most == {"a": 1, "b": 1}
+
+
+@unittest.mock.patch("streamix.DeviceMap.key", side_effect=_device_of)
+def test_probes_are_limited_per_device_and_spread_over_the_devices(mock_key):
+    lock = threading.Lock()
+    active = collections.Counter()
+    most = collections.Counter()
+    overlapped = threading.Event()
+    started = []
+
+    def probe(file_path, **kwargs):
+        device = _device_of(file_path)
+        with lock:
+            started.append(file_path)
+            active[device] += 1
+            most[device] = max(most[device], active[device])
+            if len(+active) > 1:
+                overlapped.set()
+        # a probe of the other device starts while this one runs, however the files are ordered
+        overlapped.wait(0.5)
+        with lock:
+            active[device] -= 1
+        return file_path
+
+    # the scan goes through one device at a time
+    files = ["a{0}".format(i) for i in range(6)] + ["b{0}".format(i) for i in range(6)]
+    with unittest.mock.patch.dict(streamix.cfg, {"device_probe_workers": 1}), \
+            unittest.mock.patch("streamix.FileProcessor", side_effect=probe):
+        probed = list(streamix.probe_files(files, workers=4, config=testhelper.CONFIG))
+
+    assert sorted(probed) == files
+    assert most == {"a": 1, "b": 1}
+    assert overlapped.is_set()
+    # the devices take turns
+    assert sorted(started[:2]) == ["a0", "b0"]
+
+
+def test_device_map_groups_network_files_by_export(tmp_path):
+    mounts = tmp_path / "mounts"
+    mounts.write_text("/dev/sda1 / ext4 rw 0 0\n"
+                      "server:/export /mnt/library nfs4 rw 0 0\n"
+                      "//nas/share /mnt/my\\040share cifs rw 0 0\n")
+    devices = streamix.DeviceMap(str(mounts))
+
+    assert devices._device_key("/mnt/library/movies/a.mkv", 42) == "server:/export"
+    assert devices._device_key("/mnt/my share/a.mkv", 43) == "//nas/share"
+    assert devices._device_key("/mnt/library2/a.mkv", 44) == 44
+    assert devices._device_key("/home/a.mkv", 45) == 45
+
+
+def test_device_map_key_of_a_missing_file_is_none(tmp_path):
+    assert streamix.DeviceMap().key(tmp_path / "missing.mkv") is None
+
+
+#########################################
+#
+# Test cpu governor
+#
+#########################################
+
+def test_governor_splits_the_cpus_between_conversions():
+    governor = streamix.CpuGovernor(convert_workers=3, cpus=range(8), convert_cpu_share=0.75)
+
+    assert governor.partitions == [{0, 1}, {2, 3}, {4, 5}]
+    with governor.share(streamix.FileState.Convert) as first, governor.share(streamix.FileState.Convert) as second:
+        assert first.cpus == {0, 1}
+        assert first.threads == 2
+        assert second.cpus == {2, 3}
+    # the partitions are free again
+    with governor.share(streamix.FileState.Convert) as share:
+        assert share.cpus == {0, 1}
+
+
+def test_governor_never_splits_below_one_cpu():
+    governor = streamix.CpuGovernor(convert_workers=4, cpus=[0, 1])
+
+    assert governor.partitions == [{0}, {1}]
+    with governor.share(streamix.FileState.Convert), governor.share(streamix.FileState.Convert):
+        # more conversions than cpus share the least busy partition
+        with governor.share(streamix.FileState.Convert) as share:
+            assert share.cpus == {0}
+
+
+def test_remaps_get_an_idle_io_priority_and_no_cpu_limit():
+    streamix.load_config()
+    governor = streamix.CpuGovernor(convert_workers=2, cpus=range(4))
+
+    with governor.share(streamix.FileState.Remap) as share:
+        assert share.cpus is None
+        assert share.threads is None
+        assert share.ioprio == streamix.CpuGovernor.ioprio("idle")
+
+
+def test_threads_are_set_just_before_the_output_file():
+    args = ["ffmpeg", "-i", "in.mkv", "-c:1", "copy", "out.tmp.mkv"]
+
+    assert streamix.CpuShare({0, 1}, 2, 0, None).command_args(args) == \
+        ["ffmpeg", "-i", "in.mkv", "-c:1", "copy", "-threads", "2", "out.tmp.mkv"]
+    assert streamix.UNGOVERNED.command_args(args) == args
+
+
+def test_ionice_settings_are_parsed_to_ioprio_values():
+    assert streamix.CpuGovernor.ioprio("idle") == 3 << 13 | 4
+    assert streamix.CpuGovernor.ioprio("best-effort:7") == 2 << 13 | 7
+    assert streamix.CpuGovernor.ioprio("realtime:0") == 1 << 13
+    assert streamix.CpuGovernor.ioprio(None) is None
+    try:
+        streamix.CpuGovernor.ioprio("lowest")
+        assert False, "expected an error for the unknown class"
+    except ValueError:
+        pass
+
+
+@unittest.mock.patch("streamix.os.rename")
+def test_run_applies_the_cpu_share_to_ffmpeg(mock_rename):
+    file_processor = testhelper.build_file_processor_for_json_file("test-info_client.json")
+    governor = streamix.CpuGovernor(convert_workers=1, cpus=[0, 1])
+
+    def fake_run(args, on_start=None, **kwargs):
+        on_start(1234)
+        return streamix.CommandResult(0, "", [])
+
+    with unittest.mock.patch("streamix.run_command", side_effect=fake_run) as mock_run, \
+            unittest.mock.patch("streamix.place_file", return_value="rename"), \
+            unittest.mock.patch.object(governor, "apply") as mock_apply:
+        assert file_processor.run(governor=governor) is True
+
+    assert file_processor.state == streamix.FileState.Convert
+    assert mock_apply.call_args[0][0].cpus == {0, 1}
+    assert mock_apply.call_args[0][1] == 1234
+    assert mock_run.call_args[0][0][-3:-1] == ["-threads", "2"]
+
+
+#########################################
+#
+# Test deduplication
+#
+#########################################
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_hard_links_and_symlinks_are_checked_once(tmp_path):
+    movie = _write(tmp_path / "movies" / "a.mkv", b"movie")
+    os.link(str(movie), str(tmp_path / "b.mkv"))
+    os.symlink(str(tmp_path / "movies"), str(tmp_path / "linked"))
+    dedup = streamix.Deduplicator()
+
+    unique = list(dedup.unique([movie, tmp_path / "b.mkv", tmp_path / "linked" / "a.mkv"]))
+
+    assert unique == [movie]
+    assert dedup.hardlinks == 1
+    assert dedup.symlinks == 1
+    assert dedup.links_of(movie) == [tmp_path / "b.mkv"]
+
+
+def test_hard_links_are_linked_to_the_re_encoded_file(tmp_path):
+    movie = _write(tmp_path / "a.mkv", b"movie")
+    early = tmp_path / "b.mkv"
+    late = tmp_path / "c.mkv"
+    os.link(str(movie), str(early))
+    os.link(str(movie), str(late))
+    dedup = streamix.Deduplicator()
+    assert list(dedup.unique([movie, early])) == [movie]
+
+    # the re-encode replaces the file, breaking the links
+    os.replace(str(_write(tmp_path / "a.tmp.mkv", b"re-encoded")), str(movie))
+    dedup.replaced(movie)
+    assert os.path.samefile(str(movie), str(early))
+
+    # a link found once the file was replaced is linked right away
+    assert list(dedup.unique([late])) == []
+    assert os.path.samefile(str(movie), str(late))
+    assert late.read_bytes() == b"re-encoded"
+    assert not (tmp_path / "c.tmp.mkv").exists()
+
+
+def test_copies_are_only_found_when_comparing_content(tmp_path):
+    first = _write(tmp_path / "a.mkv", b"x" * 100 + b"same")
+    copy = _write(tmp_path / "b.mkv", b"x" * 100 + b"same")
+    # the same size, start and end
+    other = _write(tmp_path / "c.mkv", b"x" * 50 + b"y" + b"x" * 49 + b"same")
+
+    assert list(streamix.Deduplicator().unique([first, copy, other])) == [first, copy, other]
+
+    dedup = streamix.Deduplicator(content=True, hash_bytes=8)
+    assert list(dedup.unique([first, copy, other])) == [first, other]
+    assert dedup.copies == 1
+
+
+def test_a_changed_file_is_let_through_again():
+    dedup = streamix.Deduplicator(content=True)
+    path = streamix.pathlib.Path(testhelper.__file__)
+
+    assert list(dedup.unique([path])) == [path]
+    assert list(dedup.unique([path])) == [path]
+
+
+def test_scheduler_links_the_re_encoded_file():
+    dedup = unittest.mock.Mock()
+    scheduler = streamix.EncodeScheduler(remap_workers=1, convert_workers=1, dedup=dedup)
+    scheduler.submit(FakeJob(streamix.FileState.Remap))
+    scheduler.submit(FakeJob(streamix.FileState.Convert, lambda: False))
+    scheduler.join()
+
+    dedup.replaced.assert_called_once_with(streamix.pathlib.Path("file.mkv"))
+
+
+def test_plan_keeps_the_hard_links_for_apply(tmp_path):
+    plan_file, remap = _plan_library(tmp_path, links=True)
+    dedup = streamix.Deduplicator()
+
+    jobs = list(streamix.read_plan(plan_file, dedup=dedup))
+
+    assert [job.file_path for job in jobs] == [remap]
+    assert dedup.links_of(remap) == [tmp_path / "remap-link.mkv"]
+
+
+#########################################
+#
+# Test logging
+#
+#########################################
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread().name)
+
+
+def test_queued_logging_hands_records_to_the_handlers():
+    root = logging.getLogger()
+    saved = root.handlers[:]
+    handler = ListHandler()
+    root.handlers[:] = [handler]
+    try:
+        streamix.queue_logging()
+        assert isinstance(root.handlers[0], logging.handlers.QueueHandler)
+        streamix.logger.warning("queued {0}".format(1))
+        streamix.stop_logging()
+
+        assert [r.getMessage() for r in handler.records] == ["queued 1"]
+        assert threading.current_thread().name not in handler.threads
+        assert root.handlers == [handler]
+    finally:
+        streamix.stop_logging()
+        root.handlers[:] = saved
+
+
+def test_file_header_is_one_line_when_compact():
+    remap = testhelper.build_file_processor_for_streams(
+        [testhelper.build_video_stream(), testhelper.build_audio_stream("abc"),
+         testhelper.build_audio_stream("aac", language="eng")])
+
+    with unittest.mock.patch.object(streamix.logger, "info") as mock_info:
+        remap.print_file_header(compact=True)
+        remap.print_file_header(compact=False)
+
+    assert mock_info.call_args_list[0][0][0] == "remap: {0}".format(remap.file_path)
+    assert "********" in mock_info.call_args_list[1][0][0]
+
+
+def test_skipped_files_are_only_counted():
+    skip = testhelper.build_file_processor_for_streams(
+        [testhelper.build_video_stream(), testhelper.build_audio_stream("aac")])
+    scheduler = streamix.EncodeScheduler(remap_workers=1, convert_workers=1)
+
+    with unittest.mock.patch.object(streamix.logger, "info") as mock_info:
+        streamix._decide(skip, scheduler)
+        streamix._decide(skip, scheduler)
+    scheduler.join()
+
+    assert not mock_info.called
+    assert scheduler.states == {streamix.FileState.Skip: 2}
+    assert streamix.count_states(scheduler.states) == "2 skip"
+    assert streamix.count_states(collections.Counter()) == "none"
+
+
+#########################################
+#
+# Test metrics
+#
+#########################################
+
+def test_metrics_time_phases_into_json_lines_and_prometheus(tmp_path):
+    streamix.load_config()
+    streamix.metrics.open(tmp_path / "metrics.jsonl", tmp_path / "streamix.prom")
+    info = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac"),
+                                  testhelper.build_audio_stream("aac", language="eng")])
+    try:
+        with unittest.mock.patch("streamix.FileProcessor._probe_file", return_value=info):
+            streamix.FileProcessor(streamix.pathlib.Path("file.mkv"))
+        streamix.metrics.observe("encode", 20.0, "file.mkv")
+    finally:
+        streamix.metrics.close()
+
+    with io.open(str(tmp_path / "metrics.jsonl")) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["phase"] for line in lines] == ["probe", "decide", "encode", "run"]
+    assert lines[0]["file"] == "file.mkv"
+    assert lines[-1]["files"] == {"remap": 1}
+    assert lines[-1]["phases"]["encode"]["secs"] == 20.0
+
+    prometheus = (tmp_path / "streamix.prom").read_text()
+    assert 'streamix_phase_seconds_bucket{phase="encode",le="10"} 0' in prometheus
+    assert 'streamix_phase_seconds_bucket{phase="encode",le="60"} 1' in prometheus
+    assert 'streamix_phase_seconds_count{phase="encode"} 1' in prometheus
+    assert 'streamix_files_total{state="remap"} 1' in prometheus
+
+
+def test_metrics_time_nothing_when_disabled():
+    metrics = streamix.Metrics()
+    assert not metrics.enabled
+    assert metrics.timed("probe") is metrics.timed("decide")
+
+    with metrics.timed("probe"):
+        pass
+    metrics.file_state(streamix.FileState.Remap)
+    assert metrics.summary() == {"phases": {}, "files": {}}
+
+
+#########################################
+#
+# Test config
+#
+#########################################
+
+def test_config_is_compiled_once_and_frozen():
+    config = testhelper.build_config()
+
+    assert isinstance(config.safe_codecs, frozenset)
+    assert isinstance(config.extensions, frozenset)
+    assert config.codec_ranks[config.codec_priority[0]] == 0
+    assert config.extra_encode_params == ("-strict", "experimental")
+
+    try:
+        config.dry_run = False
+        assert False, "expected the config to be immutable"
+    except AttributeError:
+        pass
+
+
+def test_config_can_be_sent_to_other_processes():
+    config = testhelper.build_config(scratch_dir="/scratch")
+    assert pickle.loads(pickle.dumps(config)) == config
+
+
+def test_processors_share_the_current_config():
+    streamix.load_config()
+    first = streamix.FileProcessor(streamix.pathlib.Path("a.mkv"), file_info={})
+    second = streamix.FileProcessor(streamix.pathlib.Path("b.mkv"), file_info={})
+
+    assert first.config is second.config
+
+
+def test_config_priority_keeps_the_first_of_a_repeated_codec():
+    config = testhelper.build_config(audio_codec_priority=["dts", "ac3", "dts"])
+    assert config.codec_ranks == {"dts": 0, "ac3": 1}
+
+    # shared by every processor, so read-only (also once unpickled)
+    for ranks in (config.codec_ranks, pickle.loads(pickle.dumps(config)).codec_ranks):
+        try:
+            ranks["aac"] = 2
+            assert False, "expected the codec ranks to be read-only"
+        except TypeError:
+            pass
+
+
+#########################################
+#
+# Test leases
+#
+#########################################
+
+def _coordinated_run(lease_dir, files, log_file):
+    """One host of a coordinated run, remapping the files (a remapped file probes as a skip afterwards)"""
+    remap = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("dts"),
+                                   testhelper.build_audio_stream("aac", language="eng")])
+    skip = testhelper.build_info([testhelper.build_video_stream(), testhelper.build_audio_stream("aac", language="eng")])
+
+    def probe(processor):
+        return skip if streamix.os.path.exists("{0}.done".format(processor.file_path)) else remap
+
+    def run(processor, status=None, governor=None):
+        with io.open(log_file, "a") as f:
+            f.write("{0}\n".format(processor.file_path))
+        _touch(streamix.pathlib.Path("{0}.done".format(processor.file_path)))
+        return True
+
+    streamix.load_config()
+    leases = streamix.LeaseManager(lease_dir)
+    with unittest.mock.patch("streamix.FileProcessor._probe_file", autospec=True, side_effect=probe):
+        with unittest.mock.patch("streamix.FileProcessor.run", autospec=True, side_effect=run):
+            streamix.process_files(iter(files), leases=leases)
+    leases.close()
+
+
+def test_leases_let_each_file_be_processed_by_one_host(tmp_path):
+    files = [_touch(tmp_path / "library" / "{0}.mkv".format(i)) for i in range(60)]
+    log_file = str(tmp_path / "processed.log")
+    context = multiprocessing.get_context("fork")
+
+    hosts = [context.Process(target=_coordinated_run, args=(str(tmp_path / "leases"), files, log_file))
+             for _ in range(3)]
+    for host in hosts:
+        host.start()
+    for host in hosts:
+        host.join(30)
+        assert host.exitcode == 0
+
+    with io.open(log_file) as f:
+        processed = f.read().split()
+    assert sorted(processed) == sorted(str(f) for f in files)
+    assert list((tmp_path / "leases").iterdir()) == []
+
+
+def test_lease_is_exclusive_until_released(tmp_path):
+    first = streamix.LeaseManager(tmp_path, owner="first")
+    second = streamix.LeaseManager(tmp_path, owner="second")
+
+    assert first.claim("/library/file.mkv")
+    assert not second.claim("/library/file.mkv")
+    assert second.busy == 1
+
+    first.release("/library/file.mkv")
+    assert second.claim("/library/file.mkv")
+
+
+def test_lease_of_a_file_that_fails_to_probe_is_released(tmp_path):
+    leases = streamix.LeaseManager(tmp_path, owner="first")
+    other = streamix.LeaseManager(tmp_path, owner="second")
+    path = streamix.pathlib.Path("/library/unreadable.mkv")
+
+    with unittest.mock.patch("streamix.FileProcessor._read_file_info", side_effect=RuntimeError("probe crashed")):
+        checked, scheduler = streamix.process_files([path], leases=leases, config=testhelper.CONFIG)
+
+    assert checked == 0
+    # released during the run, not when the leases are closed
+    assert other.claim(path)
+    leases.close()
+    other.close()
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    dead = streamix.LeaseManager(tmp_path, ttl_secs=60, owner="dead")
+    alive = streamix.LeaseManager(tmp_path, ttl_secs=60, owner="alive")
+    assert dead.claim("/library/file.mkv")
+
+    # the dead host stopped touching its lease two minutes ago
+    lease_file = str(dead.lease_file("/library/file.mkv"))
+    streamix.os.utime(lease_file, (time.time() - 120, time.time() - 120))
+
+    assert alive.claim("/library/file.mkv")
+    assert alive.reclaimed == 1
+
+    # the dead host notices it lost the lease and leaves it alone
+    dead.heartbeat()
+    assert not dead.holds("/library/file.mkv")
+    dead.release("/library/file.mkv")
+    assert alive.holds("/library/file.mkv")
+    assert streamix.os.path.exists(lease_file)
+
+
+def test_live_lease_moved_aside_does_not_overwrite_a_new_lease(tmp_path):
+    slow = streamix.LeaseManager(tmp_path, ttl_secs=60, owner="slow")
+    alive = streamix.LeaseManager(tmp_path, ttl_secs=60, owner="alive")
+    third = streamix.LeaseManager(tmp_path, ttl_secs=60, owner="third")
+    assert slow.claim("/library/file.mkv")
+
+    lease_file = str(slow.lease_file("/library/file.mkv"))
+    streamix.os.utime(lease_file, (time.time() - 120, time.time() - 120))
+    rename = streamix.os.rename
+
+    def late_heartbeat_rename(src, dst):
+        # the slow host touches its lease right before it is moved aside, and a third host claims the free path
+        streamix.os.utime(src)
+        rename(src, dst)
+        assert third.claim("/library/file.mkv")
+
+    with unittest.mock.patch("streamix.os.rename", late_heartbeat_rename):
+        assert not alive.claim("/library/file.mkv")
+
+    assert alive.busy == 1 and alive.reclaimed == 0
+    assert streamix.LeaseManager._owner_of(lease_file) == "third"
+    assert streamix.os.listdir(str(tmp_path)) == [streamix.os.path.basename(lease_file)]
+
+
+def test_heartbeat_keeps_the_lease_alive(tmp_path):
+    leases = streamix.LeaseManager(tmp_path, owner="host")
+    assert leases.claim("/library/file.mkv")
+
+    lease_file = str(leases.lease_file("/library/file.mkv"))
+    streamix.os.utime(lease_file, (time.time() - 120, time.time() - 120))
+    leases.heartbeat()
+
+    assert time.time() - streamix.os.stat(lease_file).st_mtime < 5
+
+
+def test_heartbeat_keeps_a_lease_it_can_not_read_for_now(tmp_path):
+    leases = streamix.LeaseManager(tmp_path, owner="host")
+    assert leases.claim("/library/file.mkv")
+
+    stale = OSError(116, "Stale file handle")
+    with unittest.mock.patch("streamix.io.open", side_effect=stale):
+        leases.heartbeat()
+    assert leases.holds("/library/file.mkv")
+
+    # only a lease that is gone (or someone else's) is dropped
+    streamix.os.remove(str(leases.lease_file("/library/file.mkv")))
+    leases.heartbeat()
+    assert not leases.holds("/library/file.mkv")
+
+
+def test_jobs_whose_lease_was_lost_are_counted(tmp_path):
+    leases = streamix.LeaseManager(tmp_path, owner="host")
+    ran = []
+    scheduler = streamix.EncodeScheduler(remap_workers=1, convert_workers=1, leases=leases)
+    scheduler.submit(FakeJob(streamix.FileState.Remap, run=lambda: ran.append(True)))
+    scheduler.join()
+
+    assert not ran
+    assert (scheduler.processed, scheduler.failed, scheduler.lost) == (0, 0, 1)
@@ -6,6 +6,10 @@ import json
 
 __author__ = 'cody'
 
+streamix.load_config()
+_settings = dict(streamix.cfg)
+CONFIG = streamix.current_config()
+
 @pytest.fixture
 def tmp_path(tmpdir):
     return pathlib.Path(str(tmpdir))
@@ -44,24 +48,116 @@ def build_info(streams):
     return info
 
 
-def build_file_processor_for_info(info, filename=None):
-    name = "file.mkv" if filename is None else filename
-
-    streamix.load_config()
+def build_config(**settings):
+    """The config from config.yml (loaded once), with the given settings changed"""
+    return streamix.Config.from_dict(dict(_settings, **settings)) if settings else CONFIG
 
-    file_processor = streamix.FileProcessor(pathlib.Path(name))
-    file_processor.file_info = info
-    file_processor._file_info_loaded()
 
-    return file_processor
+def build_file_processor_for_info(info, filename=None, config=None):
+    name = "file.mkv" if filename is None else filename
+    return streamix.FileProcessor(pathlib.Path(name), file_info=info, config=config or CONFIG)
 
 
-def build_file_processor_for_streams(streams, filename=None)->streamix.FileProcessor:
-    name = "file.mkv" if filename is None else filename
-    return build_file_processor_for_info(build_info(streams), filename)
+def build_file_processor_for_streams(streams, filename=None, config=None)->streamix.FileProcessor:
+    return build_file_processor_for_info(build_info(streams), filename, config)
 
 
-def build_file_processor_for_json_file(json_file, filename=None):
+def build_file_processor_for_json_file(json_file, filename=None, config=None):
     with io.open(str(json_file)) as f:
         info = json.load(f)
-    return build_file_processor_for_info(info, filename)
+    return build_file_processor_for_info(info, filename, config)
+
+
+def _ebml(element_id, payload):
+    """An EBML element, always with an 8 byte size so the positions of later elements are easy to work out"""
+    if isinstance(payload, int):
+        payload = payload.to_bytes(8, "big")
+    elif isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    elif isinstance(payload, list):
+        payload = b"".join(payload)
+
+    return (element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") +
+            (0x01 << 56 | len(payload)).to_bytes(8, "big") + payload)
+
+
+def build_mkv(tracks, duration=60.0, attachments=False, tracks_after_cluster=False):
+    """
+    A minimal Matroska file with the given tracks as (track type, codec id, language or None) tuples, optionally
+    followed by the FlagDefault and FlagForced values (None leaves the element out).
+    With tracks_after_cluster, the tracks are only found through the seek head.
+    """
+    mkv = streamix.mediaheaders.MatroskaHeader
+    header = _ebml(mkv.EBML, [_ebml(mkv.DOC_TYPE, "matroska")])
+
+    entries = []
+    for track in tracks:
+        track_type, codec_id, language, flag_default, flag_forced = tuple(track) + (None,) * (5 - len(track))
+        entry = [_ebml(0xD7, len(entries) + 1), _ebml(mkv.TRACK_TYPE, track_type), _ebml(mkv.CODEC_ID, codec_id)]
+        if language is not None:
+            entry.append(_ebml(mkv.LANGUAGE, language))
+        if flag_default is not None:
+            entry.append(_ebml(mkv.FLAG_DEFAULT, flag_default))
+        if flag_forced is not None:
+            entry.append(_ebml(mkv.FLAG_FORCED, flag_forced))
+        entries.append(_ebml(mkv.TRACK_ENTRY, entry))
+
+    info = _ebml(mkv.INFO, [_ebml(mkv.TIMESTAMP_SCALE, 1000000),
+                            _ebml(mkv.DURATION, streamix.struct.pack(">d", duration * 1000))])
+    track_list = _ebml(mkv.TRACKS, entries)
+    cluster = _ebml(mkv.CLUSTER, b"\0" * 4096)
+    children = [info, cluster, track_list] if tracks_after_cluster else [info, track_list, cluster]
+    if attachments:
+        children.append(_ebml(mkv.ATTACHMENTS, b""))
+
+    def seek_head(positions):
+        return _ebml(mkv.SEEK_HEAD, [_ebml(mkv.SEEK, [_ebml(mkv.SEEK_ID, element_id.to_bytes(4, "big")),
+                                                      _ebml(mkv.SEEK_POSITION, position)])
+                                     for element_id, position in positions])
+
+    # the seek head has the same size whatever the positions, so it can be built twice
+    positions = []
+    offset = len(seek_head([(int.from_bytes(c[:4], "big"), 0) for c in children]))
+    for child in children:
+        positions.append((int.from_bytes(child[:4], "big"), offset))
+        offset += len(child)
+
+    return header + _ebml(mkv.SEGMENT, [seek_head(positions)] + children)
+
+
+def _box(box_type, *payload):
+    payload = b"".join(payload)
+    return streamix.struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _mp4a(object_type):
+    decoder_config = bytes([0x04, 13, object_type, 0x15]) + b"\0" * 11
+    es_descriptor = bytes([0x03, 3 + len(decoder_config), 0, 1, 0]) + decoder_config
+    return _box(b"mp4a", b"\0" * 28, _box(b"esds", b"\0" * 4, es_descriptor))
+
+
+def _pack_language(language):
+    if language is None:
+        return 0x7FFF
+    return sum((ord(c) - 0x60) << shift for c, shift in zip(language, (10, 5, 0)))
+
+
+def build_mp4(tracks, duration=60):
+    """
+    A minimal MP4 file with the given tracks as (handler, sample entry type or mp4a object type, language or None,
+    sample sizes) tuples, with a timescale of 1000 and the given duration in seconds for every track
+    """
+    traks = []
+    for handler, entry, language, sample_sizes in tracks:
+        sample_entry = _mp4a(entry) if isinstance(entry, int) else _box(entry, b"\0" * 78)
+        stsd = _box(b"stsd", streamix.struct.pack(">II", 0, 1), sample_entry)
+        stsz = _box(b"stsz", streamix.struct.pack(">III", 0, 0, len(sample_sizes)),
+                    streamix.struct.pack(">{0}I".format(len(sample_sizes)), *sample_sizes))
+        mdhd = _box(b"mdhd", streamix.struct.pack(">IIIIIHH", 0, 0, 0, 1000, duration * 1000,
+                                                  _pack_language(language), 0))
+        hdlr = _box(b"hdlr", streamix.struct.pack(">II4s", 0, 0, handler), b"\0" * 13)
+        tkhd = _box(b"tkhd", streamix.struct.pack(">I", 3), b"\0" * 80)
+        traks.append(_box(b"trak", tkhd, _box(b"mdia", mdhd, hdlr, _box(b"minf", _box(b"stbl", stsd, stsz)))))
+
+    mvhd = _box(b"mvhd", streamix.struct.pack(">IIIII", 0, 0, 0, 1000, duration * 1000), b"\0" * 80)
+    return _box(b"ftyp", b"isom\0\0\0\0") + _box(b"mdat", b"\0" * 4096) + _box(b"moov", mvhd, *traks)